@@ -1,9 +1,14 @@
 import numpy as np
-import gzip
 import os
 import logging
 import pandas as pd
 
+from merger.clean.libraries import merger_library
+from merger.clean.libraries.merger_library import MACHO_COLUMNS
+
+BAD_TIMESTAMPS_COLUMNS = MACHO_COLUMNS + ['red_amp', 'blue_amp', 'observation_id']
+
+
 def MACHO_raw_to_pickle(filename, input_path, output_path):
 	"""
 	Read MACHO gzipped lightcurve file and save it to pickle
@@ -17,62 +22,28 @@ def MACHO_raw_to_pickle(filename, input_path, output_path):
 	output_path : str
 		Path where to save the resulting pickle file
 	"""
-	try:
-		with gzip.open(os.path.join(input_path, filename), 'rt') as f:
-			lc = {'time': [],
-				  'red_M': [],
-				  'rederr_M': [],
-				  'blue_M': [],
-				  'blueerr_M': [],
-				  'id_M': [],
-				  'red_amp': [],
-				  'blue_amp': [],
-				  'observation_id': []
-				  }
-			for line in f:
-				line = line.split(';')
-				lc['id_M'].append(line[1] + ":" + line[2] + ":" + line[3])
-				lc['time'].append(float(line[4]))
-				lc['red_M'].append(float(line[9]))
-				lc['rederr_M'].append(float(line[10]))
-				lc['blue_M'].append(float(line[24]))
-				lc['blueerr_M'].append(float(line[25]))
-				lc['red_amp'].append(float(line[17]))
-				lc['blue_amp'].append(float(line[32]))
-				lc['observation_id'].append(int(line[5]))
-	except FileNotFoundError:
+	if not os.path.isfile(os.path.join(input_path, filename)):
 		logging.error(f"File {os.path.join(input_path, filename)} not found.")
-	pd.DataFrame.from_dict(lc).to_pickle(os.path.join(output_path, filename[:-3]+".bz2"), compression='bz2')
+		return
+	merger_library.read_macho_lightcurve(input_path, filename, columns=BAD_TIMESTAMPS_COLUMNS).to_pickle(os.path.join(output_path, filename[:-3]+".bz2"), compression='bz2')
 
 
 def read_macho_lightcurve(filepath):
-	try:
-		with gzip.open(filepath, 'rt') as f:
-			lc = {'time':[],
-				  'red_M':[],
-				  'rederr_M':[],
-				  'blue_M':[],
-				  'blueerr_M':[],
-				  'id_M':[],
-				  'red_amp': [],
-				  'blue_amp': [],
-				  "observation_id":[]}
-			for line in f:
-				line = line.split(';')
-				lc['id_M'].append(line[1]+":"+line[2]+":"+line[3])
-				lc['time'].append(float(line[4]))
-				lc['red_M'].append(float(line[9]))
-				lc['rederr_M'].append(float(line[10]))
-				lc['blue_M'].append(float(line[24]))
-				lc['blueerr_M'].append(float(line[25]))
-				lc['red_amp'].append(float(line[17]))
-				lc['blue_amp'].append(float(line[32]))
-				lc['observation_id'].append(int(line[5]))
-			f.close()
-	except FileNotFoundError:
+	"""
+	Read MACHO gzipped lightcurve file, with the columns needed to spot bad timestamps (BAD_TIMESTAMPS_COLUMNS)
+
+	Parameters
+	----------
+	filepath : str
+
+	Returns
+	-------
+	pd.DataFrame
+	"""
+	if not os.path.isfile(filepath):
 		print(filepath+" doesn't exist.")
 		return None
-	return pd.DataFrame.from_dict(lc)
+	return merger_library.read_macho_lightcurve(os.path.dirname(filepath), os.path.basename(filepath), columns=BAD_TIMESTAMPS_COLUMNS)
 
 
 def MACHO_get_bad_timestamps(field, output_filepath, pickles_path=None, archives_path=None):
@@ -0,0 +1,171 @@
+"""
+Binary index of an EROS-MACHO association file.
+
+The (id_E, id_M) pairs of a MACHO field are stored as integer identifiers (see star_ids) sorted both ways, one .npy file per array,
+in a <field>.idx directory next to the <field>.txt association file, with the size and modification time of the text file
+to detect when it is replaced (see merger_library.load_correspondance_index). Jobs memory map the arrays, so that the pages are shared
+between the processes of a node, and look up stars with binary searches :
+- the counterpart of a star (or of an array of stars) in the other catalogue,
+- the pairs of a MACHO tile, contiguous in the id_M order,
+- the pairs of an EROS CCD or quarter, contiguous in the id_E order.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+from merger.clean.libraries.star_ids import encode_macho_id, encode_eros_id_parts, EROS_QUARTERS, MACHO_SEQ_BITS
+
+CORRESPONDANCE_INDEX_SUFFIX = '.idx'
+
+# Arrays of the index : sorted keys, and their counterpart, in each direction
+_INDEX_FILES = ['eros_id_E', 'eros_id_M', 'macho_id_M', 'macho_id_E']
+SOURCE_STAT_FILE = 'source_stat.npy'	# Size and modification time of the association file the index was built from
+# Lowest bits of the CCD and of the quarter in EROS identifiers (see star_ids)
+EROS_CCD_SHIFT = 38
+EROS_QUARTER_SHIFT = 36
+
+
+def correspondance_index_path(correspondance_path):
+	"""Directory of the index of an association file (<field>.txt)"""
+	return os.path.splitext(correspondance_path)[0] + CORRESPONDANCE_INDEX_SUFFIX
+
+
+def _lookup(keys, values, ids):
+	ids = np.asarray(ids, dtype='i8')
+	i = np.searchsorted(keys, ids)
+	found = i < len(keys)
+	found[found] = keys[i[found]] == ids[found]
+	return np.where(found, values[np.minimum(i, len(keys) - 1)] if len(keys) else -1, -1)
+
+
+class CorrespondanceIndex:
+	"""
+	EROS-MACHO pairs sorted by id_E and by id_M
+
+	Parameters
+	----------
+	eros_id_E, eros_id_M : np.ndarray
+		Pairs sorted by id_E
+	macho_id_M, macho_id_E : np.ndarray
+		Pairs sorted by id_M
+	"""
+	def __init__(self, eros_id_E, eros_id_M, macho_id_M, macho_id_E):
+		self.eros_id_E = eros_id_E
+		self.eros_id_M = eros_id_M
+		self.macho_id_M = macho_id_M
+		self.macho_id_E = macho_id_E
+
+	@classmethod
+	def from_pairs(cls, id_E, id_M):
+		"""
+		Index of (id_E, id_M) pairs
+
+		Raises
+		------
+		ValueError
+			If a star appears in several pairs
+		"""
+		id_E = np.asarray(id_E, dtype='i8')
+		id_M = np.asarray(id_M, dtype='i8')
+		by_eros = np.argsort(id_E, kind='stable')
+		by_macho = np.argsort(id_M, kind='stable')
+		for name, keys in (('id_E', id_E[by_eros]), ('id_M', id_M[by_macho])):
+			if len(keys) and (keys[1:] == keys[:-1]).any():
+				raise ValueError(f"Stars associated more than once : {name} {keys[1:][keys[1:] == keys[:-1]][:5]}")
+		return cls(id_E[by_eros], id_M[by_eros], id_M[by_macho], id_E[by_macho])
+
+	@classmethod
+	def load(cls, path, mmap_mode='r'):
+		"""Memory map an index written by save"""
+		return cls(*[np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode) for name in _INDEX_FILES])
+
+	def save(self, path, source_stat=None):
+		"""Write the index, under a temporary name then renamed, with the source_stat of its association file if given"""
+		tmp_path = path + '.part'
+		os.makedirs(tmp_path, exist_ok=True)
+		for name in _INDEX_FILES:
+			np.save(os.path.join(tmp_path, name + '.npy'), np.asarray(getattr(self, name)))
+		if source_stat is not None:
+			np.save(os.path.join(tmp_path, SOURCE_STAT_FILE), source_stat)
+		if os.path.isdir(path):
+			for name in os.listdir(path):
+				os.remove(os.path.join(path, name))
+			os.rmdir(path)
+		os.replace(tmp_path, path)
+
+	def __len__(self):
+		return len(self.eros_id_E)
+
+	def macho_of(self, id_E):
+		"""
+		MACHO counterparts of EROS stars
+
+		Parameters
+		----------
+		id_E : int or np.ndarray
+
+		Returns
+		-------
+		np.ndarray
+			id_M of each star, -1 if it has no counterpart
+		"""
+		return _lookup(self.eros_id_E, self.eros_id_M, np.atleast_1d(id_E))
+
+	def eros_of(self, id_M):
+		"""EROS counterparts of MACHO stars, -1 if a star has no counterpart (see macho_of)"""
+		return _lookup(self.macho_id_M, self.macho_id_E, np.atleast_1d(id_M))
+
+	def _slice(self, keys, start, stop):
+		return slice(np.searchsorted(keys, start), np.searchsorted(keys, stop))
+
+	def macho_tile(self, field, tile):
+		"""
+		Pairs of the stars of a MACHO tile
+
+		Returns
+		-------
+		tuple(np.ndarray, np.ndarray)
+			id_M (sorted) and id_E
+		"""
+		start = encode_macho_id(field, tile, 0)
+		rows = self._slice(self.macho_id_M, start, start + (1 << MACHO_SEQ_BITS))
+		return self.macho_id_M[rows], self.macho_id_E[rows]
+
+	def eros_quarter(self, field, ccd, quarter=None):
+		"""
+		Pairs of the stars of an EROS CCD, or of one of its quarters
+
+		Parameters
+		----------
+		field : int
+		ccd : int
+		quarter : str
+			'k', 'l', 'm' or 'n', default : None (whole CCD)
+
+		Returns
+		-------
+		tuple(np.ndarray, np.ndarray)
+			id_E (sorted) and id_M
+		"""
+		if quarter is None:
+			start = encode_eros_id_parts(field, ccd, 0, 0, 0)
+			stop = start + (1 << EROS_CCD_SHIFT)
+		else:
+			start = encode_eros_id_parts(field, ccd, EROS_QUARTERS.index(quarter), 0, 0)
+			stop = start + (1 << EROS_QUARTER_SHIFT)
+		rows = self._slice(self.eros_id_E, start, stop)
+		return self.eros_id_E[rows], self.eros_id_M[rows]
+
+	def select_eros(self, mask):
+		"""In memory index of the pairs of some EROS stars (boolean mask in the id_E order)"""
+		return CorrespondanceIndex.from_pairs(self.eros_id_E[mask], self.eros_id_M[mask])
+
+	def to_frame(self):
+		"""
+		Returns
+		-------
+		pd.DataFrame
+			Columns id_E and id_M, sorted by id_E
+		"""
+		return pd.DataFrame({'id_E': np.array(self.eros_id_E), 'id_M': np.array(self.eros_id_M)})
@@ -7,8 +7,14 @@ from iminuit import Minuit
 import numba as nb
 
 from merger.clean.libraries.period_searcher import confidence_use
+from merger.clean.libraries.star_ids import encode_eros_id
+from merger.clean.libraries.lightcurves import RaggedLightcurves
 
 GLOBAL_COUNTER = 0
+FIT_BANDS = {'RE': ('red_E', 'rederr_E'), 'BE': ('blue_E', 'blueerr_E'), 'RM': ('red_M', 'rederr_M'), 'BM': ('blue_M', 'blueerr_M')}
+ERROR_RANGE = (0., 9.999)		# Errors of the fitted points are strictly inside
+SENTINEL_MAGNITUDES = [99.999, -99.]	# Magnitudes of invalid measures
+CUT5_TOLERANCE = 0.9		# The 5 points median cut is not applied if it removes more than 10% of both bands of a survey
 
 @nb.njit
 def microlensing_event(t, u0, t0, tE, mag1):
@@ -130,6 +136,101 @@ def weighted_std_interpolated(time, mag, err):
 		return np.nan
 	return np.sqrt(s0*v1/(v1**2 - v2))
 
+
+def cut5_points(points):
+	"""Remove aberrant points, farther than 5 sigmas from the median of the 5 points centered on them
+
+	The 2 first and last points of each band are removed too. The cut is not applied if it removes more than
+	1 - CUT5_TOLERANCE of the points of both bands of EROS or of MACHO.
+
+	Arguments:
+		points {dict} -- (time, mag, err) arrays of each band of FIT_BANDS
+
+	Returns:
+		dict -- same as points
+	"""
+	cuts = {}
+	for key, (time, mag, err) in points.items():
+		cuts[key] = np.zeros(len(mag), dtype=bool)
+		if len(mag) >= 5:
+			medians = np.median(np.lib.stride_tricks.sliding_window_view(mag, 5), axis=1)
+			cuts[key][2:-2] = np.abs(medians - mag[2:-2]) / err[2:-2] < 5
+	ratios = {key: cut.mean() if len(cut) else np.nan for key, cut in cuts.items()}
+	if (ratios['RE'] < CUT5_TOLERANCE and ratios['BE'] < CUT5_TOLERANCE) or (ratios['BM'] < CUT5_TOLERANCE and ratios['RM'] < CUT5_TOLERANCE):
+		return points
+	return {key: tuple(values[cuts[key]] for values in band_points) for key, band_points in points.items()}
+
+
+def star_points(subdf, cut5=False):
+	"""Points of one star of a merged dataframe to fit
+
+	Arguments:
+		subdf {dataframe} -- Lightcurves data
+
+	Keyword Arguments:
+		cut5 {bool} -- If True, clean aberrant points using distance from median of 5 points (default: {False})
+
+	Returns:
+		dict -- (time, mag, err) arrays of each band of FIT_BANDS, with a magnitude and an error inside ERROR_RANGE
+	"""
+	points = {}
+	for key, (mag, err) in FIT_BANDS.items():
+		mask = (subdf[mag].notnull() & subdf[err].between(*ERROR_RANGE, inclusive='neither')).values
+		points[key] = (subdf.time.values[mask], subdf[mag].values[mask], subdf[err].values[mask])
+	return cut5_points(points) if cut5 else points
+
+
+def ragged_star_points(lc, cut5=False, clean=True, time_mask=None):
+	"""Points of one star of a RaggedLightcurves to fit, as star_points
+
+	Arguments:
+		lc {dict} -- (time, mag, err) arrays by band name (see lightcurves.RaggedLightcurves.star)
+
+	Keyword Arguments:
+		cut5 {bool} -- If True, clean aberrant points using distance from median of 5 points (default: {False})
+		clean {bool} -- remove the SENTINEL_MAGNITUDES (default: {True})
+		time_mask {list} -- times of the points to keep (default: {None}, all)
+
+	Returns:
+		dict -- (time, mag, err) arrays of each band of FIT_BANDS, sorted by time
+	"""
+	points = {}
+	for key, (mag, err) in FIT_BANDS.items():
+		if mag not in lc:
+			points[key] = (np.array([]), np.array([]), np.array([]))
+			continue
+		time, mag, err = lc[mag]
+		keep = (err > ERROR_RANGE[0]) & (err < ERROR_RANGE[1])
+		if clean:
+			keep &= ~np.isin(mag, SENTINEL_MAGNITUDES)
+		if time_mask is not None:
+			keep &= np.isin(time, time_mask)
+		order = np.argsort(time[keep], kind='stable')
+		points[key] = (time[keep][order], mag[keep][order], err[keep][order])
+	return cut5_points(points) if cut5 else points
+
+
+def fit_ragged(lcs, cut5=False, clean=True, time_mask=None):
+	"""Fit on every star of a RaggedLightcurves, reading the points of each star from views of the band arrays
+
+	Arguments:
+		lcs {RaggedLightcurves} -- merged lightcurves
+
+	Keyword Arguments:
+		cut5 {bool} -- If True, clean aberrant points using distance from median of 5 points (default: {False})
+		clean {bool} -- remove the SENTINEL_MAGNITUDES (default: {True})
+		time_mask {list} -- times of the points to keep (default: {None}, all)
+
+	Returns:
+		dataframe -- one row per star (see fit_ml), indexed by the key of the stars
+	"""
+	results = []
+	for i in range(len(lcs)):
+		points = ragged_star_points(lcs.star(i), cut5=cut5, clean=clean, time_mask=time_mask)
+		results.append(fit_points(points, lcs.counterparts[i] if lcs.counterparts is not None else -1))
+	return pd.DataFrame(results, index=pd.Index(lcs.ids, name=lcs.key))
+
+
 def fit_ml(subdf, cut5=False):
 	"""Fit on one star
 	
@@ -144,90 +245,23 @@ def fit_ml(subdf, cut5=False):
 	Returns:
 		series -- Contains parameters for the microlensing and flat curve fits, their chi2, informations on the fitter (fmin) and dof.
 	"""
+	return fit_points(star_points(subdf, cut5=cut5), subdf.id_M.iloc[0])
 
-	#sélection des données, pas plus de 10% du temps de calcul en moyenne (0.01s vs 0.1s)
-	#le fit peut durer jusqu'à 0.7s ou aussi rapide que 0.04s (en général False)
-
-	maskRE = subdf.red_E.notnull() & subdf.rederr_E.notnull()
-	maskBE = subdf.blue_E.notnull() & subdf.blueerr_E.notnull()
-	maskRM = subdf.red_M.notnull() & subdf.rederr_M.notnull()
-	maskBM = subdf.blue_M.notnull() & subdf.blueerr_M.notnull()
-
-	errRE = subdf[maskRE].rederr_E
-	errBE = subdf[maskBE].blueerr_E
-	errRM = subdf[maskRM].rederr_M
-	errBM = subdf[maskBM].blueerr_M
-
-	min_err = 0.0
-	cre = errRE.between(min_err,9.999, inclusive=False)
-	cbe = errBE.between(min_err,9.999, inclusive=False)
-	crm = errRM.between(min_err,9.999, inclusive=False)
-	cbm = errBM.between(min_err,9.999, inclusive=False)
-
-	# magRE = subdf[maskRE][cre].ampli_red_E
-	# magBE = subdf[maskBE][cbe].ampli_blue_E
-	# magRM = subdf[maskRM][crm].ampli_red_M
-	# magBM = subdf[maskBM][cbm].ampli_blue_M
-
-	magRE = subdf[maskRE][cre].red_E
-	magBE = subdf[maskBE][cbe].blue_E
-	magRM = subdf[maskRM][crm].red_M
-	magBM = subdf[maskBM][cbm].blue_M
-
-	errRE = errRE[cre]
-	errBE = errBE[cbe]
-	errRM = errRM[crm]
-	errBM = errBM[cbm]
-
-	cut5RE = np.abs((magRE.rolling(5, center=True).median()-magRE[2:-2]))/errRE[2:-2]<5
-	cut5BE = np.abs((magBE.rolling(5, center=True).median()-magBE[2:-2]))/errBE[2:-2]<5
-	cut5RM = np.abs((magRM.rolling(5, center=True).median()-magRM[2:-2]))/errRM[2:-2]<5
-	cut5BM = np.abs((magBM.rolling(5, center=True).median()-magBM[2:-2]))/errBM[2:-2]<5
-
-	remove_extremities = True
-	if not remove_extremities:
-		cut5RE[:2] = True
-		cut5RE[-2:] = True
-		cut5BE[:2] = True
-		cut5BE[-2:] = True
-		cut5RM[:2] = True
-		cut5RM[-2:] = True
-		cut5BM[:2] = True
-		cut5BM[-2:] = True
-
-	tolerance_ratio = 0.9
-	if cut5 and not ((cut5RE.sum()/len(cut5RE)<tolerance_ratio and cut5BE.sum()/len(cut5BE)<tolerance_ratio) 
-		or (cut5BM.sum()/len(cut5BM)<tolerance_ratio and cut5RM.sum()/len(cut5RM)<tolerance_ratio)):
-		timeRE = subdf[maskRE][cre][cut5RE].time.values
-		timeBE = subdf[maskBE][cbe][cut5BE].time.values
-		timeRM = subdf[maskRM][crm][cut5RM].time.values
-		timeBM = subdf[maskBM][cbm][cut5BM].time.values
-
-		errRE = errRE[cut5RE].values
-		errBE = errBE[cut5BE].values
-		errRM = errRM[cut5RM].values
-		errBM = errBM[cut5BM].values
-
-		magRE = magRE[cut5RE].values
-		magBE = magBE[cut5BE].values
-		magRM = magRM[cut5RM].values
-		magBM = magBM[cut5BM].values
 
-	else:
-		timeRE = subdf[maskRE][cre].time.values
-		timeBE = subdf[maskBE][cbe].time.values
-		timeRM = subdf[maskRM][crm].time.values
-		timeBM = subdf[maskBM][cbm].time.values
+def fit_points(points, id_M):
+	"""Fit on the points of one star
 
-		errRE = errRE.values
-		errBE = errBE.values
-		errRM = errRM.values
-		errBM = errBM.values
+	Arguments:
+		points {dict} -- (time, mag, err) arrays of each band of FIT_BANDS (see star_points)
+		id_M {int} -- MACHO identifier of the star, printed with the fit status
 
-		magRE = magRE.values
-		magBE = magBE.values
-		magRM = magRM.values
-		magBM = magBM.values
+	Returns:
+		series -- same as fit_ml
+	"""
+	timeRE, magRE, errRE = points['RE']
+	timeBE, magBE, errBE = points['BE']
+	timeRM, magRM, errRM = points['RM']
+	timeBM, magBM, errBM = points['BM']
 
 	# if magRE.size==0 or magBE.size==0 or magRM.size==0 or magBM.size==0:
 	# 	return pd.Series(None)
@@ -314,7 +348,7 @@ def fit_ml(subdf, cut5=False):
 	m_flat.migrad()
 	global GLOBAL_COUNTER
 	GLOBAL_COUNTER+=1
-	print(str(GLOBAL_COUNTER)+" : "+subdf.id_M.iloc[0]+" "+str(m_micro.get_fmin().is_valid)+"     ")#, end='\r')
+	print(str(GLOBAL_COUNTER)+" : "+str(id_M)+" "+str(m_micro.get_fmin().is_valid)+"     ")#, end='\r')
 
 	micro_params = m_micro.values
 	flat_params = m_flat.values
@@ -384,27 +418,41 @@ def fit_ml(subdf, cut5=False):
 WORKING_DIR_PATH = "/Volumes/DisqueSauvegarde/working_dir/"
 
 
-def fit_all(merged=None, filename=None, input_dir_path=WORKING_DIR_PATH, output_dir_path=WORKING_DIR_PATH, time_mask=None):
+def fit_all(merged=None, filename=None, input_dir_path=WORKING_DIR_PATH, output_dir_path=WORKING_DIR_PATH, time_mask=None, clean=True):
 	"""Fit all curves in filename
    
 	[description]
    
 	Arguments:
 		filename {str} -- Name of the file containing the merged curves.
+
+	Keyword Arguments:
+		merged {DataFrame or RaggedLightcurves} -- merged curves, instead of loading filename (default: {None}). A RaggedLightcurves
+			is fitted star by star on its band arrays (see fit_ragged), filename still names the results
+		clean {bool} -- replace invalid magnitudes by NaN and drop rows without valid magnitude, not needed if the loaders already
+			filtered the rows (see merger_library.RowFilter) (default: {True})
 	"""
-	if not isinstance(merged, pd.DataFrame):
+	ragged = isinstance(merged, RaggedLightcurves)
+	if not ragged and not isinstance(merged, pd.DataFrame):
 		if filename[-4:] != '.pkl':
 			filename += '.pkl'
 		logging.info("Loading "+filename)
 		merged = pd.read_pickle(os.path.join(input_dir_path, filename))
-	merged.replace(to_replace=[99.999, -99.], value=np.nan, inplace=True)
-	merged.dropna(axis=0, how='all', subset=['blue_E', 'red_E', 'blue_M', 'red_M'], inplace=True)
-	if time_mask:
-		merged = merged[merged['time'].isin(time_mask)]
+	if not ragged:
+		if not pd.api.types.is_integer_dtype(merged.id_E):
+			merged['id_E'] = encode_eros_id(merged.id_E)
+		if clean:
+			merged.replace(to_replace=SENTINEL_MAGNITUDES, value=np.nan, inplace=True)
+			merged.dropna(axis=0, how='all', subset=['blue_E', 'red_E', 'blue_M', 'red_M'], inplace=True)
+		if time_mask:
+			merged = merged[merged['time'].isin(time_mask)]
 	logging.info("FILES LOADED")
-	logging.info(f"{merged.id_E.nunique()}")
+	logging.info(f"{len(merged) if ragged else merged.id_E.nunique()}")
 	start = time.time()
-	res = merged.groupby("id_E").apply(fit_ml, cut5=True)
+	if ragged:
+		res = fit_ragged(merged, cut5=True, clean=clean, time_mask=time_mask)
+	else:
+		res = merged.groupby("id_E").apply(fit_ml, cut5=True)
 	end = time.time()
 	res.to_pickle(os.path.join(output_dir_path, 'res_'+filename))
 	logging.info(str(end-start)+" seconds elapsed.")
@@ -0,0 +1,232 @@
+"""
+Ragged container of merged EROS and MACHO lightcurves.
+
+The merged dataframe has one row per EROS or MACHO measure, so half of its magnitude columns are NaN, and every star has to be grouped again
+before being fitted. RaggedLightcurves keeps one contiguous time, magnitude and error array per band, with only the valid measures,
+the measures of a star being contiguous in each band. Offset arrays give the first measure of each star in every band,
+stars being sorted by their integer key (see star_ids), so that the lightcurves of a star are views of the band arrays.
+"""
+
+import numpy as np
+import pandas as pd
+
+# Magnitude and error columns of the bands of each survey, in the merged dataframes
+SURVEY_BANDS = {
+	'E': [('red_E', 'rederr_E'), ('blue_E', 'blueerr_E')],
+	'M': [('red_M', 'rederr_M'), ('blue_M', 'blueerr_M')],
+}
+BANDS = [mag for survey in SURVEY_BANDS.values() for mag, err in survey]
+ERRORS = {mag: err for survey in SURVEY_BANDS.values() for mag, err in survey}
+
+
+class RaggedLightcurves:
+	"""
+	Lightcurves of stars in every band, as contiguous arrays.
+
+	Parameters
+	----------
+	ids : np.ndarray
+		Sorted integer key of each star (id_E for merged lightcurves)
+	time, mag, err : dict
+		Arrays of the measures of each band, by band name (see BANDS), grouped by star in the order of ids
+	offsets : dict
+		First measure of each star in each band, and number of measures of the band as last value (n_stars + 1 values)
+	counterparts : np.ndarray
+		Integer identifier of each star in the other catalogue (id_M for merged lightcurves), default : None
+	key, counterpart_key : str
+		Names of the identifier columns in dataframes, default : 'id_E' and 'id_M'
+	"""
+	def __init__(self, ids, time, mag, err, offsets, counterparts=None, key='id_E', counterpart_key='id_M'):
+		self.ids = np.asarray(ids, dtype='i8')
+		self.time = time
+		self.mag = mag
+		self.err = err
+		self.offsets = offsets
+		self.counterparts = counterparts
+		self.key = key
+		self.counterpart_key = counterpart_key
+
+	@property
+	def bands(self):
+		return list(self.offsets)
+
+	def __len__(self):
+		return len(self.ids)
+
+	def counts(self):
+		"""
+		Number of measures of each star in each band
+
+		Returns
+		-------
+		pd.DataFrame
+			One column per band, indexed by star key
+		"""
+		return pd.DataFrame({band: np.diff(offsets) for band, offsets in self.offsets.items()}, index=pd.Index(self.ids, name=self.key))
+
+	def index(self, star_key):
+		"""Position of a star, raises KeyError if it is not in the container"""
+		i = np.searchsorted(self.ids, star_key)
+		if i == len(self.ids) or self.ids[i] != star_key:
+			raise KeyError(star_key)
+		return int(i)
+
+	def star(self, i):
+		"""
+		Lightcurve of the star at position i, as views of the band arrays (no copy)
+
+		Returns
+		-------
+		dict
+			(time, mag, err) arrays, by band name
+		"""
+		lc = {}
+		for band, offsets in self.offsets.items():
+			start, end = offsets[i], offsets[i + 1]
+			lc[band] = (self.time[band][start:end], self.mag[band][start:end], self.err[band][start:end])
+		return lc
+
+	def __getitem__(self, star_key):
+		return self.star(self.index(star_key))
+
+	def __iter__(self):
+		"""
+		Yields
+		------
+		tuple(np.int64, dict)
+			Key and lightcurve (see star) of each star
+		"""
+		for i in range(len(self.ids)):
+			yield self.ids[i], self.star(i)
+
+	def select(self, stars):
+		"""
+		Container of some of the stars
+
+		Parameters
+		----------
+		stars : np.ndarray
+			Boolean mask or sorted positions of the stars to keep
+
+		Returns
+		-------
+		RaggedLightcurves
+		"""
+		stars = np.asarray(stars)
+		if stars.dtype == bool:
+			stars = np.flatnonzero(stars)
+		time, mag, err, offsets = {}, {}, {}, {}
+		for band, band_offsets in self.offsets.items():
+			counts = band_offsets[stars + 1] - band_offsets[stars]
+			rows = np.repeat(band_offsets[stars] - np.r_[0, np.cumsum(counts)[:-1]], counts) + np.arange(counts.sum())
+			time[band], mag[band], err[band] = self.time[band][rows], self.mag[band][rows], self.err[band][rows]
+			offsets[band] = np.r_[0, np.cumsum(counts)].astype('i8')
+		counterparts = self.counterparts[stars] if self.counterparts is not None else None
+		return RaggedLightcurves(self.ids[stars], time, mag, err, offsets, counterparts, self.key, self.counterpart_key)
+
+	@classmethod
+	def from_frames(cls, frames, key='id_E', counterpart_key='id_M'):
+		"""
+		Build the container from merged dataframes (see merger_library.merger_eros_first)
+
+		Each band is read from the dataframes having its magnitude column, measures with a NaN magnitude or error are dropped.
+		The measures of a star keep their order of the dataframes.
+
+		Parameters
+		----------
+		frames : list(pd.DataFrame)
+			Dataframes with a time column, magnitude and error columns of some bands (see SURVEY_BANDS), and the key column
+		key, counterpart_key : str
+			Identifier columns of the stars and of their counterparts (the counterpart column is optional)
+
+		Returns
+		-------
+		RaggedLightcurves
+		"""
+		if isinstance(frames, pd.DataFrame):
+			frames = [frames]
+		columns = {}
+		for band in BANDS:
+			parts = [df for df in frames if band in df.columns]
+			if not parts:
+				continue
+			band_keys, band_time, band_mag, band_err = [], [], [], []
+			for df in parts:
+				mag = df[band].to_numpy(dtype='f8')
+				err = df[ERRORS[band]].to_numpy(dtype='f8')
+				valid = ~(np.isnan(mag) | np.isnan(err))
+				band_keys.append(df[key].to_numpy(dtype='i8')[valid])
+				band_time.append(df['time'].to_numpy(dtype='f8')[valid])
+				band_mag.append(mag[valid])
+				band_err.append(err[valid])
+			band_keys = np.concatenate(band_keys)
+			order = np.argsort(band_keys, kind='stable')
+			columns[band] = (band_keys[order], np.concatenate(band_time)[order], np.concatenate(band_mag)[order], np.concatenate(band_err)[order])
+		ids = np.unique(np.concatenate([df[key].to_numpy(dtype='i8') for df in frames])) if frames else np.array([], dtype='i8')
+		time, mag, err, offsets = {}, {}, {}, {}
+		for band, (band_keys, time[band], mag[band], err[band]) in columns.items():
+			offsets[band] = np.r_[np.searchsorted(band_keys, ids), len(band_keys)].astype('i8')
+		counterparts = None
+		with_counterparts = [df[[key, counterpart_key]] for df in frames if counterpart_key in df.columns]
+		if with_counterparts:
+			pairs = pd.concat(with_counterparts).dropna().drop_duplicates(key).set_index(key)[counterpart_key]
+			counterparts = pairs.reindex(ids).fillna(-1).to_numpy(dtype='i8')
+		return cls(ids, time, mag, err, offsets, counterparts, key, counterpart_key)
+
+	def to_frame(self):
+		"""
+		Back to a merged dataframe : one row per measure time of a star in each survey, bands of the other survey being NaN.
+
+		Measures of the bands of a survey are put on the same row if they have the same time.
+
+		Returns
+		-------
+		pd.DataFrame
+			time, magnitude and error columns, key and counterpart columns
+		"""
+		frames = []
+		for survey, survey_bands in SURVEY_BANDS.items():
+			survey_bands = [(mag, err) for mag, err in survey_bands if mag in self.offsets]
+			if not survey_bands:
+				continue
+			# Rows of the survey : the distinct (star, time, occurrence of the time) of its bands
+			parts = []
+			for mag, err in survey_bands:
+				stars = np.repeat(np.arange(len(self.ids)), np.diff(self.offsets[mag]))
+				parts.append((stars, self.time[mag], _occurrences(stars, self.time[mag])))
+			stars = np.concatenate([part[0] for part in parts])
+			times = np.concatenate([part[1] for part in parts])
+			occurrences = np.concatenate([part[2] for part in parts])
+			order = np.lexsort((occurrences, times, stars))
+			new_row = np.r_[True, (np.diff(stars[order]) != 0) | (np.diff(times[order]) != 0) | (np.diff(occurrences[order]) != 0)]
+			rows = np.empty(len(order), dtype='i8')
+			rows[order] = np.cumsum(new_row) - 1
+			nb_rows = int(new_row.sum())
+			df = {'time': times[order][new_row]}
+			start = 0
+			for (mag, err), part in zip(survey_bands, parts):
+				band_rows = rows[start:start + len(part[0])]
+				start += len(part[0])
+				for name, values in ((mag, self.mag[mag]), (err, self.err[mag])):
+					df[name] = np.full(nb_rows, np.nan)
+					df[name][band_rows] = values
+			star_of_row = stars[order][new_row]
+			df[self.key] = self.ids[star_of_row]
+			if self.counterparts is not None:
+				df[self.counterpart_key] = self.counterparts[star_of_row]
+			frames.append(pd.DataFrame(df))
+		if not frames:
+			return pd.DataFrame({'time': [], self.key: np.array([], dtype='i8')})
+		return pd.concat(frames, ignore_index=True, sort=False)
+
+
+def _occurrences(stars, times):
+	"""Rank of each measure among the measures of the same star at the same time"""
+	if not len(stars):
+		return np.array([], dtype='i8')
+	order = np.lexsort((times, stars))
+	first = np.r_[True, (np.diff(stars[order]) != 0) | (np.diff(times[order]) != 0)]
+	group_start = np.maximum.accumulate(np.where(first, np.arange(len(order)), 0))
+	occurrences = np.empty(len(order), dtype='i8')
+	occurrences[order] = np.arange(len(order)) - group_start
+	return occurrences
@@ -0,0 +1,198 @@
+"""
+Manifest of the completed merge units of an output directory, to resume interrupted runs.
+
+A unit is a (MACHO field, EROS CCD, quarter) of merger_eros_first, or a (MACHO field, tile or t_indice) of merger_macho_first.
+When a unit completes, the manifest records the checksums of its input files (with their indexes and converted columns),
+its parameters and its output paths.
+A unit is up to date if its inputs and parameters didn't change and its outputs still exist, and is then skipped ;
+a new association file or a new bad timestamps file, for example, only recomputes the units depending on it.
+
+The manifest is a JSON file, updated under a lock file and replaced atomically, so several processes can record units at once.
+"""
+
+import os
+import json
+import time
+import fcntl
+import hashlib
+import logging
+import tempfile
+from contextlib import contextmanager
+
+MANIFEST_NAME = 'merge_manifest.json'
+MANIFEST_HASH_MAX_SIZE = 64 * 1024**2		# Bytes, larger files are identified by their size and modification time instead of their content
+
+
+def file_checksum(path):
+	"""
+	Checksum of an input file
+
+	Files up to MANIFEST_HASH_MAX_SIZE are hashed (sha256), larger ones (EROS archives, MACHO tiles) are identified by size and modification time.
+
+	Parameters
+	----------
+	path : str
+
+	Returns
+	-------
+	str or None
+		None if the file doesn't exist
+	"""
+	try:
+		stat = os.stat(path)
+	except FileNotFoundError:
+		return None
+	if stat.st_size > MANIFEST_HASH_MAX_SIZE:
+		return f"stat:{stat.st_size}:{stat.st_mtime_ns}"
+	h = hashlib.sha256()
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(1024 * 1024), b''):
+			h.update(chunk)
+	return "sha256:" + h.hexdigest()
+
+
+def unit_key(MACHO_field, eros_ccd=None, quart="", MACHO_tile=None, t_indice=None):
+	"""
+	Name of a merge unit in the manifest
+
+	Parameters
+	----------
+	MACHO_field : int
+	eros_ccd : str
+		EROS CCD ("lm0***") of a merger_eros_first unit
+	quart : str
+		Quarter of the CCD, "" for the whole CCD
+	MACHO_tile : int
+		Tile of a merger_macho_first unit
+	t_indice : int
+		Job of a merger_macho_first unit
+
+	Returns
+	-------
+	str
+	"""
+	if eros_ccd is not None:
+		return f"{MACHO_field}:{eros_ccd}{quart}"
+	if MACHO_tile is not None:
+		return f"{MACHO_field}:tile:{MACHO_tile}"
+	return f"{MACHO_field}:t_indice:{t_indice}"
+
+
+class MergeManifest:
+	"""
+	Completed merge units of an output directory
+
+	Parameters
+	----------
+	output_dir_path : str
+		Directory of the merged files, containing the manifest (MANIFEST_NAME)
+	"""
+	def __init__(self, output_dir_path):
+		self.path = os.path.join(output_dir_path, MANIFEST_NAME)
+		self.lock_path = self.path + '.lock'
+
+	@contextmanager
+	def _locked(self):
+		with open(self.lock_path, 'a') as lock:
+			fcntl.flock(lock, fcntl.LOCK_EX)
+			try:
+				yield
+			finally:
+				fcntl.flock(lock, fcntl.LOCK_UN)
+
+	def units(self):
+		"""
+		Returns
+		-------
+		dict
+			Record of each completed unit, by unit key
+		"""
+		try:
+			with open(self.path) as f:
+				return json.load(f)
+		except FileNotFoundError:
+			return {}
+
+	@staticmethod
+	def inputs(paths, parameters=None):
+		"""
+		Inputs of a unit, to compare with the recorded ones
+
+		Parameters
+		----------
+		paths : list(str)
+			Input files
+		parameters : dict
+			Parameters changing the outputs (JSON serializable), default : None
+
+		Returns
+		-------
+		dict
+		"""
+		return {'files': {path: file_checksum(path) for path in sorted(set(paths))}, 'parameters': parameters or {}}
+
+	def is_done(self, key, inputs):
+		"""
+		Whether a unit was completed with the same inputs, and its outputs still exist
+
+		Parameters
+		----------
+		key : str
+			see unit_key
+		inputs : dict
+			see inputs
+		"""
+		record = self.units().get(key)
+		if record is None:
+			return False
+		if record['inputs'] != inputs:
+			changed = [path for path, checksum in inputs['files'].items() if record['inputs']['files'].get(path) != checksum]
+			logging.info(f"{key} : inputs changed {changed if changed else 'parameters'}.")
+			return False
+		return all(os.path.exists(path) for path in record['outputs'])
+
+	def record(self, key, inputs, outputs):
+		"""
+		Record a completed unit
+
+		Parameters
+		----------
+		key : str
+		inputs : dict
+			Inputs of the unit, computed before it was run
+		outputs : list(str)
+			Paths of the written files
+		"""
+		with self._locked():
+			units = self.units()
+			units[key] = {'inputs': inputs, 'outputs': list(outputs), 'time': time.time()}
+			tmp_file = tempfile.NamedTemporaryFile('w', dir=os.path.dirname(self.path), delete=False)
+			with tmp_file:
+				json.dump(units, tmp_file, indent=1, sort_keys=True)
+			os.replace(tmp_file.name, self.path)
+
+	def run(self, key, inputs, func, force=False):
+		"""
+		Run a unit, unless it is up to date
+
+		Parameters
+		----------
+		key : str
+		inputs : dict
+			see inputs
+		func : function
+			Called without argument to run the unit, returns the paths of its outputs
+		force : bool
+			Run the unit even if it is up to date, default : False
+
+		Returns
+		-------
+		tuple(list(str), bool)
+			Output paths, and whether the unit was run
+		"""
+		if not force and self.is_done(key, inputs):
+			logging.info(f"{key} is up to date, skipped.")
+			return self.units()[key]['outputs'], False
+		outputs = func()
+		self.record(key, inputs, outputs)
+		return outputs, True
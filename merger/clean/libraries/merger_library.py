@@ -1,22 +1,43 @@
 import pandas as pd
 import numpy as np
 import os
+import io
+import copy
+import hashlib
 import gzip
 import time
 import logging
 import tarfile
+import queue
+import shutil
+import threading
+from contextlib import closing, contextmanager, nullcontext
+import zlib
+from collections import deque
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
 from irods.session import iRODSSession
 from irods.exception import CollectionDoesNotExist, DataObjectDoesNotExist
 import ssl
 
-from requests import get
+import requests
+import requests.adapters
 
-import dask.dataframe as dd
-import dask.array as da
-from dask.distributed import Client
+from dask import delayed
+from dask.distributed import Client, LocalCluster
 
 import pkg_resources
 
+from merger.clean.libraries.remote_cache import get_remote_cache
+from merger.clean.libraries.lightcurves import RaggedLightcurves
+from merger.clean.libraries.correspondance_index import CorrespondanceIndex, correspondance_index_path, SOURCE_STAT_FILE
+from merger.clean.libraries.star_ids import encode_macho_id, encode_macho_id_strings, macho_id_field, macho_id_tile, macho_id_seq, encode_eros_id, decode_eros_id, sample_stars, hash_star_ids
+
+try:
+	import indexed_gzip as igzip
+except ImportError:
+	igzip = None
+
 COLOR_FILTERS = {
 	'red_E':{'mag':'red_E', 'err': 'rederr_E'},
 	'red_M':{'mag':'red_M', 'err': 'rederr_M'},
@@ -26,25 +47,258 @@ COLOR_FILTERS = {
 
 STAR_COUNT_PATH = pkg_resources.resource_filename('merger', 'utils/MACHOstarcounts')
 STARS_PER_JOBS = 5000
+STAR_COST_ROWS = 100	# Estimated cost of one star, in rows, for the 'cost' job partitioning
+MACHO_MANIFEST_DTYPE = [('tile', 'i4'), ('star_count', 'i4'), ('row_count', 'i8'), ('decompressed_size', 'i8'), ('first_star', 'i4'), ('last_star', 'i4')]
 OUTPUT_DIR_PATH = "/Volumes/DisqueSauvegarde/working_dir/"
 
+SENTINEL_MAGNITUDES = [99.999, -99.]	# Magnitudes of invalid measures
+ERROR_RANGE = (0., 9.999)		# Errors of valid measures are strictly inside
+EROS_BANDS = [('red_E', 'rederr_E'), ('blue_E', 'blueerr_E')]
+MACHO_BANDS = [('red_M', 'rederr_M'), ('blue_M', 'blueerr_M')]
+IRODS_ROOT = '/eros/data/eros2/lightcurves/lm/'
+IRODS_WORKERS = 8		# Number of iRods objects read at once
+IRODS_TIMEOUT = 30		# Seconds before an iRods read is considered failed
+IRODS_RETRIES = 3		# Number of new tries of a failed iRods read
+IRODS_BACKOFF = 1.		# Seconds before the first retry, doubled at each retry
+IRODS_HEDGE_AFTER = 3.	# Seconds before a slow iRods read is issued a second time
+EROS_COLUMNS = ['time', 'red_E', 'rederr_E', 'blue_E', 'blueerr_E']	# Columns of the EROS .time files
+EROS_HEADER_LINES = 4
+EROS_TIME_OFFSET = 49999.5		# Added to EROS times to get MJD
+EROS_FILES_CHUNK = 1000		# .time files read by a worker of load_eros_files at once
+EROS_INDEX_SPACING = 1024 * 1024	# Decompressed bytes between two gzip access checkpoints of an EROS archive index
+EROS_MEMBERS_DTYPE = [('id_E', 'i8'), ('offset', 'i8'), ('size', 'i8')]
+MACHO_BLOCK_SIZE = 16 * 1024 * 1024		# Bytes of decompressed text decoded at once
+# Fields of a line of MACHO tile : name -> (index in the ';'-separated line, dtype)
+MACHO_SCHEMA = {
+	'field': (1, 'i8'),
+	'tile': (2, 'i8'),
+	'seq': (3, 'i8'),
+	'time': (4, 'f8'),
+	'observation_id': (5, 'i8'),
+	'airmass': (8, 'f8'),
+	'red_M': (9, 'f8'),
+	'rederr_M': (10, 'f8'),
+	'red_normsky': (11, 'f8'),
+	'red_type': (12, 'f8'),
+	'red_crowd': (13, 'f8'),
+	'red_chi2': (14, 'f8'),
+	'red_amp': (17, 'f8'),
+	'red_avesky': (20, 'f8'),
+	'red_fwhm': (21, 'f8'),
+	'blue_M': (24, 'f8'),
+	'blueerr_M': (25, 'f8'),
+	'blue_normsky': (26, 'f8'),
+	'blue_type': (27, 'f8'),
+	'blue_crowd': (28, 'f8'),
+	'blue_chi2': (29, 'f8'),
+	'blue_amp': (32, 'f8'),
+	'blue_avesky': (35, 'f8'),
+	'blue_fwhm': (36, 'f8'),
+}
+MACHO_ID_COLUMNS = ['field', 'tile', 'seq']		# Always decoded, to build id_M
+MACHO_COLUMNS = ['time', 'red_M', 'rederr_M', 'blue_M', 'blueerr_M']	# Default columns of the MACHO loaders
+MACHO_STORED_COLUMNS = [name for name in MACHO_SCHEMA if name not in MACHO_ID_COLUMNS]	# Columns of the converted MACHO tiles
+COLUMNAR_SUFFIX = '.cols'		# Directory of a converted EROS archive or MACHO tile, next to the original file
+COLUMNAR_BLOCK_ROWS = 1024 * 1024	# Rows of a converted MACHO tile yielded at once
+PIPELINE_DEPTH = 4		# Blocks decompressed in advance by the reading thread of the pipelined loaders
+MACHO_URL = 'http://macho.nci.org.au/macho_photometry/'
+MACHO_URL_WORKERS = 4	# Number of tiles downloaded at once
+MACHO_URL_TIMEOUT = 60	# Seconds
+MACHO_INDEX_SPACING = 4 * 1024 * 1024	# Decompressed bytes between two gzip access checkpoints of a tile index
+OUT_OF_CORE_PARTITIONS = 64		# Star partitions of an out-of-core merge, each one merged and written at once
+OUT_OF_CORE_MEMORY_LIMIT = '4GB'	# Memory limit of each worker of the local dask cluster of an out-of-core merge
+MACHO_BAD_TIMES_BANDS = {'red_M': 'red', 'blue_M': 'blue'}	# Color of the bad timestamp files of each MACHO band (see bad_timestamp_filter)
+
+
+class RowFilter:
+	"""
+	Predicates applied by the loaders on the rows of lightcurves, before dataframes are built.
+
+	A measure in a band is invalid if its magnitude is a sentinel (SENTINEL_MAGNITUDES), if its error is not strictly inside error_range,
+	or if its time is a bad epoch of the band. Invalid measures are replaced by NaN, and rows without any valid measure are dropped.
+	With a sample_fraction, only a deterministic subsample of the stars is kept (see star_ids.sample_stars) ; loaders knowing
+	the identifiers of their stars before decoding them (see keep_stars) only decode the sampled ones.
 
-def load_irods_eros_lightcurves(irods_filepath="", idE_list=[]):
+	Parameters
+	----------
+	time_range : tuple(float, float)
+		Only rows with time_range[0] <= time <= time_range[1] are kept, default : None (all times)
+	valid_mag : bool
+		Check the magnitudes and errors, default : True
+	error_range : tuple(float, float)
+		default : ERROR_RANGE
+	bad_times : dict
+		Bad epochs (np.ndarray of times) of some bands, by magnitude column name (for example {'red_M': ..., 'blue_M': ...}), default : None
+	sample_fraction : float
+		Fraction of the stars to keep, default : None (all)
+	seed : int
+		Seed of the star sample, default : 0
 	"""
-	Load EROS lightcurves from iRods storage.
+	def __init__(self, time_range=None, valid_mag=True, error_range=ERROR_RANGE, bad_times=None, sample_fraction=None, seed=0):
+		self.time_range = time_range
+		self.valid_mag = valid_mag
+		self.error_range = error_range
+		self.bad_times = bad_times if bad_times is not None else {}
+		self.sample_fraction = sample_fraction
+		self.seed = seed
+
+	def sampled(self, sample_fraction, seed=0):
+		"""Copy of the filter with another star sample (None to keep all the stars)"""
+		row_filter = copy.copy(self)
+		row_filter.sample_fraction = sample_fraction
+		row_filter.seed = seed
+		return row_filter
+
+	def description(self):
+		"""
+		Parameters of the filter, JSON serializable, the bad epochs being replaced by a checksum (see merge_manifest)
+
+		Returns
+		-------
+		dict
+		"""
+		return {
+			'time_range': [float(t) for t in self.time_range] if self.time_range is not None else None,
+			'valid_mag': bool(self.valid_mag),
+			'error_range': [float(e) for e in self.error_range],
+			'bad_times': {mag: hashlib.sha256(np.sort(np.asarray(times, dtype='f8')).tobytes()).hexdigest() for mag, times in sorted(self.bad_times.items())},
+			'sample_fraction': float(self.sample_fraction) if self.sample_fraction is not None else None,
+			'seed': int(self.seed),
+		}
+
+	def keep_stars(self, ids):
+		"""
+		Stars of the sample
+
+		Parameters
+		----------
+		ids : int or np.ndarray
+			Integer EROS or MACHO identifiers
+
+		Returns
+		-------
+		np.ndarray(bool)
+		"""
+		if self.sample_fraction is None:
+			return np.ones(np.shape(np.atleast_1d(ids)), dtype=bool)
+		return sample_stars(ids, self.sample_fraction, self.seed)
+
+	def apply(self, cols, bands):
+		"""
+		Filter rows
+
+		Parameters
+		----------
+		cols : dict
+			Numpy arrays of the same length, by column name
+		bands : list(tuple(str, str))
+			Magnitude and error columns of each band (MACHO_BANDS or EROS_BANDS)
+
+		Returns
+		-------
+		dict
+		"""
+		if 'time' not in cols:
+			raise ValueError("Rows can't be filtered without their time.")
+		keep = np.ones(len(cols['time']), dtype=bool)
+		if self.sample_fraction is not None:
+			keep &= self.keep_stars(cols['id_E'] if 'id_E' in cols else encode_macho_id(cols['field'], cols['tile'], cols['seq']))
+		if self.time_range is not None:
+			keep &= (cols['time'] >= self.time_range[0]) & (cols['time'] <= self.time_range[1])
+		bands = [(mag, err) for mag, err in bands if mag in cols]
+		if bands and (self.valid_mag or self.bad_times):
+			any_valid = np.zeros(len(keep), dtype=bool)
+			for mag, err in bands:
+				valid = np.ones(len(keep), dtype=bool)
+				if self.valid_mag:
+					valid &= ~np.isin(cols[mag], SENTINEL_MAGNITUDES) & ~np.isnan(cols[mag])
+					if err in cols:
+						valid &= (cols[err] > self.error_range[0]) & (cols[err] < self.error_range[1])
+				if mag in self.bad_times:
+					valid &= ~np.isin(cols['time'], self.bad_times[mag])
+				if not valid.all():
+					cols[mag] = np.where(valid, cols[mag], np.nan)
+					if err in cols:
+						cols[err] = np.where(valid, cols[err], np.nan)
+				any_valid |= valid
+			keep &= any_valid
+		if keep.all():
+			return cols
+		return {name: value[keep] for name, value in cols.items()}
+
+
+def macho_bad_times_paths(bad_times_path, MACHO_field):
+	"""
+	Bad timestamp files of a MACHO field, written by bad_timestamp_filter.MACHO_get_bad_timestamps
+
+	Returns
+	-------
+	dict
+		Path of the <field>_<color>_bad_timestamps.npy file, by magnitude column
+	"""
+	return {mag: os.path.join(bad_times_path, f"{MACHO_field}_{color}_bad_timestamps.npy") for mag, color in MACHO_BAD_TIMES_BANDS.items()}
+
+
+def load_macho_bad_times(bad_times_path, MACHO_field):
+	"""
+	Bad epochs of a MACHO field, to filter its rows (see RowFilter)
+
+	The files hold (amp, time) pairs, an epoch is considered bad for every amp of the band.
 
-	Load from individual .time files. I didn't check the time taken but I think it can be significantly longer than for other load methods.
 	Parameters
 	----------
-	irods_filepath : str
-		Path in the iRods directory containing the .time files (lm/lmXXX/lmXXXX/lmXXXXL) (if loading a full CCD quarter)
-	idE_list : list(str)
-		List of EROS identifiers (lmXXXXLY....). Load only those stars
+	bad_times_path : str
+		Directory of the bad timestamp files
+	MACHO_field : int
 
 	Returns
 	-------
-	pd.DataFrame
-		Dataframe of the lightcurves (contains time, magnitudes and errors
+	dict
+		Bad times, by magnitude column. Bands without a file are left out.
+	"""
+	bad_times = {}
+	for mag, path in macho_bad_times_paths(bad_times_path, MACHO_field).items():
+		if not os.path.isfile(path):
+			logging.warning(f"No bad timestamps file {path}.")
+			continue
+		bad_times[mag] = np.unique(np.load(path).reshape(-1, 2)[:, 1])
+	return bad_times
+
+
+def filter_blocks(blocks, row_filter, bands):
+	"""
+	Apply a RowFilter on blocks of rows, skipping the blocks left empty
+
+	Parameters
+	----------
+	blocks : iterable(dict)
+	row_filter : RowFilter
+		None to keep all the rows
+	bands : list(tuple(str, str))
+
+	Yields
+	------
+	dict
+	"""
+	for cols in blocks:
+		if row_filter is not None:
+			cols = row_filter.apply(cols, bands)
+		if len(cols['time']):
+			yield cols
+
+
+def irods_session(timeout=IRODS_TIMEOUT):
+	"""
+	Open an iRods session from the environment file ($IRODS_ENVIRONMENT_FILE or ~/.irods/irods_environment.json)
+
+	Parameters
+	----------
+	timeout : float
+		Connection timeout of the session, in seconds
+
+	Returns
+	-------
+	iRODSSession
 	"""
 	try:
 		env_file = os.environ['IRODS_ENVIRONMENT_FILE']
@@ -53,57 +307,300 @@ def load_irods_eros_lightcurves(irods_filepath="", idE_list=[]):
 
 	ssl_context = ssl.create_default_context(purpose=ssl.Purpose.SERVER_AUTH, cafile=None, capath=None, cadata=None)
 	ssl_settings = {'ssl_context': ssl_context}
-	pds = []
-	with iRODSSession(irods_env_file=env_file, **ssl_settings) as session:
+	session = iRODSSession(irods_env_file=env_file, **ssl_settings)
+	session.connection_timeout = timeout
+	return session
+
+
+class IrodsSessionPool:
+	"""
+	iRods sessions shared by the threads of fetch_irods_objects, opened when needed.
+
+	A session which raised an error is closed and not reused.
+
+	Parameters
+	----------
+	session_factory : function
+		Called without argument to open a new session (see irods_session)
+	"""
+	def __init__(self, session_factory):
+		self.session_factory = session_factory
+		self.idle = queue.LifoQueue()
+		self.opened = []
+		self.lock = threading.Lock()
+
+	@contextmanager
+	def session(self):
+		try:
+			session = self.idle.get_nowait()
+		except queue.Empty:
+			session = self.session_factory()
+			with self.lock:
+				self.opened.append(session)
+		try:
+			yield session
+		except DataObjectDoesNotExist:
+			self.idle.put(session)
+			raise
+		except Exception:
+			with self.lock:
+				self.opened.remove(session)
+			session.cleanup()
+			raise
+		self.idle.put(session)
+
+	def close(self):
+		with self.lock:
+			for session in self.opened:
+				session.cleanup()
+			self.opened = []
+
+
+def read_irods_object(pool, path, cache=None):
+	"""
+	Read the whole content of an iRods data object
+
+	Parameters
+	----------
+	pool : IrodsSessionPool
+	path : str
+	cache : RemoteCache
+		If given, the object is read from it when its size and modification time did not change, and added to it otherwise
+
+	Returns
+	-------
+	bytes
+	"""
+	with pool.session() as session:
+		obj = session.data_objects.get(path)
+		key = None
+		if cache is not None:
+			key = cache.key(path, obj.size, obj.modify_time)
+			data = cache.get(key)
+			if data is not None:
+				return data
+		with obj.open('r') as f:
+			data = f.read()
+	if key is not None:
+		cache.put(key, data)
+	return data
+
+
+def fetch_irods_objects(paths, session_factory=None, n_workers=IRODS_WORKERS, timeout=IRODS_TIMEOUT, retries=IRODS_RETRIES, backoff=IRODS_BACKOFF, hedge_after=IRODS_HEDGE_AFTER, cache_path=None):
+	"""
+	Read iRods data objects concurrently.
+
+	At most n_workers objects are read at once, each thread using a session of a shared pool.
+	A read taking more than hedge_after seconds is issued a second time, the first answer being kept.
+	A read failing or taking more than timeout seconds is retried up to "retries" times, waiting backoff seconds, then 2 * backoff, ...
+	Objects that still can't be read are logged and left out, the other ones are kept.
+
+	Parameters
+	----------
+	paths : list(str)
+	session_factory : function
+		Called without argument to open a new session, default : irods_session
+	n_workers : int
+	timeout : float
+	retries : int
+	backoff : float
+	hedge_after : float
+	cache_path : str
+		Directory of the local cache of remote files (see remote_cache), default : None (MERGER_REMOTE_CACHE environment variable, no cache if unset). '' to disable the cache.
+
+	Returns
+	-------
+	dict
+		Content (bytes) of the objects read, by path
+	"""
+	if session_factory is None:
+		session_factory = irods_session
+	pool = IrodsSessionPool(session_factory)
+	cache = get_remote_cache(cache_path)
+	results = {}
+	attempts = dict.fromkeys(paths, 0)
+	waiting = deque(attempts)
+	pending_retries = []	# (time of the retry, path)
+	running = {}		# future : path
+	started = {}		# path : start time of its current attempt
+	hedged = set()
+	poll = min(timeout, hedge_after) / 4
+
+	def forget(path):
+		started.pop(path, None)
+		hedged.discard(path)
+		pending_retries[:] = [retry for retry in pending_retries if retry[1] != path]
+		if path in waiting:
+			waiting.remove(path)
+
+	def fail(path, error):
+		del started[path]
+		hedged.discard(path)
+		if attempts[path] <= retries:
+			logging.warning(f"iRods read of {path} failed ({error!r}), retry {attempts[path]}/{retries}.")
+			pending_retries.append((time.monotonic() + backoff * 2 ** (attempts[path] - 1), path))
+		else:
+			logging.error(f"iRods read of {path} failed ({error!r}), giving up.")
+
+	executor = ThreadPoolExecutor(max_workers=2 * n_workers)
+	try:
+		while waiting or pending_retries or started:
+			now = time.monotonic()
+			for retry in [retry for retry in pending_retries if retry[0] <= now]:
+				pending_retries.remove(retry)
+				waiting.append(retry[1])
+			while waiting and len(started) < n_workers:
+				path = waiting.popleft()
+				attempts[path] += 1
+				started[path] = now
+				running[executor.submit(read_irods_object, pool, path, cache)] = path
+			if not running:
+				time.sleep(max(min(retry[0] for retry in pending_retries) - now, 0))
+				continue
+
+			done, _ = wait(running, timeout=poll, return_when=FIRST_COMPLETED)
+			for future in done:
+				path = running.pop(future)
+				if path in results:
+					continue
+				try:
+					results[path] = future.result()
+				except DataObjectDoesNotExist:
+					logging.error(f"iRods file not found : {path}")
+					forget(path)
+				except Exception as e:
+					# Failure of an attempt still followed by another one (hedged or abandoned) is ignored
+					if path in started and path not in running.values():
+						fail(path, e)
+				else:
+					forget(path)
+
+			now = time.monotonic()
+			for path, start in list(started.items()):
+				if now - start > timeout:
+					fail(path, TimeoutError(f"{timeout} seconds"))
+				elif now - start > hedge_after and path not in hedged:
+					logging.info(f"Slow iRods read of {path}, issuing it again.")
+					hedged.add(path)
+					running[executor.submit(read_irods_object, pool, path, cache)] = path
+	finally:
+		# Do not wait for abandoned reads
+		executor.shutdown(wait=False, cancel_futures=True)
+		pool.close()
+	return results
+
+
+def load_irods_eros_lightcurves(irods_filepath="", idE_list=[], n_workers=IRODS_WORKERS, session_factory=None, cache_path=None, row_filter=None):
+	"""
+	Load EROS lightcurves from iRods storage.
+
+	Load from individual .time files, read concurrently (see fetch_irods_objects).
+	Parameters
+	----------
+	irods_filepath : str
+		Path in the iRods directory containing the .time files (lm/lmXXX/lmXXXX/lmXXXXL) (if loading a full CCD quarter)
+	idE_list : list(str) or list(int)
+		List of EROS identifiers (lmXXXXLY.... or their integer encoding). Load only those stars
+	n_workers : int
+		Number of .time files read at once, default : IRODS_WORKERS
+	session_factory : function
+		Called without argument to open a new iRods session, default : irods_session
+	cache_path : str
+		Directory of the local cache of remote files (see remote_cache), default : None (MERGER_REMOTE_CACHE environment variable, no cache if unset). '' to disable the cache.
+	row_filter : RowFilter
+		Rows to keep, default : None (all)
+
+	Returns
+	-------
+	pd.DataFrame
+		Dataframe of the lightcurves (contains time, magnitudes and errors
+	"""
+	if session_factory is None:
+		session_factory = irods_session
+	paths = []
+	if irods_filepath != "":
+		session = session_factory()
 		try:
 			coll = session.collections.get(irods_filepath)
+			paths = [os.path.join(irods_filepath, lcfile.name) for lcfile in coll.data_objects if lcfile.name[-4:]=='time']
 		except CollectionDoesNotExist:
 			logging.error(f"iRods path not found : {irods_filepath}")
-		if irods_filepath != "":
-			for lcfile in coll.data_objects:
-				id_E = lcfile.name
-				if id_E[-4:]=='time':
-					with lcfile.open('r') as f:
-						lc = {'time':[], 'red_E':[], 'rederr_E':[], 'blue_E':[], 'blueerr_E':[], 'id_E':[]}
-						for line in f.readlines()[4:]:
-							line = line.decode().split()
-							lc["time"].append(float(line[0])+49999.5)
-							lc["red_E"].append(float(line[1]))
-							lc["rederr_E"].append(float(line[2]))
-							lc["blue_E"].append(float(line[3]))
-							lc["blueerr_E"].append(float(line[4]))
-							lc["id_E"].append(id_E[:-5])
-					pds.append(pd.DataFrame.from_dict(lc))
-		elif len(idE_list) != 0:
-			IRODS_ROOT = '/eros/data/eros2/lightcurves/lm/'
-			times = []
-			for id_E in idE_list:
-				logging.info(str(id_E))
-				irods_filepath= os.path.join(IRODS_ROOT, id_E[:5], id_E[:6], id_E[:7], id_E + ".time")
-				if irods_filepath[-4:] == 'time':
-					st2 = time.time()
-					try:
-						obj = session.data_objects.get(irods_filepath)
-					except DataObjectDoesNotExist:
-						logging.error(f"iRods file not found : {irods_filepath}")
-					with obj.open('r') as f:
-						lc = {'time': [], 'red_E': [], 'rederr_E': [], 'blue_E': [], 'blueerr_E': [], 'id_E': []}
-						for line in f.readlines()[4:]:
-							line = line.decode().split()
-							lc["time"].append(float(line[0]) + 49999.5)
-							lc["red_E"].append(float(line[1]))
-							lc["rederr_E"].append(float(line[2]))
-							lc["blue_E"].append(float(line[3]))
-							lc["blueerr_E"].append(float(line[4]))
-							lc["id_E"].append(id_E)
-					pds.append(pd.DataFrame.from_dict(lc))
-					logging.info(time.time() - st2)
-					times.append(time.time() - st2)
-					if (len(times)>10 and np.median(times[-10:]) >= 3) or times[-1]>=10.:
-						logging.warning(f"EROS loading take too much time. No time to waste.")
-						logging.warning(f"Restarting EROS loading session...")
-						return "RESTART"
-		return pd.concat(pds)
+		finally:
+			session.cleanup()
+	elif len(idE_list) != 0:
+		for id_E in idE_list:
+			if not isinstance(id_E, str):
+				id_E = decode_eros_id(id_E)
+			paths.append(os.path.join(IRODS_ROOT, id_E[:5], id_E[:6], id_E[:7], id_E + ".time"))
+	if row_filter is not None and row_filter.sample_fraction is not None and paths:
+		keep = row_filter.keep_stars(encode_eros_id([path.split('/')[-1][:-5] for path in paths]))
+		paths = [path for path, k in zip(paths, keep) if k]
+
+	st1 = time.time()
+	contents = fetch_irods_objects(paths, session_factory=session_factory, n_workers=n_workers, cache_path=cache_path)
+	logging.info(f"{time.time() - st1} seconds to read {len(contents)}/{len(paths)} iRods files.")
+	lightcurves = []
+	ids = []
+	for path in paths:
+		if path in contents:
+			lightcurves.append(parse_eros_time(contents[path]))
+			ids.append(encode_eros_id(path.split('/')[-1][:-5]))
+	return eros_lightcurves_to_frame(lightcurves, ids, row_filter=row_filter)
+
+
+def parse_eros_time(data):
+	"""
+	Decode the content of an EROS .time lightcurve file
+
+	Parameters
+	----------
+	data : bytes
+
+	Returns
+	-------
+	np.ndarray
+		(number of epochs, 5) array of the EROS_COLUMNS, time offset by EROS_TIME_OFFSET
+
+	Raises
+	------
+	ValueError
+		If the rows don't have one value per EROS_COLUMNS
+	"""
+	body = data.split(b'\n', EROS_HEADER_LINES)
+	if len(body) <= EROS_HEADER_LINES or not body[-1].strip():
+		return np.empty((0, len(EROS_COLUMNS)))
+	# loadtxt raises a ValueError if the number of values changes from one row to another
+	values = np.loadtxt(io.BytesIO(body[-1]), dtype='f8', ndmin=2)
+	if values.shape[1] != len(EROS_COLUMNS):
+		raise ValueError(f"EROS lightcurve with rows of {values.shape[1]} columns instead of {len(EROS_COLUMNS)}.")
+	values[:, 0] += EROS_TIME_OFFSET
+	return values
+
+
+def eros_lightcurves_to_frame(lightcurves, ids, row_filter=None):
+	"""
+	Concatenate EROS lightcurves into a dataframe
+
+	Parameters
+	----------
+	lightcurves : list(np.ndarray)
+		Decoded .time files (see parse_eros_time)
+	ids : list(int)
+		EROS identifier of each lightcurve (see star_ids.encode_eros_id)
+	row_filter : RowFilter
+		Rows to keep, default : None (all)
+
+	Returns
+	-------
+	pd.DataFrame
+		EROS_COLUMNS and id_E
+	"""
+	values = np.concatenate(lightcurves) if lightcurves else np.empty((0, len(EROS_COLUMNS)))
+	lc = {name: values[:, i] for i, name in enumerate(EROS_COLUMNS)}
+	lc["id_E"] = np.repeat(np.asarray(ids, dtype='i8'), [len(lightcurve) for lightcurve in lightcurves])
+	if row_filter is not None:
+		lc = row_filter.apply(lc, EROS_BANDS)
+	return pd.DataFrame(lc)
 
 
 def read_eros_lighcurve(filepath):
@@ -118,48 +615,94 @@ def read_eros_lighcurve(filepath):
 		pandas DataFrame -- dataframe containing the EROS id, time of observation, magnitudes in blue and red and associated errors.
 	"""
 	try:
-		with open(filepath) as f:
-			for _ in range(4): f.readline()
-			lc = {"time":[], "red_E":[], "rederr_E":[], "blue_E":[], "blueerr_E":[], "id_E":[]}
-			id_E = filepath.split('/')[-1][:-5]
-			for line in f.readlines():
-				line = line.split()
-				lc["time"].append(float(line[0])+49999.5)
-				lc["red_E"].append(float(line[1]))
-				lc["rederr_E"].append(float(line[2]))
-				lc["blue_E"].append(float(line[3]))
-				lc["blueerr_E"].append(float(line[4]))
-				lc["id_E"].append(id_E)
-			f.close()
+		with open(filepath, 'rb') as f:
+			values = parse_eros_time(f.read())
 	except FileNotFoundError:
 		logging.error(f"{filepath} doesn't exist.")
 		return None
-	return pd.DataFrame.from_dict(lc)
+	return eros_lightcurves_to_frame([values], [encode_eros_id(filepath.split('/')[-1][:-5])])
+
+
+def scan_eros_files(eros_path):
+	"""
+	Find the EROS lightcurve files (lm*.time) in a directory and its subdirectories
+
+	Parameters
+	----------
+	eros_path : str
 
+	Returns
+	-------
+	list(str)
+		Sorted paths of the .time files
+	"""
+	paths = []
+	directories = [eros_path]
+	while directories:
+		with os.scandir(directories.pop()) as it:
+			for entry in it:
+				if entry.is_dir():
+					directories.append(entry.path)
+				elif entry.name[-4:] == "time":
+					paths.append(entry.path)
+	return sorted(paths)
+
+
+def read_eros_files(paths):
+	"""
+	Read EROS lightcurve files
 
-def load_eros_files(eros_path):
+	Parameters
+	----------
+	paths : list(str)
+
+	Returns
+	-------
+	tuple(np.ndarray, np.ndarray, np.ndarray)
+		Rows of all the lightcurves (see parse_eros_time), EROS identifier and number of rows of each lightcurve
+	"""
+	lightcurves = []
+	for path in paths:
+		with open(path, 'rb') as f:
+			lightcurves.append(parse_eros_time(f.read()))
+	values = np.concatenate(lightcurves) if lightcurves else np.empty((0, len(EROS_COLUMNS)))
+	return values, encode_eros_id([path.split('/')[-1][:-5] for path in paths]), np.array([len(lightcurve) for lightcurve in lightcurves], dtype='i8')
+
+
+def load_eros_files(eros_path, n_workers=1, chunk_size=EROS_FILES_CHUNK, row_filter=None):
 	"""[summary]
 
-	[description]
+	The .time files are found with scan_eros_files, and read by chunks of chunk_size files in a process pool.
 
 	Arguments:
 		eros_path {str} -- ideally path to an EROS CCD, but can be just a 1/4 or a whole field (not recommended as it uses a lot of memory).
 
+	Keyword Arguments:
+		n_workers {int} -- number of processes reading files (default: {1})
+		chunk_size {int} -- number of files read by a process at once (default: {EROS_FILES_CHUNK})
+		row_filter {RowFilter} -- rows to keep (default: {None}, all)
+
 	Returns:
 		pandas DataFrame -- dataframe containing all the lightcurves in the subdirectories of eros_path
 	"""
-	pds = []
-	for root, subdirs, files in os.walk(eros_path):
-		print(subdirs)
-		c=0
-		for filename in files:
-			if filename[-4:]=="time":
-				print(c, end='\r')
-				c+=1
-				#print(os.path.join(root, filename))
-				pds.append(read_eros_lighcurve(os.path.join(root, filename)))
-		print(c)
-	return pd.concat(pds)
+	paths = scan_eros_files(eros_path)
+	logging.info(f"{len(paths)} EROS files in {eros_path}")
+	if row_filter is not None and row_filter.sample_fraction is not None and paths:
+		keep = row_filter.keep_stars(encode_eros_id([path.split('/')[-1][:-5] for path in paths]))
+		paths = [path for path, k in zip(paths, keep) if k]
+	chunks = list(parallel_map(read_eros_files, [(paths[i:i+chunk_size],) for i in range(0, len(paths), chunk_size)], n_workers=n_workers))
+	nb_rows = sum(len(values) for values, ids, counts in chunks)
+	lc = {name: np.empty(nb_rows) for name in EROS_COLUMNS}
+	lc["id_E"] = np.empty(nb_rows, dtype='i8')
+	row = 0
+	for values, ids, counts in chunks:
+		for i, name in enumerate(EROS_COLUMNS):
+			lc[name][row:row+len(values)] = values[:, i]
+		lc["id_E"][row:row+len(values)] = np.repeat(ids, counts)
+		row += len(values)
+	if row_filter is not None:
+		lc = row_filter.apply(lc, EROS_BANDS)
+	return pd.DataFrame(lc)
 
 
 def read_compressed_eros_lightcurve(lc, exfile, name):
@@ -168,22 +711,124 @@ def read_compressed_eros_lightcurve(lc, exfile, name):
 	[description]
 
 	Arguments:
-		lc {dict} -- dictionnary containing the data of the current EROS 1/4 CCD
+		lc {dict} -- lists "lightcurves" (see parse_eros_time) and "id_E" of the current EROS 1/4 CCD
 		exfile {file} -- lightcurve file
 		name {str} -- lightcurve EROS identifier
 	"""
-	id_E = name.split("/")[-1][:-5]
-	for line in exfile.readlines()[4:]:
-		line = line.split()
-		lc["time"].append(float(line[0])+49999.5)
-		lc["red_E"].append(float(line[1]))
-		lc["rederr_E"].append(float(line[2]))
-		lc["blue_E"].append(float(line[3]))
-		lc["blueerr_E"].append(float(line[4]))
-		lc["id_E"].append(id_E)
+	lc["lightcurves"].append(parse_eros_time(exfile.read()))
+	lc["id_E"].append(encode_eros_id(name.split("/")[-1][:-5]))
+
+
+def iter_tar_members(filepath):
+	"""
+	Read the files of a tar.gz archive
+
+	Parameters
+	----------
+	filepath : str
+
+	Yields
+	------
+	tuple(str, bytes)
+		Name and content of each file of the archive
+	"""
+	with tarfile.open(filepath, 'r:gz') as f:
+		for member in f:
+			lcf = f.extractfile(member)
+			if lcf:
+				yield member.name, lcf.read()
+				lcf.close()
+
+
+def eros_index_paths(filepath):
+	"""
+	Paths of the sidecar index files of an EROS tar.gz archive.
+
+	Returns
+	-------
+	tuple(str, str)
+		gzip access checkpoints file and members file
+	"""
+	return filepath + ".gzidx", filepath + ".members.npy"
+
+
+def build_eros_archive_index(filepath, spacing=EROS_INDEX_SPACING):
+	"""
+	Build the sidecar index (see is_current_sidecar) of an EROS tar.gz archive, to be able to extract some lightcurves without decompressing the whole archive.
 
+	The index is made of the gzip access checkpoints (one every "spacing" bytes of decompressed data)
+	and, for each lightcurve, its EROS identifier, the decompressed offset of its data and its size (EROS_MEMBERS_DTYPE).
+
+	Parameters
+	----------
+	filepath : str
+	spacing : int
+		Number of decompressed bytes between two gzip checkpoints
 
-def load_eros_compressed_files(filepath):
+	Returns
+	-------
+	np.ndarray
+		Members of the archive
+	"""
+	if igzip is None:
+		logging.error("indexed_gzip is not installed, can't index EROS archives.")
+		return None
+	gzidx_path, members_path = eros_index_paths(filepath)
+	stat = source_stat(filepath)
+	members = []
+	with igzip.IndexedGzipFile(filepath, spacing=spacing) as f:
+		with tarfile.open(fileobj=f, mode='r:') as tar:
+			for member in tar:
+				if member.isfile():
+					members.append((encode_eros_id(member.name.split("/")[-1][:-5]), member.offset_data, member.size))
+		f.build_full_index()
+		f.export_index(gzidx_path)
+	members = np.array(members, dtype=EROS_MEMBERS_DTYPE)
+	np.save(members_path, members)
+	np.save(source_stat_path(filepath), stat)
+	return members
+
+
+def load_eros_archive_index(filepath):
+	"""
+	Load the members of an EROS archive index.
+
+	Returns
+	-------
+	np.ndarray or None
+		Members of the archive (EROS_MEMBERS_DTYPE), None if the archive is not indexed, if its index is out of date or if indexed_gzip is not installed
+	"""
+	gzidx_path, members_path = eros_index_paths(filepath)
+	if igzip is None or not (os.path.isfile(gzidx_path) and os.path.isfile(members_path)):
+		return None
+	if not is_current_sidecar(source_stat_path(filepath), filepath):
+		return None
+	return np.load(members_path)
+
+
+def iter_indexed_tar_members(filepath, members):
+	"""
+	Read some files of an indexed EROS archive (see build_eros_archive_index)
+
+	Parameters
+	----------
+	filepath : str
+	members : np.ndarray
+		Members to read (EROS_MEMBERS_DTYPE)
+
+	Yields
+	------
+	tuple(np.int64, bytes)
+		EROS identifier and content of each member, in archive order
+	"""
+	gzidx_path, _ = eros_index_paths(filepath)
+	with igzip.IndexedGzipFile(filepath, index_file=gzidx_path) as f:
+		for member in np.sort(members, order='offset'):
+			f.seek(member['offset'])
+			yield member['id_E'], f.read(member['size'])
+
+
+def load_eros_compressed_files(filepath, pipeline=False, idE_list=None, use_index=True, row_filter=None):
 	"""Load EROS lightcurves from compressed tar.gz archives
 
 	[description]
@@ -191,174 +836,1224 @@ def load_eros_compressed_files(filepath):
 	Arguments:
 		filepath {str} -- path to the file to open
 
+	Keyword Arguments:
+		pipeline {bool} -- decompress the archive in a separate thread, while lightcurves are decoded (default: {False})
+		idE_list {list} -- EROS identifiers (str or int) of the lightcurves to load, if the archive is indexed (see build_eros_archive_index)
+			only those are decompressed (default: {None}, all the lightcurves)
+		use_index {bool} -- use the archive index if it exists (default: {True})
+		row_filter {RowFilter} -- rows to keep (default: {None}, all). Lightcurves out of its star sample are not decoded,
+			nor decompressed if the archive is indexed.
+
+	If the archive was converted (see convert_eros_archive) and not replaced since, the lightcurves are read from the converted columns.
+
 	Returns:
 		[DataFrame] -- dataframe containing all the lightcurves of "filepath"
 	"""
-	with tarfile.open(filepath, 'r:gz') as f:
-		lc = {"time":[], "red_E":[], "rederr_E":[], "blue_E":[], "blueerr_E":[], "id_E":[]}
-		c = 0
-		for member in f.getmembers():
-			lcf = f.extractfile(member)
-			if lcf:
-				c+=1
-				print(c, end='\r')
-				read_compressed_eros_lightcurve(lc, lcf, member.name)
-				lcf.close()
-	return pd.DataFrame.from_dict(lc)
+	columnar_path = eros_columnar_path(filepath)
+	if is_current_columnar(columnar_path, filepath):
+		return read_eros_columnar(columnar_path, idE_list=idE_list, row_filter=row_filter)
+	lc = {"lightcurves":[], "id_E":[]}
+	wanted = None
+	sampled = row_filter is not None and row_filter.sample_fraction is not None
+	if idE_list is not None or sampled:
+		if idE_list is not None:
+			wanted = np.array([encode_eros_id(id_E) if isinstance(id_E, str) else id_E for id_E in idE_list], dtype='i8')
+		index = load_eros_archive_index(filepath) if use_index else None
+		if index is not None:
+			selected = np.isin(index['id_E'], wanted) if wanted is not None else np.ones(len(index), dtype=bool)
+			if sampled:
+				selected &= row_filter.keep_stars(index['id_E'])
+			members = iter_indexed_tar_members(filepath, index[selected])
+			if pipeline:
+				members = prefetch(members)
+			with closing(members):
+				for id_E, data in members:
+					lc["lightcurves"].append(parse_eros_time(data))
+					lc["id_E"].append(id_E)
+			return eros_lightcurves_to_frame(lc["lightcurves"], lc["id_E"], row_filter=row_filter)
+		if wanted is not None:
+			wanted = set(wanted.tolist())
+	members = iter_tar_members(filepath)
+	if pipeline:
+		members = prefetch(members)
+	with closing(members):
+		for name, data in members:
+			if wanted is None and not sampled:
+				read_compressed_eros_lightcurve(lc, io.BytesIO(data), name)
+				continue
+			id_E = encode_eros_id(name.split("/")[-1][:-5])
+			if (wanted is None or id_E in wanted) and (not sampled or row_filter.keep_stars(id_E)[0]):
+				read_compressed_eros_lightcurve(lc, io.BytesIO(data), name)
+	logging.debug(f"{len(lc['id_E'])} lightcurves read from {filepath}")
+	return eros_lightcurves_to_frame(lc["lightcurves"], lc["id_E"], row_filter=row_filter)
+
+
+def eros_archive_path(EROS_files_path, id_E):
+	"""
+	Path of the quarter archive (lmXXXXq-lc.tar.gz) containing an EROS star
+
+	Parameters
+	----------
+	EROS_files_path : str
+	id_E : str or int
+
+	Returns
+	-------
+	str
+	"""
+	if not isinstance(id_E, str):
+		id_E = decode_eros_id(id_E)
+	return os.path.join(EROS_files_path, id_E[:5], id_E[:7]+"-lc.tar.gz")
+
+
+def load_eros_stars(EROS_files_path, idE_list, n_workers=1, max_inflight=None, row_filter=None):
+	"""
+	Load some EROS lightcurves from the quarter archives of a local EROS mirror
+
+	The stars are grouped by archive, and only them are extracted from each archive (see load_eros_compressed_files).
+
+	Parameters
+	----------
+	EROS_files_path : str
+		Path to EROS archives (containing lmXXX directories)
+	idE_list : list(str) or list(int)
+		EROS identifiers of the stars to load
+	n_workers : int
+		Number of processes reading archives concurrently, default : 1
+	max_inflight : int
+		Maximum number of archives submitted to the pool at once, default : 2 * n_workers.
+		All the archives are concatenated at the end, the memory used is not bounded by it
+	row_filter : RowFilter
+		Rows to keep, default : None (all)
+
+	Returns
+	-------
+	pd.DataFrame
+	"""
+	ids = np.unique(np.array([encode_eros_id(id_E) if isinstance(id_E, str) else id_E for id_E in idE_list], dtype='i8'))
+	# Stars of the same archive share field, CCD and quarter, the highest bits of their identifiers
+	archives, inverse = np.unique(ids >> 36, return_inverse=True)
+	args_list = []
+	for i in range(len(archives)):
+		archive_ids = ids[inverse == i]
+		args_list.append((eros_archive_path(EROS_files_path, archive_ids[0]), False, archive_ids, True, row_filter))
+	pds = list(parallel_map(load_eros_compressed_files, args_list, n_workers=n_workers, max_inflight=max_inflight))
+	if not pds:
+		return eros_lightcurves_to_frame([], [])
+	return pd.concat(pds, ignore_index=True)
+
+
+def write_columnar(path, columns, ids, offsets, source_path=None):
+	"""
+	Write lightcurves as one .npy file per column, with the identifier and the first row of each star.
+
+	The directory is written under a temporary name, then renamed.
+
+	Parameters
+	----------
+	path : str
+		Directory to write
+	columns : dict
+		Numpy arrays of the rows, by column name
+	ids : np.ndarray
+		Identifier of each star
+	offsets : np.ndarray
+		First row of each star, and total number of rows as last value
+	source_path : str
+		Converted file, whose source_stat is recorded (see is_current_columnar), default : None
+	"""
+	tmp_path = path + '.part'
+	os.makedirs(tmp_path, exist_ok=True)
+	if source_path is not None:
+		np.save(os.path.join(tmp_path, 'source_stat.npy'), source_stat(source_path))
+	for name, values in columns.items():
+		np.save(os.path.join(tmp_path, name + '.npy'), values)
+	np.save(os.path.join(tmp_path, 'star_ids.npy'), np.asarray(ids, dtype='i8'))
+	np.save(os.path.join(tmp_path, 'star_offsets.npy'), np.asarray(offsets, dtype='i8'))
+	if os.path.isdir(path):
+		shutil.rmtree(path)
+	os.replace(tmp_path, path)
+
+
+def load_columnar(path, columns):
+	"""
+	Memory map lightcurves written by write_columnar
+
+	Parameters
+	----------
+	path : str
+	columns : list(str)
+
+	Returns
+	-------
+	tuple(np.ndarray, np.ndarray, dict)
+		Star identifiers, star offsets and memory mapped columns
+	"""
+	ids = np.load(os.path.join(path, 'star_ids.npy'))
+	offsets = np.load(os.path.join(path, 'star_offsets.npy'))
+	return ids, offsets, {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in columns}
+
+
+def is_current_columnar(path, source_path):
+	"""
+	Whether a file was converted (see write_columnar) and not replaced since, a warning being logged if it was replaced
+
+	Parameters
+	----------
+	path : str
+		Directory of the converted columns
+	source_path : str
+		Converted file
+
+	Returns
+	-------
+	bool
+	"""
+	return os.path.isdir(path) and is_current_sidecar(os.path.join(path, 'source_stat.npy'), source_path)
+
+
+def star_rows(offsets, stars):
+	"""
+	Rows of some stars
+
+	Parameters
+	----------
+	offsets : np.ndarray
+		First row of each star, and total number of rows as last value
+	stars : np.ndarray
+		Sorted indices of the stars
+
+	Returns
+	-------
+	np.ndarray
+	"""
+	counts = offsets[stars + 1] - offsets[stars]
+	return np.repeat(offsets[stars] - np.r_[0, np.cumsum(counts)[:-1]], counts) + np.arange(counts.sum())
+
+
+def eros_columnar_path(filepath):
+	"""Directory of the converted columns of an EROS archive (lmXXXXq-lc.tar.gz)"""
+	return filepath[:-len('.tar.gz')] + COLUMNAR_SUFFIX
+
+
+def convert_eros_archive(filepath):
+	"""
+	Convert an EROS archive into memory mappable columns (see write_columnar)
+
+	Parameters
+	----------
+	filepath : str
+		Path of the lmXXXXq-lc.tar.gz archive
+	"""
+	lc = {"lightcurves":[], "id_E":[]}
+	for name, data in iter_tar_members(filepath):
+		read_compressed_eros_lightcurve(lc, io.BytesIO(data), name)
+	values = np.concatenate(lc["lightcurves"]) if lc["lightcurves"] else np.empty((0, len(EROS_COLUMNS)))
+	offsets = np.r_[0, np.cumsum([len(lightcurve) for lightcurve in lc["lightcurves"]])]
+	write_columnar(eros_columnar_path(filepath), {name: values[:, i] for i, name in enumerate(EROS_COLUMNS)}, lc["id_E"], offsets, source_path=filepath)
+
+
+def read_eros_columnar(path, idE_list=None, row_filter=None):
+	"""
+	Read lightcurves of a converted EROS archive (see convert_eros_archive)
+
+	Parameters
+	----------
+	path : str
+	idE_list : list(str) or list(int)
+		EROS identifiers of the lightcurves to load, default : None (all)
+	row_filter : RowFilter
+		Rows to keep, default : None (all)
+
+	Returns
+	-------
+	pd.DataFrame
+	"""
+	ids, offsets, columns = load_columnar(path, EROS_COLUMNS)
+	sampled = row_filter is not None and row_filter.sample_fraction is not None
+	if idE_list is None and not sampled:
+		lc = {name: np.array(values) for name, values in columns.items()}
+		lc["id_E"] = np.repeat(ids, np.diff(offsets))
+	else:
+		selected = np.ones(len(ids), dtype=bool)
+		if idE_list is not None:
+			selected &= np.isin(ids, np.array([encode_eros_id(id_E) if isinstance(id_E, str) else id_E for id_E in idE_list], dtype='i8'))
+		if sampled:
+			selected &= row_filter.keep_stars(ids)
+		stars = np.flatnonzero(selected)
+		rows = star_rows(offsets, stars)
+		lc = {name: values[rows] for name, values in columns.items()}
+		lc["id_E"] = np.repeat(ids[stars], offsets[stars + 1] - offsets[stars])
+	if row_filter is not None:
+		lc = row_filter.apply(lc, EROS_BANDS)
+	return pd.DataFrame(lc)
+
+
+def macho_columnar_path(filepath, filename):
+	"""Directory of the converted columns of a MACHO tile (F_X.Y.gz)"""
+	return os.path.join(filepath, filename[:-len('.gz')] + COLUMNAR_SUFFIX)
+
+
+def convert_macho_tile(filepath, filename):
+	"""
+	Convert a MACHO tile into memory mappable columns (see write_columnar)
+
+	All the MACHO_STORED_COLUMNS are kept.
+
+	Parameters
+	----------
+	filepath : str
+	filename : str
+	"""
+	values = {name: [] for name in MACHO_STORED_COLUMNS + ['star_nb']}
+	ids = []
+	with gzip.open(os.path.join(filepath, filename), 'rb') as f:
+		for cols in iter_macho_stream_blocks(f, columns=MACHO_STORED_COLUMNS):
+			starts = np.r_[0, np.flatnonzero(cols['star_nb'][1:] != cols['star_nb'][:-1]) + 1]
+			ids.append(encode_macho_id(cols['field'][starts], cols['tile'][starts], cols['seq'][starts]))
+			for name in values:
+				values[name].append(cols[name])
+	columns = {name: np.concatenate(value) if value else np.array([], dtype=MACHO_SCHEMA[name][1]) for name, value in values.items() if name != 'star_nb'}
+	star_nb = np.concatenate(values['star_nb']) if values['star_nb'] else np.array([], dtype='i8')
+	offsets = np.r_[np.searchsorted(star_nb, np.arange(star_nb[-1] + 1 if len(star_nb) else 0)), len(star_nb)]
+	write_columnar(macho_columnar_path(filepath, filename), columns, np.concatenate(ids) if ids else [], offsets, source_path=os.path.join(filepath, filename))
+
+
+def iter_macho_columnar_blocks(path, star_nb_start=0, star_nb_stop=-1, columns=None, row_filter=None):
+	"""
+	Read a converted MACHO tile (see convert_macho_tile) by blocks of whole stars, as iter_macho_blocks.
+
+	Parameters
+	----------
+	path : str
+	star_nb_start : int
+	star_nb_stop : int
+	columns : list(str)
+		Names of MACHO_SCHEMA columns to decode, default : MACHO_COLUMNS
+	row_filter : RowFilter
+		Only the rows of the stars of its sample are read, default : None (all the stars). Its other predicates are not applied.
+
+	Yields
+	------
+	dict
+		Requested columns, 'field', 'tile', 'seq' and 'star_nb' (star number in the tile) as numpy arrays
+	"""
+	if columns is None:
+		columns = MACHO_COLUMNS
+	names = [name for name in columns if name not in MACHO_ID_COLUMNS]
+	ids, offsets, stored = load_columnar(path, names)
+	sample = row_filter.keep_stars(ids) if row_filter is not None and row_filter.sample_fraction is not None else None
+	stop = len(ids) if star_nb_stop < 0 else min(star_nb_stop + 1, len(ids))
+	start = min(star_nb_start, stop)
+	while start < stop:
+		end = max(min(np.searchsorted(offsets, offsets[start] + COLUMNAR_BLOCK_ROWS, side='right') - 1, stop), start + 1)
+		if sample is None:
+			stars = np.arange(start, end)
+			cols = {name: np.array(stored[name][offsets[start]:offsets[end]]) for name in names}
+		else:
+			stars = start + np.flatnonzero(sample[start:end])
+			rows = star_rows(offsets, stars)
+			cols = {name: stored[name][rows] for name in names}
+		counts = offsets[stars + 1] - offsets[stars]
+		cols['star_nb'] = np.repeat(stars, counts)
+		block_ids = np.repeat(ids[stars], counts)
+		cols['field'] = macho_id_field(block_ids).astype(MACHO_SCHEMA['field'][1])
+		cols['tile'] = macho_id_tile(block_ids).astype(MACHO_SCHEMA['tile'][1])
+		cols['seq'] = macho_id_seq(block_ids).astype(MACHO_SCHEMA['seq'][1])
+		yield cols
+		start = end
+
+
+def prefetch(iterable, depth=None):
+	"""
+	Iterate over iterable in a separate producer thread.
+
+	Items are passed through a queue of at most "depth" items, so that producing (for example reading and decompressing, as zlib
+	releases the GIL) overlaps with the processing of the previous items by the caller. Exceptions of the producer are raised in the caller.
+	Closing the returned generator stops the producer thread.
+
+	Parameters
+	----------
+	iterable : iterable
+	depth : int
+		Maximum number of produced items waiting to be consumed, default : PIPELINE_DEPTH
+
+	Yields
+	------
+	Items of iterable
+	"""
+	if depth is None:
+		depth = PIPELINE_DEPTH
+	items = queue.Queue(maxsize=depth)
+	stop = threading.Event()
+	end = object()
+
+	def put(item):
+		while not stop.is_set():
+			try:
+				items.put(item, timeout=0.1)
+				return True
+			except queue.Full:
+				pass
+		return False
+
+	def produce():
+		try:
+			for item in iterable:
+				if not put((item, None)):
+					return
+			put((end, None))
+		except BaseException as e:
+			put((end, e))
+
+	thread = threading.Thread(target=produce, daemon=True)
+	thread.start()
+	try:
+		while True:
+			item, error = items.get()
+			if item is end:
+				if error is not None:
+					raise error
+				return
+			yield item
+	finally:
+		stop.set()
+		thread.join()
+
+
+def iter_line_blocks(f, block_size=None, nbytes=None):
+	"""
+	Read a binary stream by blocks that always end on a line break.
+
+	Parameters
+	----------
+	f : file
+		Binary stream (for example opened with gzip.open(..., 'rb'))
+	block_size : int
+		Number of bytes read at once, default : MACHO_BLOCK_SIZE
+	nbytes : int
+		Stop after reading this number of bytes, default : None (goes to the end of stream)
+
+	Yields
+	------
+	bytes
+		Block of complete lines
+	"""
+	if block_size is None:
+		block_size = MACHO_BLOCK_SIZE
+	tail = b''
+	while nbytes is None or nbytes > 0:
+		buf = f.read(block_size if nbytes is None else min(block_size, nbytes))
+		if not buf:
+			break
+		if nbytes is not None:
+			nbytes -= len(buf)
+		if tail:
+			buf = tail + buf
+		cut = buf.rfind(b'\n') + 1
+		tail = buf[cut:]
+		if cut:
+			yield buf[:cut]
+	if tail.strip():
+		yield tail
+
+
+def parse_macho_block(block, columns=None):
+	"""
+	Decode a block of MACHO lines into numpy columns.
+
+	Only the requested columns of MACHO_SCHEMA (and the identifier columns) are converted.
+
+	Parameters
+	----------
+	block : bytes
+		Complete ';'-separated lines of a MACHO tile
+	columns : list(str)
+		Names of MACHO_SCHEMA columns to decode, default : MACHO_COLUMNS
+
+	Returns
+	-------
+	dict
+		Requested columns plus 'field', 'tile' and 'seq', as numpy arrays
+	"""
+	if columns is None:
+		columns = MACHO_COLUMNS
+	names = MACHO_ID_COLUMNS + [name for name in columns if name not in MACHO_ID_COLUMNS]
+	try:
+		fields = {MACHO_SCHEMA[name][0]: name for name in names}
+	except KeyError as e:
+		raise ValueError(f"Unknown MACHO column : {e}")
+	dtypes = {idx: MACHO_SCHEMA[name][1] for idx, name in fields.items()}
+	df = pd.read_csv(io.BytesIO(block), sep=';', header=None, usecols=list(fields), dtype=dtypes, engine='c')
+	return {name: df[idx].to_numpy() for idx, name in fields.items()}
+
+
+def source_stat(path):
+	"""Size and modification time of a file, recorded with the sidecar files built from it"""
+	stat = os.stat(path)
+	return np.array([stat.st_size, stat.st_mtime_ns], dtype='i8')
+
+
+def source_stat_path(path):
+	"""Path of the recorded source_stat of the sidecar index files of a file"""
+	return path + ".source.npy"
+
+
+def is_current_sidecar(stat_path, source_path):
+	"""
+	Whether sidecar files were built from the current version of their source file
+
+	Indexes and converted columns are written next to the file they are built from, and read by the loaders instead of parsing it.
+	They record the source_stat of that file when they are built, and are ignored once it is replaced :
+	sidecars without a recorded source_stat, or whose source changed since, are out of date and a warning is logged.
+	If the source file doesn't exist anymore, the sidecars are the only copy of its data, and are considered up to date.
+
+	Parameters
+	----------
+	stat_path : str
+		Path of the source_stat recorded when the sidecars were built
+	source_path : str
+
+	Returns
+	-------
+	bool
+	"""
+	try:
+		current = source_stat(source_path)
+	except FileNotFoundError:
+		return True
+	try:
+		recorded = np.load(stat_path)
+	except FileNotFoundError:
+		recorded = None
+	if recorded is None or not np.array_equal(recorded, current):
+		logging.warning(f"Sidecar files of {source_path} are out of date, they are not used. Build them again.")
+		return False
+	return True
+
+
+def macho_index_paths(filepath, filename):
+	"""
+	Paths of the sidecar index files of a MACHO tile.
+
+	Returns
+	-------
+	tuple(str, str)
+		gzip access checkpoints file and star offsets file
+	"""
+	path = os.path.join(filepath, filename)
+	return path + ".gzidx", path + ".stars.npy"
+
+
+def build_macho_tile_index(filepath, filename, spacing=MACHO_INDEX_SPACING):
+	"""
+	Build the sidecar index (see is_current_sidecar) of a MACHO tile, to be able to seek to any star without decompressing the tile from its beginning.
+
+	The index is made of the gzip access checkpoints (one every "spacing" bytes of decompressed data)
+	and the decompressed offset of the first row of each star (with the total decompressed size as last value).
+
+	Parameters
+	----------
+	filepath : str
+	filename : str
+	spacing : int
+		Number of decompressed bytes between two gzip checkpoints
+
+	Returns
+	-------
+	np.ndarray
+		Star offsets
+	"""
+	if igzip is None:
+		logging.error("indexed_gzip is not installed, can't index MACHO tiles.")
+		return None
+	gzidx_path, stars_path = macho_index_paths(filepath, filename)
+	stat = source_stat(os.path.join(filepath, filename))
+	offsets = []
+	position = 0
+	last_seq = None
+	with igzip.IndexedGzipFile(os.path.join(filepath, filename), spacing=spacing) as f:
+		for block in iter_line_blocks(f):
+			seq = parse_macho_block(block, columns=[])['seq']
+			chars = np.frombuffer(block, dtype=np.uint8)
+			line_starts = np.r_[0, np.flatnonzero(chars == ord('\n')) + 1]
+			line_starts = line_starts[line_starts < len(chars)]
+			# Blank lines are skipped by parse_macho_block, they don't start a row
+			line_starts = line_starts[chars[line_starts] != ord('\n')]
+			changes = np.r_[last_seq is None or seq[0] != last_seq, seq[1:] != seq[:-1]]
+			offsets.append(position + line_starts[changes])
+			position += len(block)
+			last_seq = seq[-1]
+		f.build_full_index()
+		f.export_index(gzidx_path)
+	offsets.append([position])
+	offsets = np.concatenate(offsets).astype('i8')
+	np.save(stars_path, offsets)
+	np.save(source_stat_path(os.path.join(filepath, filename)), stat)
+	return offsets
+
+
+def load_macho_tile_index(filepath, filename):
+	"""
+	Load the star offsets of a MACHO tile index.
+
+	Returns
+	-------
+	np.ndarray or None
+		Star offsets, None if the tile is not indexed, if its index is out of date or if indexed_gzip is not installed
+	"""
+	gzidx_path, stars_path = macho_index_paths(filepath, filename)
+	if igzip is None or not (os.path.isfile(gzidx_path) and os.path.isfile(stars_path)):
+		return None
+	if not is_current_sidecar(source_stat_path(os.path.join(filepath, filename)), os.path.join(filepath, filename)):
+		return None
+	return np.load(stars_path)
+
+
+def open_indexed_macho_tile(filepath, filename):
+	"""
+	Open a MACHO tile with its gzip access checkpoints (see build_macho_tile_index)
+
+	Returns
+	-------
+	indexed_gzip.IndexedGzipFile
+	"""
+	gzidx_path, _ = macho_index_paths(filepath, filename)
+	return igzip.IndexedGzipFile(os.path.join(filepath, filename), index_file=gzidx_path)
+
+
+def iter_macho_stream_blocks(f, star_nb_start=0, star_nb_stop=-1, nbytes=None, first_star_nb=0, columns=None, pipeline=False):
+	"""
+	Read a decompressed MACHO tile stream by blocks of whole stars (see iter_macho_blocks)
+
+	Parameters
+	----------
+	f : file
+		Binary stream of decompressed MACHO lines
+	star_nb_start : int
+	star_nb_stop : int
+	nbytes : int
+		Number of bytes to read from f, default : None (until the end of stream)
+	first_star_nb : int
+		Star number of the first row of the stream
+	columns : list(str)
+		Names of MACHO_SCHEMA columns to decode, default : MACHO_COLUMNS
+	pipeline : bool
+		Read (and decompress) f in a separate thread, while blocks are decoded, default : False
+
+	Yields
+	------
+	dict
+		Requested columns, 'field', 'tile', 'seq' and 'star_nb' (star number in the tile) as numpy arrays
+	"""
+	curr_star_nb = first_star_nb
+	last_seq = None
+	carry = None
+	blocks = iter_line_blocks(f, nbytes=nbytes)
+	if pipeline:
+		blocks = prefetch(blocks)
+	with closing(blocks):
+		for block in blocks:
+			cols = parse_macho_block(block, columns=columns)
+			seq = cols['seq']
+			if not len(seq):
+				continue
+			# Star number of each row, counted from the beginning of the tile
+			changes = np.r_[last_seq is not None and seq[0] != last_seq, seq[1:] != seq[:-1]]
+			star_nb = curr_star_nb + np.cumsum(changes)
+			curr_star_nb = star_nb[-1]
+			last_seq = seq[-1]
+
+			if star_nb_stop >= 0 and star_nb[0] > star_nb_stop:
+				break
+			keep = star_nb >= star_nb_start
+			if star_nb_stop >= 0:
+				keep &= star_nb <= star_nb_stop
+			cols['star_nb'] = star_nb
+			cols = {name: value[keep] for name, value in cols.items()}
+			if carry is not None:
+				cols = {name: np.concatenate([carry[name], value]) for name, value in cols.items()}
+			if not len(cols['star_nb']):
+				continue
+			split = np.searchsorted(cols['star_nb'], cols['star_nb'][-1])
+			carry = {name: value[split:] for name, value in cols.items()}
+			if split:
+				yield {name: value[:split] for name, value in cols.items()}
+	if carry is not None:
+		yield carry
+
+
+def iter_macho_blocks(filepath, filename, star_nb_start=0, star_nb_stop=-1, use_index=True, columns=None, pipeline=False, row_filter=None):
+	"""
+	Read MACHO tile archive by blocks of whole stars.
+
+	The decompressed stream is read by blocks of MACHO_BLOCK_SIZE bytes, each block being decoded at once into columns.
+	Rows of the last star of a block are kept until the next block, so that a star is never split between two yielded blocks.
+	If the tile has an index (see build_macho_tile_index), reading starts directly at the first row of star_nb_start.
+	If the tile was converted (see convert_macho_tile) and not replaced since, blocks are read from the converted columns instead.
+
+	Parameters
+	----------
+	filepath : str
+	filename : str
+	star_nb_start : int
+		From which star to start saving value of file, default : 0 (from first line)
+	star_nb_stop : int
+		Star at which the program will stop reading the file (included), default : -1 (goes to the end of file)
+	use_index : bool
+		Use the tile index if it exists, default : True
+	columns : list(str)
+		Names of MACHO_SCHEMA columns to decode, default : MACHO_COLUMNS
+	pipeline : bool
+		Decompress the tile in a separate thread, while blocks are decoded, default : False
+	row_filter : RowFilter
+		Rows to keep, default : None (all)
+
+	Yields
+	------
+	dict
+		Requested columns, 'field', 'tile', 'seq' and 'star_nb' (star number in the tile) as numpy arrays
+	"""
+	columnar_path = macho_columnar_path(filepath, filename)
+	if is_current_columnar(columnar_path, os.path.join(filepath, filename)):
+		yield from filter_blocks(iter_macho_columnar_blocks(columnar_path, star_nb_start=star_nb_start, star_nb_stop=star_nb_stop, columns=columns, row_filter=row_filter), row_filter, MACHO_BANDS)
+		return
+	nbytes = None
+	first_star_nb = 0
+	offsets = load_macho_tile_index(filepath, filename) if use_index and (star_nb_start > 0 or star_nb_stop >= 0) else None
+	try:
+		if offsets is not None:
+			stop = len(offsets) - 1 if star_nb_stop < 0 else min(star_nb_stop + 1, len(offsets) - 1)
+			f = open_indexed_macho_tile(filepath, filename)
+			if star_nb_start < stop:
+				f.seek(offsets[star_nb_start])
+			first_star_nb = star_nb_start
+			nbytes = int(max(offsets[stop] - offsets[min(star_nb_start, stop)], 0))
+		else:
+			f = gzip.open(os.path.join(filepath, filename), 'rb')
+		with f:
+			yield from filter_blocks(iter_macho_stream_blocks(f, star_nb_start=star_nb_start, star_nb_stop=star_nb_stop, nbytes=nbytes, first_star_nb=first_star_nb, columns=columns, pipeline=pipeline), row_filter, MACHO_BANDS)
+	except FileNotFoundError:
+		logging.error(os.path.join(filepath, filename) + " doesn't exist.")
+
+
+def iter_macho_stars(filepath, filename, star_nb_start=0, star_nb_stop=-1, use_index=True, columns=None, row_filter=None):
+	"""
+	Read MACHO tile archive star by star.
+
+	Only one block of the tile (see iter_macho_blocks) is in memory at once.
+
+	Parameters
+	----------
+	filepath : str
+	filename : str
+	star_nb_start : int
+		From which star to start, default : 0 (from first line)
+	star_nb_stop : int
+		Last star read (included), default : -1 (goes to the end of file)
+	use_index : bool
+		Use the tile index if it exists, default : True
+	columns : list(str)
+		Names of MACHO_SCHEMA columns to decode, default : MACHO_COLUMNS
+	row_filter : RowFilter
+		Rows to keep, default : None (all)
+
+	Yields
+	------
+	tuple(np.int64, dict)
+		MACHO identifier of the star (see star_ids.encode_macho_id) and its lightcurve, as numpy arrays of the requested columns
+	"""
+	if columns is None:
+		columns = MACHO_COLUMNS
+	for cols in iter_macho_blocks(filepath, filename, star_nb_start=star_nb_start, star_nb_stop=star_nb_stop, use_index=use_index, columns=columns, row_filter=row_filter):
+		starts = np.r_[0, np.flatnonzero(cols['star_nb'][1:] != cols['star_nb'][:-1]) + 1, len(cols['star_nb'])]
+		for i, j in zip(starts[:-1], starts[1:]):
+			yield encode_macho_id(cols['field'][i], cols['tile'][i], cols['seq'][i]), {name: cols[name][i:j] for name in columns}
+
+
+def iter_macho_field_stars(MACHO_files_path, field, columns=None):
+	"""
+	Read all the MACHO tiles of a field star by star (see iter_macho_stars)
+
+	Parameters
+	----------
+	MACHO_files_path : str
+	field : int
+	columns : list(str)
+		Names of MACHO_SCHEMA columns to decode, default : MACHO_COLUMNS
+
+	Yields
+	------
+	tuple(np.int64, dict)
+		MACHO identifier of the star and its lightcurve
+	"""
+	macho_path = os.path.join(MACHO_files_path, "F_"+str(field))
+	for filename in sorted(os.listdir(macho_path)):
+		if filename[-3:] == '.gz':
+			yield from iter_macho_stars(macho_path, filename, columns=columns)
+
+
+def macho_blocks_to_frame(blocks, columns=None):
+	"""
+	Concatenate blocks of MACHO columns (see iter_macho_blocks) into a dataframe
+
+	Parameters
+	----------
+	blocks : iterable(dict)
+	columns : list(str)
+		Names of the MACHO_SCHEMA columns of the blocks to keep, default : MACHO_COLUMNS
+
+	Returns
+	-------
+	pd.DataFrame
+		Requested columns and id_M
+	"""
+	if columns is None:
+		columns = MACHO_COLUMNS
+	names = [name for name in columns if name not in MACHO_ID_COLUMNS]
+	values = {name: [] for name in names + MACHO_ID_COLUMNS}
+	for cols in blocks:
+		for name in values:
+			values[name].append(cols[name])
+
+	cols = {name: np.concatenate(value) if value else np.array([], dtype=MACHO_SCHEMA[name][1]) for name, value in values.items()}
+	lc = {name: cols[name] for name in names}
+	lc['id_M'] = encode_macho_id(cols['field'], cols['tile'], cols['seq'])
+	return pd.DataFrame(lc)
+
+
+def split_macho_tile(offsets, n_chunks, star_nb_start=0, star_nb_stop=-1):
+	"""
+	Split a range of stars of an indexed MACHO tile into contiguous ranges of about the same decompressed size.
+
+	Parameters
+	----------
+	offsets : np.ndarray
+		Star offsets of the tile index (see build_macho_tile_index)
+	n_chunks : int
+	star_nb_start : int
+	star_nb_stop : int
+		Last star (included), default : -1 (last star of the tile)
+
+	Returns
+	-------
+	list(tuple(int, int))
+		(first star, last star included) of each non empty range
+	"""
+	stop = len(offsets) - 1 if star_nb_stop < 0 else min(star_nb_stop + 1, len(offsets) - 1)
+	if star_nb_start >= stop:
+		return []
+	targets = np.linspace(offsets[star_nb_start], offsets[stop], n_chunks + 1)[1:-1]
+	bounds = np.unique(np.r_[star_nb_start, np.searchsorted(offsets[star_nb_start:stop], targets) + star_nb_start, stop])
+	return [(int(start), int(end) - 1) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def read_macho_lightcurve(filepath, filename, star_nb_start=0, star_nb_stop=-1, use_index=True, columns=None, pipeline=False, n_workers=1, row_filter=None):
+	"""
+	Read MACHO lightcurves from tile archive.
+
+	Concatenation of the blocks of iter_macho_blocks.
+	With n_workers > 1 and an indexed tile (see build_macho_tile_index), the tile is split into ranges of stars
+	(see split_macho_tile) decompressed and decoded by several processes, each one seeking directly at its first star.
+
+	Parameters
+	----------
+	filepath : str
+	filename : str
+	star_nb_start : int
+		From which star to start saving value of file, default : 0 (from first line)
+	star_nb_stop : int
+		Star at which the program will stop reading the file (included), default : -1 (goes to the end of file)
+	use_index : bool
+		Use the tile index if it exists, default : True
+	columns : list(str)
+		Names of MACHO_SCHEMA columns to load, default : MACHO_COLUMNS
+	pipeline : bool
+		Decompress the tile in a separate thread, while blocks are decoded, default : False
+	n_workers : int
+		Number of processes decompressing the tile, default : 1
+	row_filter : RowFilter
+		Rows to keep, default : None (all)
+
+	Returns
+	-------
+	pd.DataFrame
+		Requested columns and id_M
+	"""
+	if n_workers > 1 and not is_current_columnar(macho_columnar_path(filepath, filename), os.path.join(filepath, filename)):
+		offsets = load_macho_tile_index(filepath, filename) if use_index else None
+		if offsets is None:
+			logging.warning(os.path.join(filepath, filename) + " is not indexed, it is decompressed by a single process.")
+		else:
+			args_list = [(filepath, filename, start, stop, True, columns, pipeline, 1, row_filter) for start, stop in split_macho_tile(offsets, n_workers, star_nb_start, star_nb_stop)]
+			pds = list(parallel_map(read_macho_lightcurve, args_list, n_workers=n_workers))
+			if pds:
+				return pd.concat(pds, ignore_index=True)
+	return macho_blocks_to_frame(iter_macho_blocks(filepath, filename, star_nb_start=star_nb_start, star_nb_stop=star_nb_stop, use_index=use_index, columns=columns, pipeline=pipeline, row_filter=row_filter), columns=columns)
+
+
+class GzipChunksReader:
+	"""
+	File-like object decompressing on the fly an iterable of gzip chunks (for example an HTTP response body).
+
+	As with gzip.GzipFile, reading a stream that ends inside a gzip member raises EOFError.
+
+	Parameters
+	----------
+	chunks : iterable(bytes)
+		Compressed data
+	copy_to : file
+		If given, every compressed chunk is also written into it
+	"""
+	def __init__(self, chunks, copy_to=None):
+		self.chunks = iter(chunks)
+		self.copy_to = copy_to
+		self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+		self.buffer = bytearray()
+		self.eof = False
+
+	def _fill(self):
+		try:
+			chunk = next(self.chunks)
+		except StopIteration:
+			self.buffer += self.decompressor.flush()
+			self.eof = True
+			if not self.decompressor.eof:
+				raise EOFError("Compressed stream ended before the end of the last gzip member")
+			return
+		if self.copy_to is not None:
+			self.copy_to.write(chunk)
+		while chunk:
+			self.buffer += self.decompressor.decompress(chunk)
+			chunk = b''
+			if self.decompressor.eof and self.decompressor.unused_data:
+				#Next gzip member
+				chunk = self.decompressor.unused_data
+				self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+	def read(self, size=-1):
+		while not self.eof and (size < 0 or len(self.buffer) < size):
+			self._fill()
+		if size < 0:
+			size = len(self.buffer)
+		out = bytes(self.buffer[:size])
+		del self.buffer[:size]
+		return out
+
+
+_HTTP_SESSION = None
+
+
+def get_http_session():
+	"""
+	HTTP session of the current process, keeping up to MACHO_URL_WORKERS connections open for reuse.
+
+	Returns
+	-------
+	requests.Session
+	"""
+	global _HTTP_SESSION
+	if _HTTP_SESSION is None:
+		_HTTP_SESSION = requests.Session()
+		adapter = requests.adapters.HTTPAdapter(pool_connections=MACHO_URL_WORKERS, pool_maxsize=MACHO_URL_WORKERS, max_retries=3)
+		_HTTP_SESSION.mount('http://', adapter)
+		_HTTP_SESSION.mount('https://', adapter)
+	return _HTTP_SESSION
 
 
-def read_macho_lightcurve(filepath, filename, star_nb_start=0, star_nb_stop=-1):
+def load_macho_from_url(filename, cache_path=None, base_url=None, columns=None, row_filter=None):
 	"""
-	Read MACHO lightcurves from tile archive.
+	Load MACHO lightcurves from online database (http://macho.nci.org.au/macho_photometry)
+
+	The tile is decompressed and decoded while it is downloaded, and kept in the local cache of remote files (see remote_cache),
+	keyed by its URL, size and modification date, so that it is downloaded only once.
+	If the size and modification date can't be requested, the tile is downloaded without the cache.
 
 	Parameters
 	----------
-	filepath : str
 	filename : str
-	star_nb_start : int
-		From which star to start saving value of file, default : 0 (from first line)
-	star_nb_stop : int
-		Star at which the program will stop reading the file, default : -1 (goes to the end of file)
+		Name of file to load (F_ + field + . + tile + .gz). Example F_1.3319.gz
+	cache_path : str
+		Directory of the cache, default : None (MERGER_REMOTE_CACHE environment variable, no cache if unset). '' to disable the cache.
+	base_url : str
+		default : MACHO_URL
+	columns : list(str)
+		Names of MACHO_SCHEMA columns to load, default : MACHO_COLUMNS
+	row_filter : RowFilter
+		Rows to keep, default : None (all)
 
 	Returns
 	-------
 	pd.DataFrame
 	"""
-
-	lc = list() # {'time':[], 'red_M':[], 'rederr_M':[], 'blue_M':[], 'blueerr_M':[], 'id_M':[]}
-	curr_star_nb = 0
+	if base_url is None:
+		base_url = MACHO_URL
+	field = filename.split(".")[0]
+	target_url = base_url+field+'/'+filename
+	cache = get_remote_cache(cache_path)
 	try:
-		with gzip.open(os.path.join(filepath, filename), 'rt') as f:
-			line = f.readline().split(';')
-			last_star_id = line[3]
-			f.seek(0)
-
-			#Discard until star_nb_start
-			while curr_star_nb<star_nb_start:
-				line = f.readline().split(';')
-				if last_star_id != line[3]:
-					last_star_id = line[3]
-					curr_star_nb+=1
-
-			#Save until star_nb_stop
-			for line in f:
-				line = line.split(';')
-				temp = list()
-				if last_star_id != line[3]:
-					last_star_id = line[3]
-					curr_star_nb += 1
-					if curr_star_nb == star_nb_stop+1:
-						break
-				temp.append(float(line[4]))
-				temp.append(float(line[9]))
-				temp.append(float(line[10]))
-				temp.append(float(line[24]))
-				temp.append(float(line[25]))
-				temp.append(line[1] + ":" + line[2] + ":" + line[3])
-				lc.append(tuple(temp))
-			f.close()
-	except FileNotFoundError:
-		logging.error(os.path.join(filepath, filename) + " doesn't exist.")
-	lc = np.array(lc, dtype=[('time', 'f8'),
-							 ('red_M', 'f8'),
-							 ('rederr_M', 'f8'),
-							 ('blue_M', 'f8'),
-							 ('blueerr_M', 'f8'),
-							 ('id_M', 'U13')])
-	return pd.DataFrame.from_records(lc)
+		key = None
+		if cache is not None:
+			try:
+				with get_http_session().head(target_url, timeout=MACHO_URL_TIMEOUT, allow_redirects=True) as r:
+					r.raise_for_status()
+					key = cache.key(target_url, r.headers.get('Content-Length'), r.headers.get('Last-Modified'))
+			except requests.RequestException as e:
+				logging.warning(f"Could not request {target_url} headers ({e}), downloading it without the cache.")
+		if key is not None:
+			f = cache.open(key)
+			if f is not None:
+				with gzip.GzipFile(fileobj=f) as gzf, f:
+					return macho_blocks_to_frame(filter_blocks(iter_macho_stream_blocks(gzf, columns=columns), row_filter, MACHO_BANDS), columns=columns)
+
+		with get_http_session().get(target_url, stream=True, timeout=MACHO_URL_TIMEOUT) as r:
+			r.raise_for_status()
+			with cache.writer(key) if key is not None else nullcontext() as copy_to:
+				f = GzipChunksReader(r.iter_content(chunk_size=1024 * 1024), copy_to=copy_to)
+				return macho_blocks_to_frame(filter_blocks(iter_macho_stream_blocks(f, columns=columns), row_filter, MACHO_BANDS), columns=columns)
+	except (OSError, EOFError, zlib.error, requests.RequestException) as e:
+		logging.error(f"Could not load {target_url} : {e}")
+		return None
 
 
-def load_macho_from_url(filename):
+def parallel_map(func, args_list, n_workers=1, max_inflight=None, threads=False):
 	"""
-	Load MACHO lightcurves from online database (http://macho.nci.org.au/macho_photometry)
+	Apply func on each tuple of arguments of args_list in a process pool, and yield the results in the order of args_list.
 
 	Parameters
 	----------
-	filename : str
-		Name of file to load (F_ + field + . + tile + .gz). Example F_1.3319.gz
+	func : function
+		Must be picklable (defined at module level)
+	args_list : iterable(tuple)
+	n_workers : int
+		Number of worker processes, default : 1 (no pool, everything is computed in the current process)
+	max_inflight : int
+		Maximum number of submitted calls whose results were not yielded yet, default : 2 * n_workers.
+		Only the memory of the results waiting in the pool is bounded, the consumer keeps what it collects
+	threads : bool
+		Use a thread pool instead of a process pool (for I/O bound functions), default : False
+
+	Yields
+	------
+	Result of func for each element of args_list
+	"""
+	if n_workers <= 1:
+		for args in args_list:
+			yield func(*args)
+		return
+	if max_inflight is None:
+		max_inflight = 2 * n_workers
+	executor = ThreadPoolExecutor if threads else ProcessPoolExecutor
+	with executor(max_workers=n_workers) as pool:
+		pending = deque()
+		for args in args_list:
+			if len(pending) >= max_inflight:
+				yield pending.popleft().result()
+			pending.append(pool.submit(func, *args))
+		while pending:
+			yield pending.popleft().result()
+
+
+def load_macho_tiles(MACHO_files_path, field, tile_list, n_workers=1, max_inflight=None, columns=None, pipeline=False, row_filter=None):
+	"""
+	Load MACHO tiles of a field
+
+	Parameters
+	----------
+	MACHO_files_path : str
+		Path to MACHO tile files or 'url' to load them from NCI
+	field : int
+	tile_list : list(int)
+	n_workers : int
+		Number of processes reading tiles concurrently, default : 1 (at least MACHO_URL_WORKERS download threads with 'url')
+	max_inflight : int
+		Maximum number of tiles submitted to the pool at once, default : 2 * n_workers.
+		All the tiles are concatenated at the end, the memory used is not bounded by it
+	columns : list(str)
+		Names of MACHO_SCHEMA columns to load, default : MACHO_COLUMNS
+	pipeline : bool
+		Decompress each local tile in a separate thread, while it is decoded, default : False
+	row_filter : RowFilter
+		Rows to keep, default : None (all)
 
 	Returns
 	-------
 	pd.DataFrame
 	"""
-	field = filename.split(".")[0]
-	target_url = 'http://macho.nci.org.au/macho_photometry/'+field+'/'+filename
-	try:
-		file = gzip.decompress(get(target_url).content).decode().split('\n')[:-1]
-	except OSError:
-		logging.error(f"Not a gzipped file : {target_url}")
-		return None
-
-	#lc = {'time': [], 'red_M': [], 'rederr_M': [], 'blue_M': [], 'blueerr_M': [], 'id_M': []}
-	lc = list()
-	linecount=0
-	df = None
-	for line in file:
-		temp = list()
-		line = line.split(';')
-		temp.append(float(line[4]))
-		temp.append(float(line[9]))
-		temp.append(float(line[10]))
-		temp.append(float(line[24]))
-		temp.append(float(line[25]))
-		temp.append(line[1] + ":" + line[2] + ":" + line[3])
-		lc.append(tuple(temp))
-		linecount += 1
-		if linecount>500000:
-			linecount=0
-			lc = np.array(lc, dtype=[('time', 'f4'),
-									 ('red_M', 'f4'),
-									 ('rederr_M', 'f4'),
-									 ('blue_M', 'f4'),
-									 ('blueerr_M', 'f4'),
-									 ('id_M', 'U13')])
-			t = da.from_array(lc, chunks='100MB')
-			lc = list()
-			if df is None:
-				df = t.to_dask_dataframe()
-			else:
-				df = dd.concat([df, t.to_dask_dataframe()])
-	if df is None:
-		lc = np.array(lc, dtype=[('time', 'f4'),
-								 ('red_M', 'f4'),
-								 ('rederr_M', 'f4'),
-								 ('blue_M', 'f4'),
-								 ('blueerr_M', 'f4'),
-								 ('id_M', 'U13')])
-		t = da.from_array(lc, chunks='100MB')
-		df = t.to_dask_dataframe()
-	return df
-
-
-def load_macho_tiles(MACHO_files_path, field, tile_list):
 	macho_path = MACHO_files_path+"F_"+str(field)+"/"
-	pds = []
+	args_list = []
 	for tile in tile_list:
 		logging.debug(macho_path+"F_"+str(field)+"."+str(tile)+".gz")
 		# pds.append(pd.read_csv(macho_path+"F_49."+str(tile)+".gz", names=["id1", "id2", "id3", "time", "red_M", "rederr_M", "blue_M", "blueerr_M"], usecols=[1,2,3,4,9,10,24,25], sep=';'))
 		if MACHO_files_path=='url':
-			pds.append(load_macho_from_url("F_"+str(field)+"."+str(tile)+".gz"))
+			args_list.append(("F_"+str(field)+"."+str(tile)+".gz", None, None, columns, row_filter))
 		else:
-			pds.append(read_macho_lightcurve(macho_path, "F_"+str(field)+"."+str(tile)+".gz"))
-	return dd.concat(pds)
+			args_list.append((macho_path, "F_"+str(field)+"."+str(tile)+".gz", 0, -1, True, columns, pipeline, 1, row_filter))
+	if MACHO_files_path=='url':
+		pds = list(parallel_map(load_macho_from_url, args_list, n_workers=max(n_workers, MACHO_URL_WORKERS), max_inflight=max_inflight, threads=True))
+	else:
+		pds = list(parallel_map(read_macho_lightcurve, args_list, n_workers=n_workers, max_inflight=max_inflight))
+	return pd.concat(pds)
 
 
-def load_macho_field(MACHO_files_path, field):
+def load_macho_field(MACHO_files_path, field, n_workers=1, max_inflight=None, columns=None, pipeline=False, row_filter=None):
+	"""
+	Load all the MACHO tiles of a field
+
+	Parameters
+	----------
+	MACHO_files_path : str
+	field : int
+	n_workers : int
+		Number of processes reading tiles concurrently, default : 1
+	max_inflight : int
+		Maximum number of tiles submitted to the pool at once, default : 2 * n_workers.
+		All the tiles are concatenated at the end, the memory used is not bounded by it
+	columns : list(str)
+		Names of MACHO_SCHEMA columns to load, default : MACHO_COLUMNS
+	pipeline : bool
+		Decompress each local tile in a separate thread, while it is decoded, default : False
+	row_filter : RowFilter
+		Rows to keep, default : None (all)
+
+	Returns
+	-------
+	pd.DataFrame
+	"""
 	macho_path = MACHO_files_path+"F_"+str(field)+"/"
-	pds = []
+	args_list = []
 	for root, subdirs, files in os.walk(macho_path):
 		for file in files:
 			if file[-2:]=='gz':
-				print(file)
-				pds.append(read_macho_lightcurve(macho_path, file))
+				logging.debug(macho_path+file)
+				args_list.append((macho_path, file, 0, -1, True, columns, pipeline, 1, row_filter))
 				#pds.append(pd.read_csv(os.path.join(macho_path+file), names=["id1", "id2", "id3", "time", "red_M", "rederr_M", "blue_M", "blueerr_M"], usecols=[1,2,3,4,9,10,24,25], sep=';'))
-	return dd.concat(pds)
+	pds = list(parallel_map(read_macho_lightcurve, args_list, n_workers=n_workers, max_inflight=max_inflight))
+	return pd.concat(pds)
+
+
+def build_macho_field_manifest(MACHO_files_path, field, output_path=STAR_COUNT_PATH):
+	"""
+	Scan all the tiles of a MACHO field and save their manifest (see MACHO_MANIFEST_DTYPE) in output_path/manifest_<field>.npy
+
+	Parameters
+	----------
+	MACHO_files_path : str
+	field : int
+	output_path : str
+
+	Returns
+	-------
+	np.ndarray
+		Manifest of the field
+	"""
+	macho_path = os.path.join(MACHO_files_path, "F_"+str(field))
+	manifest = []
+	for filename in sorted(os.listdir(macho_path)):
+		if filename[-3:] != '.gz':
+			continue
+		star_count, row_count, size, first_star, last_star = 0, 0, 0, -1, -1
+		last_seq = None
+		with gzip.open(os.path.join(macho_path, filename), 'rb') as f:
+			for block in iter_line_blocks(f):
+				size += len(block)
+				seq = parse_macho_block(block, columns=[])['seq']
+				if not len(seq):
+					continue
+				if last_seq is None:
+					first_star = seq[0]
+				star_count += np.count_nonzero(np.r_[last_seq is None or seq[0] != last_seq, seq[1:] != seq[:-1]])
+				row_count += len(seq)
+				last_seq = last_star = seq[-1]
+		manifest.append((int(filename.split('.')[1]), star_count, row_count, size, first_star, last_star))
+	manifest = np.sort(np.array(manifest, dtype=MACHO_MANIFEST_DTYPE), order='tile')
+	np.save(os.path.join(output_path, "manifest_"+str(field)+".npy"), manifest)
+	return manifest
+
+
+def load_macho_field_manifest(field, manifest_path=None):
+	"""
+	Load the manifest of a MACHO field (see build_macho_field_manifest)
+
+	Parameters
+	----------
+	field : int
+	manifest_path : str
+		Directory of the manifests, default : STAR_COUNT_PATH
+
+	Returns
+	-------
+	np.ndarray or None
+		None if the manifest doesn't exist
+	"""
+	if manifest_path is None:
+		manifest_path = STAR_COUNT_PATH
+	path = os.path.join(manifest_path, "manifest_"+str(field)+".npy")
+	if not os.path.isfile(path):
+		return None
+	return np.load(path)
+
+
+def partition_macho_jobs(manifest, n_jobs, weight='rows'):
+	"""
+	Cut the stars of a MACHO field in n_jobs shards of similar weight.
 
+	Stars are kept in tile order, each shard being a contiguous range of stars. Inside a tile, all the stars are supposed to have the same weight.
 
-def load_macho_stars(MACHO_files_path, MACHO_field, t_indice):
+	Parameters
+	----------
+	manifest : np.ndarray
+		Manifest of the field (see MACHO_MANIFEST_DTYPE)
+	n_jobs : int
+		Number of shards
+	weight : str
+		'rows' to balance the number of rows, 'cost' to add STAR_COST_ROWS rows per star to it, 'stars' to balance the number of stars
+
+	Returns
+	-------
+	list(list(tuple(int, int, int)))
+		For each shard, list of (tile, star_nb_start, star_nb_stop) with star_nb_stop included
+	"""
+	manifest = manifest[manifest['star_count'] > 0]	#No empty files
+	star_count = manifest['star_count'].astype('i8')
+	if weight == 'rows':
+		tile_weights = manifest['row_count'].astype('f8')
+	elif weight == 'cost':
+		tile_weights = manifest['row_count'] + STAR_COST_ROWS * star_count.astype('f8')
+	elif weight == 'stars':
+		tile_weights = star_count.astype('f8')
+	else:
+		raise ValueError(f"Unknown weight : {weight}")
+	star_weights = np.repeat(tile_weights / star_count, star_count)
+	cum_weights = np.cumsum(star_weights)
+	# Shard of each star, from the position of its middle in the cumulated weights
+	shards = np.minimum(((cum_weights - star_weights / 2) / cum_weights[-1] * n_jobs).astype('i8'), n_jobs - 1)
+	first_stars = np.searchsorted(shards, np.arange(n_jobs + 1))
+	tile_starts = np.r_[0, np.cumsum(star_count)]
+
+	jobs = []
+	for k in range(n_jobs):
+		a, b = first_stars[k], first_stars[k + 1]
+		job = []
+		for idx in range(np.searchsorted(tile_starts, a, side='right') - 1, np.searchsorted(tile_starts, b, side='left')):
+			start = max(a, tile_starts[idx]) - tile_starts[idx]
+			stop = min(b, tile_starts[idx + 1]) - tile_starts[idx] - 1
+			if stop >= start:
+				job.append((int(manifest['tile'][idx]), int(start), int(stop)))
+		jobs.append(job)
+	return jobs
+
+
+def load_macho_stars(MACHO_files_path, MACHO_field, t_indice, weight='rows', row_filter=None):
 	"""
 	Load MACHO stars by group of STARS_PER_JOBS stars.
 
+	If the field has a manifest (see build_macho_field_manifest), the field is cut in as many jobs as with groups of STARS_PER_JOBS stars,
+	but the jobs are balanced on "weight" (see partition_macho_jobs) instead of the number of stars.
+	The manifests are not shipped with the package : they are built once per field with utils/build_macho_manifest.py,
+	before submitting the jobs. Without one, the jobs are cut on the star counts of STAR_COUNT_PATH/strcnt_<field>.txt.
+	Tiles with an index (see build_macho_tile_index) are read from the first needed star instead of from their beginning.
+
 	Parameters
 	----------
 	MACHO_files_path: str
@@ -367,13 +2062,40 @@ def load_macho_stars(MACHO_files_path, MACHO_field, t_indice):
 		Curretn MACHO field
 	t_indice: int
 		Current job array number
+	weight: str
+		'rows', 'cost' or 'stars', used only with a manifest, default : 'rows'
+	row_filter : RowFilter
+		Rows to keep, default : None (all)
+
+	Raises
+	------
+	ValueError
+		t_indice is not the number of a job of the field
 
 	Returns
 	-------
 	pd.DataFrame
+		Empty if the job has no star
 	"""
-	counts = np.loadtxt(os.path.join(STAR_COUNT_PATH, "strcnt_"+str(MACHO_field)+".txt"), dtype=[('tile', 'i4'), ('number_of_stars', 'i4')])
-	counts = counts[counts['number_of_stars'] > 0]	#No empty files
+	full_path = os.path.join(MACHO_files_path, 'F_'+str(MACHO_field))
+	manifest = load_macho_field_manifest(MACHO_field)
+	if manifest is not None:
+		n_jobs = int(np.ceil(manifest['star_count'].sum() / STARS_PER_JOBS))
+	else:
+		logging.info(f"No manifest for MACHO field {MACHO_field}, jobs are cut on star counts (see utils/build_macho_manifest.py)")
+		counts = np.loadtxt(os.path.join(STAR_COUNT_PATH, "strcnt_"+str(MACHO_field)+".txt"), dtype=[('tile', 'i4'), ('number_of_stars', 'i4')])
+		counts = counts[counts['number_of_stars'] > 0]	#No empty files
+		n_jobs = int(np.ceil(counts['number_of_stars'].sum() / STARS_PER_JOBS))
+	if not 1 <= t_indice <= n_jobs:
+		raise ValueError(f"t_indice {t_indice} out of range, MACHO field {MACHO_field} has {n_jobs} jobs of {STARS_PER_JOBS} stars")
+
+	if manifest is not None:
+		job = partition_macho_jobs(manifest, n_jobs, weight=weight)[t_indice - 1]
+		if not job:
+			return macho_blocks_to_frame([])
+		pds = [read_macho_lightcurve(full_path, 'F_'+str(MACHO_field)+'.'+str(tile)+'.gz', star_nb_start, star_nb_stop, row_filter=row_filter) for tile, star_nb_start, star_nb_stop in job]
+		return pd.concat(pds, copy=False, sort=False)
+
 	start = (t_indice - 1) * STARS_PER_JOBS
 	end = t_indice * STARS_PER_JOBS - 1
 	tot_starcounts = counts['number_of_stars'].cumsum()
@@ -387,22 +2109,243 @@ def load_macho_stars(MACHO_files_path, MACHO_field, t_indice):
 		end_tile = counts['tile'][end_idx]
 		n_end = tot_starcounts[end_idx] - counts['number_of_stars'][end_idx]
 
-	full_path = os.path.join(MACHO_files_path, 'F_'+str(MACHO_field))
 	n_start = tot_starcounts[start_idx] - counts['number_of_stars'][start_idx] 	#First cumulated star number
 	if start_idx==end_idx:
-		pds = read_macho_lightcurve(full_path, 'F_'+str(MACHO_field)+'.'+str(start_tile)+'.gz', start-n_start, end-n_end)
+		pds = [read_macho_lightcurve(full_path, 'F_'+str(MACHO_field)+'.'+str(start_tile)+'.gz', start-n_start, end-n_end, row_filter=row_filter)]
 	else:
 		pds = list()
-		pds.append(read_macho_lightcurve(full_path, 'F_'+str(MACHO_field)+'.'+str(start_tile)+'.gz', star_nb_start=start-n_start))
-		pds.append(read_macho_lightcurve(full_path, 'F_'+str(MACHO_field)+'.'+str(end_tile)+'.gz', star_nb_stop=end-n_end))
+		pds.append(read_macho_lightcurve(full_path, 'F_'+str(MACHO_field)+'.'+str(start_tile)+'.gz', star_nb_start=start-n_start, row_filter=row_filter))
+		pds.append(read_macho_lightcurve(full_path, 'F_'+str(MACHO_field)+'.'+str(end_tile)+'.gz', star_nb_stop=end-n_end, row_filter=row_filter))
 		if start_idx+1 <= end_idx-1:
 			for idx in range(start_idx+1, end_idx):
-				pds.append(read_macho_lightcurve(full_path, 'F_' + str(MACHO_field) + '.' + str(counts['tile'][idx]) + '.gz'))
+				pds.append(read_macho_lightcurve(full_path, 'F_' + str(MACHO_field) + '.' + str(counts['tile'][idx]) + '.gz', row_filter=row_filter))
 	return pd.concat(pds, copy=False, sort=False)
 
 
 
-def merger_eros_first(output_dir_path, MACHO_field, eros_ccd, EROS_files_path, correspondance_files_path, MACHO_files_path, quart="", save=True):
+def load_correspondance(correspondance_path):
+	"""
+	Load EROS-MACHO association file, with integer identifiers (see star_ids)
+
+	Parameters
+	----------
+	correspondance_path : str
+
+	Returns
+	-------
+	pd.DataFrame
+		Columns id_E and id_M
+	"""
+	correspondance = pd.read_csv(correspondance_path, names=["id_E", "id_M"], usecols=[0, 3], sep=' ', dtype=str)
+	return pd.DataFrame({'id_E': encode_eros_id(correspondance.id_E), 'id_M': encode_macho_id_strings(correspondance.id_M)})
+
+
+def build_correspondance_index(correspondance_path):
+	"""
+	Convert an EROS-MACHO association file into its binary index (see correspondance_index), written next to it
+
+	Parameters
+	----------
+	correspondance_path : str
+		Path of the <field>.txt association file
+
+	Returns
+	-------
+	CorrespondanceIndex
+	"""
+	stat = source_stat(correspondance_path)
+	correspondance = load_correspondance(correspondance_path)
+	index = CorrespondanceIndex.from_pairs(correspondance.id_E.values, correspondance.id_M.values)
+	index.save(correspondance_index_path(correspondance_path), source_stat=stat)
+	return index
+
+
+def load_correspondance_index(correspondance_path):
+	"""
+	Index of an EROS-MACHO association file : memory mapped if it was built (see build_correspondance_index), else built in memory
+
+	An index built before the association file was replaced is not used, a warning is logged.
+
+	Parameters
+	----------
+	correspondance_path : str
+		Path of the <field>.txt association file
+
+	Returns
+	-------
+	CorrespondanceIndex
+	"""
+	index_path = correspondance_index_path(correspondance_path)
+	if os.path.isdir(index_path) and is_current_sidecar(os.path.join(index_path, SOURCE_STAT_FILE), correspondance_path):
+		return CorrespondanceIndex.load(index_path)
+	correspondance = load_correspondance(correspondance_path)
+	return CorrespondanceIndex.from_pairs(correspondance.id_E.values, correspondance.id_M.values)
+
+
+def add_counterparts(lcs, counterparts, counterpart_key):
+	"""
+	Add the identifiers of the counterparts of the stars to lightcurves, and drop the rows of stars without counterpart
+
+	Parameters
+	----------
+	lcs : pd.DataFrame
+	counterparts : np.ndarray
+		Identifier of the counterpart of each row, -1 if none (see CorrespondanceIndex.macho_of and eros_of)
+	counterpart_key : str
+		Name of the added column
+
+	Returns
+	-------
+	pd.DataFrame
+	"""
+	keep = counterparts >= 0
+	lcs = lcs[keep].reset_index(drop=True)
+	lcs[counterpart_key] = counterparts[keep]
+	return lcs
+
+
+def input_sidecars(path):
+	"""
+	Existing sidecar files of an input file, read by the loaders instead of it : indexes (see build_macho_tile_index,
+	build_eros_archive_index and build_correspondance_index) and converted columns (see write_columnar)
+
+	Parameters
+	----------
+	path : str
+		MACHO tile, EROS archive or association file
+
+	Returns
+	-------
+	list(str)
+	"""
+	paths = [path + suffix for suffix in ('.gzidx', '.stars.npy', '.members.npy', '.source.npy')]
+	if path.endswith('.tar.gz'):
+		directory = eros_columnar_path(path)
+	elif path.endswith('.gz'):
+		directory = macho_columnar_path(os.path.dirname(path), os.path.basename(path))
+	else:
+		directory = correspondance_index_path(path)
+	if os.path.isdir(directory):
+		paths += [os.path.join(directory, name) for name in sorted(os.listdir(directory))]
+	return [path for path in paths if os.path.isfile(path)]
+
+
+def merger_eros_first_inputs(MACHO_field, eros_ccd, EROS_files_path, correspondance_files_path, MACHO_files_path, quart=""):
+	"""
+	Local input files of merger_eros_first : association file, EROS quarter archives and MACHO tiles of the associated stars,
+	and their sidecar files (see input_sidecars)
+
+	Files loaded from iRods or from NCI are not listed.
+
+	Parameters
+	----------
+	MACHO_field : int
+	eros_ccd : str
+		ccd eros, format : "lm0***"
+	EROS_files_path, correspondance_files_path, MACHO_files_path : str
+		see merger_eros_first
+	quart : str
+		Quarter of the CCD, default : "" (all the quarters)
+
+	Returns
+	-------
+	list(str)
+	"""
+	correspondance_path = os.path.join(correspondance_files_path, str(MACHO_field)+".txt")
+	paths = [correspondance_path]
+	correspondance = load_correspondance_index(correspondance_path)
+	quarts = "klmn" if quart not in "klmn" or quart=="" else quart
+	tiles = []
+	for q in quarts:
+		if EROS_files_path != 'irods':
+			paths.append(os.path.join(EROS_files_path, eros_ccd[:5], eros_ccd+q+"-lc.tar.gz"))
+		tiles.append(macho_id_tile(correspondance.eros_quarter(int(eros_ccd[2:5]), int(eros_ccd[5]), q)[1]))
+	if MACHO_files_path != 'url':
+		paths += [os.path.join(MACHO_files_path, "F_"+str(MACHO_field), "F_"+str(MACHO_field)+"."+str(tile)+".gz") for tile in np.unique(np.concatenate(tiles))]
+	return paths + [sidecar for path in paths for sidecar in input_sidecars(path)]
+
+
+def merger_macho_first_inputs(MACHO_field, MACHO_tile, EROS_files_path, correspondance_files_path, MACHO_files_path):
+	"""
+	Local input files of merger_macho_first on tiles : association file, MACHO tiles and EROS quarter archives of the associated stars,
+	and their sidecar files (see input_sidecars)
+
+	Parameters
+	----------
+	MACHO_field : int
+	MACHO_tile : int or list(int)
+	EROS_files_path, correspondance_files_path, MACHO_files_path : str
+		see merger_macho_first
+
+	Returns
+	-------
+	list(str)
+	"""
+	correspondance_path = os.path.join(correspondance_files_path, str(MACHO_field)+".txt")
+	paths = [correspondance_path]
+	correspondance = load_correspondance_index(correspondance_path)
+	archives = []
+	for tile in np.atleast_1d(MACHO_tile):
+		if MACHO_files_path != 'url':
+			paths.append(os.path.join(MACHO_files_path, "F_"+str(MACHO_field), "F_"+str(MACHO_field)+"."+str(tile)+".gz"))
+		archives.append(np.unique(correspondance.macho_tile(MACHO_field, int(tile))[1] >> 36))
+	if EROS_files_path != 'irods':
+		# The highest bits of EROS identifiers are the ones of their archive
+		paths += [eros_archive_path(EROS_files_path, archive << 36) for archive in np.unique(np.concatenate(archives))]
+	return paths + [sidecar for path in paths for sidecar in input_sidecars(path)]
+
+
+def filter_complete_stars(merged, min_points=1, key='id_E'):
+	"""
+	Remove the stars missing one or more color from merged lightcurves
+
+	Valid points (magnitude and error not NaN) of each star are counted in every band at once, without grouping the dataframe by star.
+
+	Parameters
+	----------
+	merged : pd.DataFrame
+	min_points : int
+		Minimum number of valid points of a star in each band, default : 1
+	key : str
+		Identifier column of the stars, default : 'id_E'
+
+	Returns
+	-------
+	pd.DataFrame
+		Rows of the stars with at least min_points valid points in every band, in their original order
+	"""
+	codes, stars = pd.factorize(merged[key])
+	complete = np.ones(len(stars), dtype=bool)
+	for color_filter in COLOR_FILTERS.values():
+		valid = merged[color_filter['mag']].notnull().to_numpy() & merged[color_filter['err']].notnull().to_numpy()
+		complete &= np.bincount(codes[valid], minlength=len(stars)) >= min_points
+	return merged[complete[codes]]
+
+
+def save_ragged_merge(lcs, path=None, min_points=1):
+	"""
+	Remove the stars missing one or more color from merged lightcurves, and save them as a dataframe
+
+	Parameters
+	----------
+	lcs : RaggedLightcurves
+	path : str
+		Path of the bz2 compressed pickle file, default : None (not saved)
+	min_points : int
+		Minimum number of valid points of a star in each band, default : 1
+
+	Returns
+	-------
+	RaggedLightcurves
+	"""
+	lcs = lcs.select((lcs.counts() >= min_points).all(axis=1).to_numpy())
+	if path is not None:
+		logging.info("Saving")
+		lcs.to_frame().to_pickle(path, compression='bz2')
+	return lcs
+
+
+def merger_eros_first(output_dir_path, MACHO_field, eros_ccd, EROS_files_path, correspondance_files_path, MACHO_files_path, quart="", save=True, n_workers=1, max_inflight=None, row_filter=None, sample_fraction=None, seed=0, ragged=False, min_points=1):
 	"""
 	Merge EROS and MACHO lightcurves, using EROS as starter
 
@@ -414,6 +2357,21 @@ def merger_eros_first(output_dir_path, MACHO_field, eros_ccd, EROS_files_path, c
 		MACHO field on which merge lcs.
 	eros_ccd : str
 		ccd eros, format : "lm0***"
+	n_workers : int
+		Number of processes loading the EROS quarters, then the MACHO tiles, concurrently, default : 1
+	max_inflight : int
+		Maximum number of quarters or tiles submitted to the pool at once, default : 2 * n_workers.
+		Each EROS quarter is merged as soon as it is loaded, the MACHO tiles are concatenated at the end
+	row_filter : RowFilter
+		Rows kept by the loaders, default : RowFilter() (invalid magnitudes replaced by NaN, rows without valid magnitude dropped)
+	sample_fraction : float
+		Merge only this fraction of the EROS stars, chosen by hashing their identifier (see star_ids.sample_stars), default : None (all)
+	seed : int
+		Seed of the star sample, default : 0
+	ragged : bool
+		Return the lightcurves as a RaggedLightcurves instead of a dataframe, default : False. The saved file is still a dataframe.
+	min_points : int
+		Minimum number of valid points of a star in each band, stars with less points are removed (see filter_complete_stars), default : 1
 
 	Raises
 	------
@@ -422,63 +2380,67 @@ def merger_eros_first(output_dir_path, MACHO_field, eros_ccd, EROS_files_path, c
 
 	Returns
 	-------
-	pd.DataFrame
+	pd.DataFrame or RaggedLightcurves
 	"""
 	start = time.time()
+	if row_filter is None:
+		row_filter = RowFilter()
+	if sample_fraction is not None:
+		row_filter = row_filter.sampled(sample_fraction, seed)
 
+	#loading correspondance index, to merge each EROS quarter as soon as it is loaded
+	correspondance_path=os.path.join(correspondance_files_path, str(MACHO_field)+".txt")
+	correspondance = load_correspondance_index(correspondance_path)
+	if not len(correspondance.eros_quarter(int(eros_ccd[2:5]), int(eros_ccd[5]))[0]):
+		logging.error(f'No common stars in CCD, correspondace path : {correspondance_path}')
+		raise NameError("No common stars in field !!!!")
 
 	# l o a d   E R O S
 	logging.info("Loading EROS files")
 
+	quarts = "klmn" if quart not in "klmn" or quart=="" else quart
 	if EROS_files_path != 'irods':
 		# eros_lcs = pd.concat([pd.read_pickle(output_dir_path+"full_"+eros_ccd+quart) for quart in 'klmn'])				# <===== Load from pickle files
 		# eros_lcs = load_eros_files("/Volumes/DisqueSauvegarde/EROS/lightcurves/lm/"+eros_ccd[:5]+"/"+eros_ccd)			# <===== Load from .time files
-		if quart not in "klmn" or quart=="":
-			eros_lcs = pd.concat([load_eros_compressed_files(os.path.join(EROS_files_path,eros_ccd[:5],eros_ccd+quart+"-lc.tar.gz")) for quart in "klmn"])
-		else:
-			eros_lcs = load_eros_compressed_files(os.path.join(EROS_files_path,eros_ccd[:5],eros_ccd+quart+"-lc.tar.gz"))
+		loader = partial(load_eros_compressed_files, row_filter=row_filter)
+		args_list = [(os.path.join(EROS_files_path,eros_ccd[:5],eros_ccd+q+"-lc.tar.gz"),) for q in quarts]
 	else:
-		IRODS_ROOT = '/eros/data/eros2/lightcurves/lm/'
-		if quart not in 'klmn' or quart=='':
-			eros_lcs = pd.concat([load_irods_eros_lightcurves(os.path.join(IRODS_ROOT, eros_ccd[:5], eros_ccd, eros_ccd+quart)) for quart in "klmn"])
-		else:
-			eros_lcs = load_irods_eros_lightcurves(os.path.join(IRODS_ROOT, eros_ccd[:5], eros_ccd, eros_ccd+quart))
+		loader = partial(load_irods_eros_lightcurves, row_filter=row_filter)
+		args_list = [(os.path.join(IRODS_ROOT, eros_ccd[:5], eros_ccd, eros_ccd+q),) for q in quarts]
+	merged1 = []
+	nb_lines = 0
+	for eros_lcs in parallel_map(loader, args_list, n_workers=min(n_workers, len(args_list)), max_inflight=max_inflight):
+		nb_lines += len(eros_lcs)
+		merged1.append(add_counterparts(eros_lcs, correspondance.macho_of(eros_lcs.id_E.values), 'id_M'))
+		del eros_lcs
+	merged1 = pd.concat(merged1, ignore_index=True)
 	end_load_eros = time.time()
-	logging.info(str(end_load_eros-start)+' seconds elapsed for loading EROS files')
-	logging.info(f'{len(eros_lcs)} lines loaded.')
-
-	#loading correspondance file and merging with load EROS stars
-	logging.info("Merging")
-	correspondance_path=os.path.join(correspondance_files_path, str(MACHO_field)+".txt")
-	correspondance = pd.read_csv(correspondance_path, names=["id_E", "id_M"], usecols=[0, 3], sep=' ')
-	merged1 = eros_lcs.merge(correspondance, on="id_E", validate="m:1")
-	del eros_lcs
+	logging.info(str(end_load_eros-start)+' seconds elapsed for loading and merging EROS files')
+	logging.info(f'{nb_lines} lines loaded.')
 
 	# determine needed tiles from MACHO
-	tiles = np.unique([x.split(":")[1] for x in merged1.id_M.unique()])
+	tiles = np.unique(macho_id_tile(merged1.id_M.unique()))
 	if not tiles.size:
 		logging.error(f'No common stars in field, correspondace path : {correspondance_path}')
 		raise NameError("No common stars in field !!!!")
 
 	#l o a d   M A C H O
 	logging.info("Loading MACHO files")
-	macho_lcs = load_macho_tiles(MACHO_files_path, MACHO_field, tiles)
+	macho_lcs = load_macho_tiles(MACHO_files_path, MACHO_field, tiles, n_workers=n_workers, max_inflight=max_inflight, row_filter=row_filter.sampled(None))
 
 	logging.info("Merging")
-	merged2 = macho_lcs.merge(correspondance, on='id_M', validate="m:1")
+	# the sample is drawn on EROS stars, MACHO stars are kept if their counterpart is in the sample
+	counterparts = correspondance.eros_of(macho_lcs.id_M.values)
+	merged2 = add_counterparts(macho_lcs, np.where(row_filter.keep_stars(counterparts), counterparts, -1), 'id_E')
 	del macho_lcs
+	if ragged:
+		return save_ragged_merge(RaggedLightcurves.from_frames([merged1, merged2]), os.path.join(output_dir_path, str(MACHO_field)+"_"+str(eros_ccd)+quart+".pkl") if save else None, min_points)
 	merged = pd.concat((merged1, merged2), copy=False)
 	del merged1
 	del merged2
 
-	# replace invalid values in magnitudes with numpy NaN and remove rows with no valid magnitudes
-	merged = merged.replace(to_replace=[99.999,-99.], value=np.nan).dropna(axis=0, how='all', subset=['blue_E', 'red_E', 'blue_M', 'red_M'])
-
 	# remove lightcurves missing one or more color
-	merged = merged.groupby('id_E').filter(lambda x: x.red_E.count()!=0
-		and x.red_M.count()!=0
-		and x.blue_E.count()!=0
-		and x.blue_M.count()!=0)
+	merged = filter_complete_stars(merged, min_points)
 
 	# save merged dataframe
 	if save:
@@ -487,13 +2449,18 @@ def merger_eros_first(output_dir_path, MACHO_field, eros_ccd, EROS_files_path, c
 
 	return merged
 
-def merger_macho_first(output_dir_path, MACHO_field, EROS_files_path, correspondance_files_path, MACHO_files_path, save=True, t_indice=None, MACHO_tile=None,):
+def merger_macho_first(output_dir_path, MACHO_field, EROS_files_path, correspondance_files_path, MACHO_files_path, save=True, t_indice=None, MACHO_tile=None, n_workers=1, row_filter=None, sample_fraction=None, seed=0, ragged=False, min_points=1):
 	logging.info("Loading MACHO files")
-
-	if isinstance(MACHO_tile, list) or isinstance(MACHO_tile, np.ndarray):
-		macho_lcs = load_macho_tiles(MACHO_files_path, MACHO_field, [MACHO_tile])
+	if row_filter is None:
+		row_filter = RowFilter()
+	if sample_fraction is not None:
+		# the sample is drawn on MACHO stars
+		row_filter = row_filter.sampled(sample_fraction, seed)
+
+	if isinstance(MACHO_tile, (int, np.integer, list, np.ndarray)):
+		macho_lcs = load_macho_tiles(MACHO_files_path, MACHO_field, np.atleast_1d(MACHO_tile), row_filter=row_filter)
 	elif isinstance(t_indice, int):
-		macho_lcs = load_macho_stars(MACHO_files_path=MACHO_files_path, MACHO_field=MACHO_field, t_indice=t_indice)
+		macho_lcs = load_macho_stars(MACHO_files_path=MACHO_files_path, MACHO_field=MACHO_field, t_indice=t_indice, row_filter=row_filter)
 	else:
 		logging.error("No tile or t_indice defined or bad format")
 		raise SystemExit(0)
@@ -502,49 +2469,250 @@ def merger_macho_first(output_dir_path, MACHO_field, EROS_files_path, correspond
 	# loading correspondance file and merging with load MACHO stars
 	logging.info("Merging")
 	correspondance_path = os.path.join(correspondance_files_path, str(MACHO_field) + ".txt")
-	correspondance = pd.read_csv(correspondance_path, names=["id_E", "id_M"], usecols=[0, 3], sep=' ')
-	merged1 = macho_lcs.merge(correspondance, on="id_M", validate="m:1")
+	correspondance = load_correspondance_index(correspondance_path)
+	merged1 = add_counterparts(macho_lcs, correspondance.eros_of(macho_lcs.id_M.values), 'id_E')
 	del macho_lcs
 
 	logging.info("Loading EROS lightcurves")
 
 	if EROS_files_path == 'irods':
 		st1 = time.time()
-		eros_lcs = ""
-		for i in range(10):
-			eros_lcs = load_irods_eros_lightcurves(idE_list=merged1.id_E.unique())
-			if isinstance(eros_lcs, pd.DataFrame):
-				break
-			if i==9:
-				raise SystemExit(f"iRods takes too much times. Restart the job.")
+		eros_lcs = load_irods_eros_lightcurves(idE_list=merged1.id_E.unique(), n_workers=max(n_workers, IRODS_WORKERS), row_filter=row_filter.sampled(None))
 		logging.info(f"{time.time()-st1} seconds to load {eros_lcs.id_E.nunique()}.")
 	else:
-		raise logging.error("Usual EROS loading not implemented yet !")
+		st1 = time.time()
+		eros_lcs = load_eros_stars(EROS_files_path, merged1.id_E.unique(), n_workers=n_workers, row_filter=row_filter.sampled(None))
+		logging.info(f"{time.time()-st1} seconds to load {eros_lcs.id_E.nunique()}.")
 
 	logging.info("Merging")
-	merged2 = eros_lcs.merge(correspondance, on='id_E', validate="m:1")
+	merged2 = add_counterparts(eros_lcs, correspondance.macho_of(eros_lcs.id_E.values), 'id_M')
 	del eros_lcs
+	output_path = None
+	if save:
+		# Several tiles are joined in the file name : <field>_3319-3320.bz2
+		name = "-".join(str(tile) for tile in np.atleast_1d(MACHO_tile)) if MACHO_tile is not None else t_indice
+		output_path = os.path.join(output_dir_path, str(MACHO_field) + "_" + str(name) + ".bz2")
+	if ragged:
+		return save_ragged_merge(RaggedLightcurves.from_frames([merged2, merged1]), output_path, min_points)
 
 	merged = pd.concat((merged1, merged2), copy=False, sort=False)
 
-	# replace invalid values in magnitudes with numpy NaN and remove rows with no valid magnitudes
-	merged = merged.replace(to_replace=[99.999, -99.], value=np.nan).dropna(axis=0, how='all',
-																			subset=['blue_E', 'red_E', 'blue_M',
-																					'red_M'])
-
 	# remove lightcurves missing one or more color
-	merged = merged.groupby('id_E').filter(lambda x: x.red_E.count() != 0
-													 and x.red_M.count() != 0
-													 and x.blue_E.count() != 0
-													 and x.blue_M.count() != 0)
+	merged = filter_complete_stars(merged, min_points)
 
 	# save merged dataframe
 	if save:
 		logging.info("Saving")
-		if MACHO_tile:
-			name = MACHO_tile
-		else:
-			name = t_indice
-		merged.to_pickle(os.path.join(output_dir_path, str(MACHO_field) + "_" + str(name) + ".bz2"), compression='bz2')
+		merged.to_pickle(output_path, compression='bz2')
+
+	return merged
+
+def star_partitions(ids, n_partitions):
+	"""
+	Partition of stars, from the hash of their identifier (see star_ids.hash_star_ids)
+
+	Parameters
+	----------
+	ids : np.ndarray
+	n_partitions : int
+
+	Returns
+	-------
+	np.ndarray
+	"""
+	return (hash_star_ids(ids) % np.uint64(n_partitions)).astype('i8')
+
+
+def write_star_partitions(lcs, shuffle_path, unit, n_partitions, key='id_E'):
+	"""
+	Split lightcurves by star partition (see star_partitions), and write each part in the directory of its partition
+
+	Parameters
+	----------
+	lcs : pd.DataFrame
+	shuffle_path : str
+		Directory containing a directory per partition
+	unit : str
+		Name of the written files, unique for each loaded unit (archive or tile)
+	n_partitions : int
+	key : str
+		Column of the star identifiers, default : 'id_E'
+
+	Returns
+	-------
+	np.ndarray
+		Number of rows written in each partition
+	"""
+	partitions = star_partitions(lcs[key].values, n_partitions)
+	order = np.argsort(partitions, kind='stable')
+	counts = np.bincount(partitions, minlength=n_partitions)
+	bounds = np.r_[0, np.cumsum(counts)]
+	for p in np.flatnonzero(counts):
+		lcs.iloc[order[bounds[p]:bounds[p+1]]].reset_index(drop=True).to_pickle(os.path.join(shuffle_path, f"{p:04d}", unit + ".pkl"))
+	return counts
+
+
+def shuffle_eros_quarter(path, correspondance_path, shuffle_path, n_partitions, row_filter=None):
+	"""
+	Load an EROS quarter (archive, or iRods collection if path is in IRODS_ROOT), add the MACHO counterparts
+	and write the stars with a counterpart in their partitions (see write_star_partitions)
+	"""
+	if path.startswith(IRODS_ROOT):
+		eros_lcs = load_irods_eros_lightcurves(path, row_filter=row_filter)
+	else:
+		eros_lcs = load_eros_compressed_files(path, row_filter=row_filter)
+	correspondance = load_correspondance_index(correspondance_path)
+	merged = add_counterparts(eros_lcs, correspondance.macho_of(eros_lcs.id_E.values), 'id_M')
+	return write_star_partitions(merged, shuffle_path, "E_" + os.path.basename(path).split("-")[0], n_partitions)
+
+
+def shuffle_macho_tile(MACHO_files_path, field, tile, correspondance_path, shuffle_path, n_partitions, row_filter=None):
+	"""
+	Load a MACHO tile, add the EROS counterparts (only if they are in the star sample of row_filter)
+	and write the stars with a counterpart in their partitions (see write_star_partitions)
+	"""
+	macho_lcs = load_macho_tiles(MACHO_files_path, field, [tile], row_filter=row_filter.sampled(None) if row_filter is not None else None)
+	correspondance = load_correspondance_index(correspondance_path)
+	counterparts = correspondance.eros_of(macho_lcs.id_M.values)
+	if row_filter is not None:
+		counterparts = np.where(row_filter.keep_stars(counterparts), counterparts, -1)
+	merged = add_counterparts(macho_lcs, counterparts, 'id_E')
+	return write_star_partitions(merged, shuffle_path, f"M_{field}.{tile}", n_partitions)
+
 
-	return merged
\ No newline at end of file
+def merge_star_partition(shuffle_path, partition, output_path, min_points=1):
+	"""
+	Merge the EROS and MACHO lightcurves of a star partition, remove the stars missing one or more color and save them
+
+	Parameters
+	----------
+	shuffle_path : str
+	partition : int
+	output_path : str
+		Path of the bz2 compressed pickle file of the partition
+	min_points : int
+		Minimum number of valid points of a star in each band, default : 1
+
+	Returns
+	-------
+	tuple(str, int)
+		Output path and number of merged rows, (None, 0) if the partition is empty
+	"""
+	partition_path = os.path.join(shuffle_path, f"{partition:04d}")
+	# EROS parts first (E_ files), as in merger_eros_first
+	pds = [pd.read_pickle(os.path.join(partition_path, name)) for name in sorted(os.listdir(partition_path))]
+	merged = filter_complete_stars(pd.concat(pds, ignore_index=True, sort=False), min_points) if pds else pd.DataFrame()
+	shutil.rmtree(partition_path)
+	if merged.empty:
+		return None, 0
+	merged.to_pickle(output_path, compression='bz2')
+	return output_path, len(merged)
+
+
+@contextmanager
+def local_dask_client(n_workers=1, memory_limit=OUT_OF_CORE_MEMORY_LIMIT):
+	"""
+	Client of a local dask cluster of single threaded worker processes, closed at the end of the with block
+
+	Parameters
+	----------
+	n_workers : int
+	memory_limit : str or int
+		Memory limit of each worker, over which it spills data on disk and is then paused
+
+	Yields
+	------
+	dask.distributed.Client
+	"""
+	with LocalCluster(n_workers=n_workers, threads_per_worker=1, memory_limit=memory_limit, dashboard_address=None) as cluster:
+		with Client(cluster) as client:
+			yield client
+
+
+def merger_field_out_of_core(output_dir_path, MACHO_field, EROS_field, EROS_files_path, correspondance_files_path, MACHO_files_path, n_partitions=OUT_OF_CORE_PARTITIONS, n_workers=1, memory_limit=OUT_OF_CORE_MEMORY_LIMIT, row_filter=None, sample_fraction=None, seed=0, min_points=1, client=None):
+	"""
+	Merge all the associated stars of an EROS field and a MACHO field, without loading them in memory at once
+
+	Every EROS quarter and MACHO tile containing associated stars is loaded by a task, which looks up the counterparts of its stars
+	in the association index (see load_correspondance_index) and writes its rows split by star partition, hashed on id_E.
+	Then each partition (both EROS and MACHO rows of its stars) is merged by a task and written in its own file,
+	<MACHO_field>_<EROS_field>_partXXXX.pkl. Tasks run on a local dask cluster, each worker being limited to memory_limit.
+
+	Parameters
+	----------
+	output_dir_path : str
+		Where to put the partition files
+	MACHO_field : int
+	EROS_field : str
+		EROS field, format : "lm0**"
+	n_partitions : int
+		Number of star partitions, default : OUT_OF_CORE_PARTITIONS. A partition has to fit in the memory of a worker.
+	n_workers : int
+		Number of worker processes of the local cluster, default : 1
+	memory_limit : str or int
+		Memory limit of each worker, default : OUT_OF_CORE_MEMORY_LIMIT
+	row_filter : RowFilter
+		Rows kept by the loaders, default : RowFilter()
+	sample_fraction : float
+		Merge only this fraction of the EROS stars (see merger_eros_first), default : None (all)
+	seed : int
+		Seed of the star sample, default : 0
+	min_points : int
+		Minimum number of valid points of a star in each band, default : 1
+	client : dask.distributed.Client
+		Client of an existing cluster, default : None (a local cluster is started)
+
+	Returns
+	-------
+	list(str)
+		Paths of the written partition files
+	"""
+	start = time.time()
+	if row_filter is None:
+		row_filter = RowFilter()
+	if sample_fraction is not None:
+		row_filter = row_filter.sampled(sample_fraction, seed)
+	correspondance_path = os.path.join(correspondance_files_path, str(MACHO_field)+".txt")
+	correspondance = load_correspondance_index(correspondance_path)
+
+	# Units to load : EROS quarters and MACHO tiles with associated stars
+	quarters = []
+	tiles = []
+	for ccd in range(8):
+		for quart in "klmn":
+			id_E, id_M = correspondance.eros_quarter(int(EROS_field[2:5]), ccd, quart)
+			if len(id_E):
+				quarters.append(EROS_field + str(ccd) + quart)
+				tiles.append(np.unique(macho_id_tile(id_M)))
+	if not quarters:
+		logging.error(f'No common stars in field, correspondace path : {correspondance_path}')
+		raise NameError("No common stars in field !!!!")
+	tiles = np.unique(np.concatenate(tiles))
+	logging.info(f"{len(quarters)} EROS quarters and {len(tiles)} MACHO tiles to merge in {n_partitions} partitions.")
+
+	shuffle_path = os.path.join(output_dir_path, f"shuffle_{MACHO_field}_{EROS_field}")
+	# parts left by an interrupted merge would be merged again
+	shutil.rmtree(shuffle_path, ignore_errors=True)
+	for p in range(n_partitions):
+		os.makedirs(os.path.join(shuffle_path, f"{p:04d}"), exist_ok=True)
+	shuffled = []
+	for quarter in quarters:
+		if EROS_files_path == 'irods':
+			path = os.path.join(IRODS_ROOT, quarter[:5], quarter[:6], quarter)
+		else:
+			path = os.path.join(EROS_files_path, quarter[:5], quarter+"-lc.tar.gz")
+		shuffled.append(delayed(shuffle_eros_quarter)(path, correspondance_path, shuffle_path, n_partitions, row_filter))
+	for tile in tiles:
+		shuffled.append(delayed(shuffle_macho_tile)(MACHO_files_path, MACHO_field, int(tile), correspondance_path, shuffle_path, n_partitions, row_filter))
+	merged = [delayed(merge_star_partition)(shuffle_path, p, os.path.join(output_dir_path, f"{MACHO_field}_{EROS_field}_part{p:04d}.pkl"), min_points)
+			  for p in range(n_partitions)]
+
+	with (nullcontext(client) if client is not None else local_dask_client(n_workers, memory_limit)) as client:
+		counts = np.sum(client.compute(shuffled, sync=True), axis=0)
+		logging.info(f"{counts.sum()} lines loaded, largest partition : {counts.max()} lines, {time.time()-start} seconds.")
+		# Partitions are merged once all the units are written
+		results = client.compute(merged, sync=True)
+	os.rmdir(shuffle_path)
+	paths = [path for path, nb_rows in results if path is not None]
+	logging.info(f"{sum(nb_rows for path, nb_rows in results)} lines merged in {len(paths)} partitions, {time.time()-start} seconds.")
+	return paths
@@ -0,0 +1,223 @@
+"""
+On-disk cache of remote files (EROS lightcurves from iRods, MACHO tiles from NCI), shared by the processes of a node.
+
+Files are stored under a key computed from their remote path, size and modification time, so that a modified remote file is downloaded again.
+When the cache grows over its byte budget, the least recently used files are removed, down to REMOTE_CACHE_LOW_WATER of the budget.
+Files are written in a temporary directory and moved in place atomically, and evictions are serialized with a lock file,
+so several processes can use the same cache at once.
+
+The cache is disabled unless a directory is given, or set in the REMOTE_CACHE_ENV environment variable.
+It should be on a local disk of the node : fcntl locks are not reliable on network file systems (NFS home directories).
+"""
+
+import os
+import fcntl
+import hashlib
+import logging
+import tempfile
+from contextlib import contextmanager
+
+REMOTE_CACHE_ENV = 'MERGER_REMOTE_CACHE'	# Environment variable giving the default directory of the cache
+REMOTE_CACHE_BUDGET = 50 * 1024**3		# Bytes
+REMOTE_CACHE_LOW_WATER = 0.9		# Fraction of the budget kept after an eviction, so that the next writes don't evict again
+
+_CACHES = {}
+
+
+class RemoteCache:
+	"""
+	Size bounded, least recently used, on-disk cache of remote files
+
+	Parameters
+	----------
+	path : str
+		Directory of the cache
+	budget : int
+		Maximum size of the cached files, in bytes
+	"""
+	def __init__(self, path, budget=REMOTE_CACHE_BUDGET):
+		self.path = path
+		self.budget = budget
+		self.objects_path = os.path.join(path, 'objects')
+		self.tmp_path = os.path.join(path, 'tmp')
+		self.lock_path = os.path.join(path, 'lock')
+		self.size_path = os.path.join(path, 'size')
+		os.makedirs(self.objects_path, exist_ok=True)
+		os.makedirs(self.tmp_path, exist_ok=True)
+
+	@staticmethod
+	def key(remote_path, size=None, mtime=None):
+		"""
+		Key of a remote file
+
+		Parameters
+		----------
+		remote_path : str
+		size : int
+		mtime : str or float or datetime
+			Modification time of the remote file
+
+		Returns
+		-------
+		str
+		"""
+		return hashlib.sha256(f"{remote_path}\0{size}\0{mtime}".encode()).hexdigest()
+
+	def object_path(self, key):
+		return os.path.join(self.objects_path, key[:2], key)
+
+	def open(self, key):
+		"""
+		Open a cached file, and mark it as recently used
+
+		Returns
+		-------
+		file or None
+			Binary file, None if the key is not in cache
+		"""
+		path = self.object_path(key)
+		try:
+			f = open(path, 'rb')
+		except FileNotFoundError:
+			return None
+		try:
+			os.utime(path)
+		except OSError:
+			pass
+		return f
+
+	def get(self, key):
+		"""
+		Content of a cached file
+
+		Returns
+		-------
+		bytes or None
+			None if the key is not in cache
+		"""
+		f = self.open(key)
+		if f is None:
+			return None
+		with f:
+			return f.read()
+
+	@contextmanager
+	def writer(self, key):
+		"""
+		Binary file to write a new cache entry into. The entry is added if the with block exits without error.
+		"""
+		tmp_file = tempfile.NamedTemporaryFile(dir=self.tmp_path, delete=False)
+		try:
+			yield tmp_file
+			tmp_file.close()
+		except BaseException:
+			tmp_file.close()
+			os.remove(tmp_file.name)
+			raise
+		self._store(tmp_file.name, key)
+
+	def put(self, key, data):
+		with self.writer(key) as f:
+			f.write(data)
+
+	@contextmanager
+	def _locked(self):
+		with open(self.lock_path, 'a') as lock:
+			fcntl.flock(lock, fcntl.LOCK_EX)
+			try:
+				yield
+			finally:
+				fcntl.flock(lock, fcntl.LOCK_UN)
+
+	def _read_size(self):
+		try:
+			with open(self.size_path) as f:
+				return int(f.read())
+		except (FileNotFoundError, ValueError):
+			return None
+
+	def _write_size(self, size):
+		with open(self.size_path, 'w') as f:
+			f.write(str(size))
+
+	def entries(self):
+		"""
+		Cached files
+
+		Returns
+		-------
+		list(tuple(float, int, str))
+			Last use time, size and path of each cached file
+		"""
+		entries = []
+		for subdir in os.scandir(self.objects_path):
+			if subdir.is_dir():
+				for entry in os.scandir(subdir.path):
+					try:
+						stat = entry.stat()
+					except FileNotFoundError:
+						continue
+					entries.append((stat.st_mtime, stat.st_size, entry.path))
+		return entries
+
+	def _store(self, tmp_path, key):
+		"""
+		Move a written file in place and count it in the size of the cache, minus the size of the entry it replaces.
+		If the budget is exceeded, evict the least recently used files until the cache is under REMOTE_CACHE_LOW_WATER of its budget.
+		"""
+		path = self.object_path(key)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		size = os.path.getsize(tmp_path)
+		with self._locked():
+			try:
+				size -= os.path.getsize(path)
+			except FileNotFoundError:
+				pass
+			os.replace(tmp_path, path)
+			total = self._read_size()
+			if total is not None and total + size <= self.budget:
+				self._write_size(total + size)
+				return
+			entries = sorted(self.entries())
+			total = sum(entry[1] for entry in entries)
+			if total <= self.budget:
+				self._write_size(total)
+				return
+			for mtime, entry_size, entry_path in entries:
+				if total <= self.budget * REMOTE_CACHE_LOW_WATER:
+					break
+				if os.path.basename(entry_path) == key:
+					continue
+				try:
+					os.remove(entry_path)
+				except FileNotFoundError:
+					pass
+				total -= entry_size
+			self._write_size(total)
+			logging.debug(f"Cache {self.path} : {total} bytes.")
+
+
+def get_remote_cache(cache_path=None, budget=None):
+	"""
+	Cache of the current process for a directory
+
+	Parameters
+	----------
+	cache_path : str
+		Directory of the cache, default : the REMOTE_CACHE_ENV environment variable, the cache being disabled if it is not set. '' to disable the cache.
+	budget : int
+		Maximum size of the cache in bytes, default : REMOTE_CACHE_BUDGET
+
+	Returns
+	-------
+	RemoteCache or None
+	"""
+	if cache_path is None:
+		cache_path = os.environ.get(REMOTE_CACHE_ENV, '')
+	if not cache_path:
+		return None
+	if budget is None:
+		budget = REMOTE_CACHE_BUDGET
+	if (cache_path, budget) not in _CACHES:
+		_CACHES[cache_path, budget] = RemoteCache(cache_path, budget)
+	return _CACHES[cache_path, budget]
@@ -0,0 +1,204 @@
+"""
+Integer encoding of EROS and MACHO star identifiers.
+
+MACHO identifiers "field:tile:seq" are packed in an int64 as field << 40 | tile << 20 | seq.
+EROS identifiers "lmFFFCQN..." (field, CCD, quarter and star number) are packed in an int64 as
+field << 42 | ccd << 38 | quarter << 36 | number of digits of the star number << 32 | star number,
+the number of digits keeping the leading zeros of the star number.
+
+Stars are subsampled deterministically by hashing their integer identifier (see sample_stars).
+"""
+
+import numpy as np
+import pandas as pd
+
+MACHO_SEQ_BITS = 20
+MACHO_TILE_BITS = 20
+
+EROS_NUMBER_BITS = 32
+EROS_QUARTERS = "klmn"
+
+_GOLDEN_GAMMA = 0x9E3779B97F4A7C15
+
+
+def encode_macho_id(field, tile, seq):
+	"""
+	Pack MACHO field, tile and star sequence number into int64 identifiers
+
+	Parameters
+	----------
+	field : int or np.ndarray
+	tile : int or np.ndarray
+	seq : int or np.ndarray
+
+	Returns
+	-------
+	np.int64 or np.ndarray
+	"""
+	field = np.asarray(field, dtype='i8')
+	tile = np.asarray(tile, dtype='i8')
+	seq = np.asarray(seq, dtype='i8')
+	return (field << (MACHO_TILE_BITS + MACHO_SEQ_BITS)) | (tile << MACHO_SEQ_BITS) | seq
+
+
+def macho_id_field(id_M):
+	return np.asarray(id_M, dtype='i8') >> (MACHO_TILE_BITS + MACHO_SEQ_BITS)
+
+
+def macho_id_tile(id_M):
+	return (np.asarray(id_M, dtype='i8') >> MACHO_SEQ_BITS) & ((1 << MACHO_TILE_BITS) - 1)
+
+
+def macho_id_seq(id_M):
+	return np.asarray(id_M, dtype='i8') & ((1 << MACHO_SEQ_BITS) - 1)
+
+
+def encode_macho_id_strings(ids):
+	"""
+	Encode "field:tile:seq" MACHO identifiers
+
+	Parameters
+	----------
+	ids : str or list(str) or np.ndarray or pd.Series
+
+	Returns
+	-------
+	np.int64 or np.ndarray
+	"""
+	if isinstance(ids, str):
+		return encode_macho_id(*[int(x) for x in ids.split(":")])
+	parts = pd.Series(ids, dtype=str).str.split(":", expand=True).astype('i8')
+	return encode_macho_id(parts[0].values, parts[1].values, parts[2].values)
+
+
+def decode_macho_id(id_M):
+	"""
+	Back to "field:tile:seq" MACHO identifiers
+
+	Parameters
+	----------
+	id_M : int or np.ndarray
+
+	Returns
+	-------
+	str or np.ndarray(object)
+	"""
+	if np.ndim(id_M) == 0:
+		return f"{macho_id_field(id_M)}:{macho_id_tile(id_M)}:{macho_id_seq(id_M)}"
+	keys, inverse = np.unique(np.asarray(id_M, dtype='i8'), return_inverse=True)
+	strings = np.array([f"{f}:{t}:{s}" for f, t, s in zip(macho_id_field(keys), macho_id_tile(keys), macho_id_seq(keys))], dtype=object)
+	return strings[inverse.reshape(-1)]
+
+
+def encode_eros_id_parts(field, ccd, quarter, number, width):
+	field = np.asarray(field, dtype='i8')
+	ccd = np.asarray(ccd, dtype='i8')
+	quarter = np.asarray(quarter, dtype='i8')
+	number = np.asarray(number, dtype='i8')
+	width = np.asarray(width, dtype='i8')
+	return (field << 42) | (ccd << 38) | (quarter << 36) | (width << EROS_NUMBER_BITS) | number
+
+
+def encode_eros_id(ids):
+	"""
+	Encode "lmFFFCQN..." EROS identifiers
+
+	Parameters
+	----------
+	ids : str or list(str) or np.ndarray or pd.Series
+
+	Returns
+	-------
+	np.int64 or np.ndarray
+	"""
+	if isinstance(ids, str):
+		return encode_eros_id_parts(int(ids[2:5]), int(ids[5]), EROS_QUARTERS.index(ids[6]), int(ids[7:]), len(ids) - 7)
+	ids = pd.Series(ids, dtype=str)
+	numbers = ids.str.slice(7)
+	return encode_eros_id_parts(ids.str.slice(2, 5).astype('i8').values,
+								ids.str.slice(5, 6).astype('i8').values,
+								ids.str.slice(6, 7).map({q: i for i, q in enumerate(EROS_QUARTERS)}).astype('i8').values,
+								numbers.astype('i8').values,
+								numbers.str.len().values)
+
+
+def eros_id_field(id_E):
+	return np.asarray(id_E, dtype='i8') >> 42
+
+
+def eros_id_ccd(id_E):
+	return (np.asarray(id_E, dtype='i8') >> 38) & 0xF
+
+
+def eros_id_quarter(id_E):
+	return (np.asarray(id_E, dtype='i8') >> 36) & 0x3
+
+
+def eros_id_number(id_E):
+	return np.asarray(id_E, dtype='i8') & ((1 << EROS_NUMBER_BITS) - 1)
+
+
+def _decode_eros_key(id_E):
+	width = (int(id_E) >> EROS_NUMBER_BITS) & 0xF
+	return f"lm{eros_id_field(id_E):03d}{eros_id_ccd(id_E)}{EROS_QUARTERS[eros_id_quarter(id_E)]}{eros_id_number(id_E):0{width}d}"
+
+
+def decode_eros_id(id_E):
+	"""
+	Back to "lmFFFCQN..." EROS identifiers
+
+	Parameters
+	----------
+	id_E : int or np.ndarray
+
+	Returns
+	-------
+	str or np.ndarray(object)
+	"""
+	if np.ndim(id_E) == 0:
+		return _decode_eros_key(id_E)
+	keys, inverse = np.unique(np.asarray(id_E, dtype='i8'), return_inverse=True)
+	strings = np.array([_decode_eros_key(key) for key in keys], dtype=object)
+	return strings[inverse.reshape(-1)]
+
+
+def hash_star_ids(ids, seed=0):
+	"""
+	Mix integer star identifiers into uniformly distributed 64 bits hashes (splitmix64 finalizer)
+
+	Parameters
+	----------
+	ids : int or np.ndarray
+	seed : int
+
+	Returns
+	-------
+	np.ndarray(uint64)
+	"""
+	x = np.atleast_1d(np.asarray(ids, dtype='i8')).view('u8') + np.uint64(_GOLDEN_GAMMA * (seed + 1) % 2**64)
+	x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+	x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+	return x ^ (x >> np.uint64(31))
+
+
+def sample_stars(ids, fraction, seed=0):
+	"""
+	Deterministic subsample of stars : a star is kept if the hash of its identifier is in the first "fraction" of the hash range.
+
+	The selection of a star doesn't depend on the other stars, so it is the same in every loader and on every run,
+	and the samples of a seed are nested when fraction grows.
+
+	Parameters
+	----------
+	ids : int or np.ndarray
+		Integer EROS or MACHO identifiers
+	fraction : float
+		Fraction of the stars to keep, between 0 and 1
+	seed : int
+
+	Returns
+	-------
+	np.ndarray(bool)
+	"""
+	# Compare the top 53 bits, exactly representable as floats
+	return (hash_star_ids(ids, seed) >> np.uint64(11)).astype('f8') < fraction * 2.**53
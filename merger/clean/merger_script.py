@@ -4,20 +4,85 @@
 """Script to load lightcuvres from EROS and MACHO database and save the merged result
 
 Load lightcurves from EROS and MACHO databases, load association file, that should be already computed, merge the lightcurves and save it in a pandas pickle file
+Completed units (CCD, quarter or tile) are recorded in the manifest of the output directory, and skipped by the next runs if their inputs didn't change.
 """
 
 import argparse
 import numpy as np
+import pandas as pd
 import logging
 import os
 
-from merger.clean.libraries import merger_library, iminuit_fitter
+from functools import partial
+
+from merger.clean.libraries import merger_library, iminuit_fitter, merge_manifest
 
 def dir_path_check(dirpath):
 	if not os.path.isdir(dirpath):
 		raise Exception("This directory doesn't exist : "+dirpath)
 
 
+def unit_row_filter(MACHO_field, bad_times_path=None):
+	"""
+	Row filter of the merge units of a MACHO field, and the bad timestamp files it was built from
+
+	Returns
+	-------
+	tuple(merger_library.RowFilter, list(str))
+	"""
+	if bad_times_path is None:
+		return merger_library.RowFilter(), []
+	paths = merger_library.macho_bad_times_paths(bad_times_path, MACHO_field)
+	return merger_library.RowFilter(bad_times=merger_library.load_macho_bad_times(bad_times_path, MACHO_field)), list(paths.values())
+
+
+def unit_parameters(fit, save, sample_fraction, seed, min_points, row_filter):
+	"""Parameters of a merge unit changing its outputs, recorded in the manifest"""
+	return {'fit': fit, 'save': save, 'sample_fraction': sample_fraction, 'seed': seed, 'min_points': min_points, 'row_filter': row_filter.description()}
+
+
+def fit_merged(merged, filename, output_directory):
+	iminuit_fitter.fit_all(merged=merged, filename=filename, input_dir_path=output_directory, output_dir_path=output_directory, clean=False)
+	return os.path.join(output_directory, 'res_'+filename)
+
+
+def run_eros_ccd(output_directory, MACHO_field, eros_ccd, EROS_files_path, correspondance_files_path, MACHO_files_path, quart, fit, save=False, n_workers=1, sample_fraction=None, seed=0, min_points=1, row_filter=None):
+	filename = str(MACHO_field)+"_"+str(eros_ccd)+quart+".pkl"
+	merged = merger_library.merger_eros_first(output_directory, MACHO_field, eros_ccd, EROS_files_path, correspondance_files_path, MACHO_files_path, quart=quart, save=save,
+											  n_workers=n_workers, row_filter=row_filter, sample_fraction=sample_fraction, seed=seed, min_points=min_points)
+	outputs = [os.path.join(output_directory, filename)] if save else []
+	if fit:
+		outputs.append(fit_merged(merged, filename, output_directory))
+	return outputs
+
+
+def merge_eros_ccd(output_directory, MACHO_field, eros_ccd, EROS_files_path, correspondance_files_path, MACHO_files_path, quart, fit, save=False, n_workers=1, sample_fraction=None, seed=0, min_points=1, bad_times_path=None, force=False):
+	manifest = merge_manifest.MergeManifest(output_directory)
+	row_filter, bad_times_files = unit_row_filter(MACHO_field, bad_times_path)
+	inputs = manifest.inputs(merger_library.merger_eros_first_inputs(MACHO_field, eros_ccd, EROS_files_path, correspondance_files_path, MACHO_files_path, quart) + bad_times_files,
+							 unit_parameters(fit, save, sample_fraction, seed, min_points, row_filter))
+	manifest.run(merge_manifest.unit_key(MACHO_field, eros_ccd, quart), inputs,
+				 partial(run_eros_ccd, output_directory, MACHO_field, eros_ccd, EROS_files_path, correspondance_files_path, MACHO_files_path, quart, fit, save, n_workers, sample_fraction, seed, min_points, row_filter),
+				 force=force)
+
+
+def run_macho_tile(output_directory, MACHO_field, MACHO_tile, EROS_files_path, correspondance_files_path, MACHO_files_path, fit, save=False, n_workers=1, sample_fraction=None, seed=0, min_points=1, row_filter=None):
+	merged = merger_library.merger_macho_first(output_directory, MACHO_field, EROS_files_path, correspondance_files_path, MACHO_files_path, save=save, MACHO_tile=MACHO_tile,
+											   n_workers=n_workers, row_filter=row_filter, sample_fraction=sample_fraction, seed=seed, min_points=min_points)
+	outputs = [os.path.join(output_directory, str(MACHO_field) + "_" + str(MACHO_tile) + ".bz2")] if save else []
+	if fit:
+		outputs.append(fit_merged(merged, str(MACHO_field) + "_" + str(MACHO_tile) + ".pkl", output_directory))
+	return outputs
+
+
+def run_field_out_of_core(output_directory, MACHO_field, EROS_field, EROS_files_path, correspondance_files_path, MACHO_files_path, fit, n_partitions, n_workers, memory_limit, sample_fraction=None, seed=0, min_points=1, row_filter=None):
+	outputs = merger_library.merger_field_out_of_core(output_directory, MACHO_field, EROS_field, EROS_files_path, correspondance_files_path, MACHO_files_path,
+													   n_partitions=n_partitions, n_workers=n_workers, memory_limit=memory_limit, row_filter=row_filter, sample_fraction=sample_fraction, seed=seed, min_points=min_points)
+	if fit:
+		outputs += [fit_merged(pd.read_pickle(path, compression='bz2'), os.path.basename(path), output_directory) for path in list(outputs)]
+	return outputs
+
+
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser()
 	parser.add_argument('--EROS-field', '-fE', type=str, required=True, help="something like lmXXX")
@@ -25,12 +90,23 @@ if __name__ == '__main__':
 	parser.add_argument('--MACHO-field', '-fM', type=int, required=True)
 	parser.add_argument('--output-directory', '-odir', type=str, default=merger_library.OUTPUT_DIR_PATH)
 	parser.add_argument('-fit', action='store_true')
+	parser.add_argument('--save-merged', action='store_true', help='Save the merged lightcurves of each CCD, quarter or tile (the out-of-core merge always saves its partitions)')
 	parser.add_argument('--EROS-path', '-pE', type=str, default="/Volumes/DisqueSauvegarde/EROS/lightcurves/lm/", help="'irods' for laoding from CC-IN2P3 irods")
 	parser.add_argument('--MACHO-path', '-pM', type=str, default="/Volumes/DisqueSauvegarde/MACHO/lightcurves/", help="'url' for loading from NCI")
 	parser.add_argument('--correspondance-path', '-pC', type=str, default="/Users/tristanblaineau/")
 	parser.add_argument('--quart', type=str, default="", choices=["k", "l", "m", "n"])
 	parser.add_argument('--verbose', '-v', action='store_true', help='Debug logging level')
 	parser.add_argument('--MACHO-tile', '-tM', type=int)
+	parser.add_argument('--workers', '-w', type=int, default=1, help='Number of processes loading EROS quarters, CCDs or archives concurrently. '
+																	  'When merging all CCDs, the processes left after one per CCD load the quarters of each CCD')
+	parser.add_argument('--sample-fraction', type=float, default=None, help='Merge only this fraction of the stars, the same ones on every run')
+	parser.add_argument('--seed', type=int, default=0, help='Seed of the star sample')
+	parser.add_argument('--min-points', type=int, default=1, help='Minimum number of valid points of a star in each band')
+	parser.add_argument('--out-of-core', action='store_true', help='Merge the whole field on a local dask cluster, one output file per star partition')
+	parser.add_argument('--partitions', type=int, default=merger_library.OUT_OF_CORE_PARTITIONS, help='Number of star partitions of an out-of-core merge')
+	parser.add_argument('--memory-limit', type=str, default=merger_library.OUT_OF_CORE_MEMORY_LIMIT, help='Memory limit of each dask worker of an out-of-core merge')
+	parser.add_argument('--bad-times', type=str, default=None, help='Directory of the MACHO bad timestamp files (<field>_<color>_bad_timestamps.npy), whose epochs are removed')
+	parser.add_argument('--force', action='store_true', help='Merge the units already recorded in the manifest of the output directory again')
 
 	#Retrieve arguments
 	args = parser.parse_args()
@@ -40,12 +116,20 @@ if __name__ == '__main__':
 	EROS_field = args.EROS_field
 	EROS_CCD = args.EROS_CCD
 	fit = args.fit
+	save = args.save_merged
 	EROS_files_path = args.EROS_path
 	MACHO_files_path = args.MACHO_path
 	correspondance_files_path = args.correspondance_path
 	output_directory = args.output_directory
 	quart = args.quart
 	verbose = args.verbose
+	n_workers = args.workers
+	sample_fraction = args.sample_fraction
+	seed = args.seed
+	min_points = args.min_points
+	out_of_core = args.out_of_core
+	bad_times_path = args.bad_times
+	force = args.force
 
 	if verbose:
 		logging.basicConfig(level=logging.INFO)
@@ -55,6 +139,8 @@ if __name__ == '__main__':
 
 	#Check if input paths exist
 	dir_path_check(output_directory)
+	if bad_times_path is not None:
+		dir_path_check(bad_times_path)
 	dir_path_check(correspondance_files_path)
 	if not MACHO_files_path=="url":
 		dir_path_check(MACHO_files_path)
@@ -63,20 +149,34 @@ if __name__ == '__main__':
 
 	print(fit)
 
+	manifest = merge_manifest.MergeManifest(output_directory)
+	row_filter, bad_times_files = unit_row_filter(MACHO_field, bad_times_path)
+	parameters = unit_parameters(fit, save, sample_fraction, seed, min_points, row_filter)
+
 	#Main
 	if not MACHO_tile:
-		if not EROS_CCD is None:
+		if out_of_core:
+			eros_field = "lm"+EROS_field
+			paths = list(bad_times_files)
+			for i in range(0, 8):
+				paths += merger_library.merger_eros_first_inputs(MACHO_field, eros_field+str(i), EROS_files_path, correspondance_files_path, MACHO_files_path)
+			parameters.update(partitions=args.partitions)
+			manifest.run(f"{MACHO_field}:{eros_field}:out_of_core", manifest.inputs(paths, parameters),
+						 partial(run_field_out_of_core, output_directory, MACHO_field, eros_field, EROS_files_path, correspondance_files_path, MACHO_files_path, fit,
+								 args.partitions, n_workers, args.memory_limit, sample_fraction, seed, min_points, row_filter),
+						 force=force)
+		elif not EROS_CCD is None:
 			eros_ccd = "lm"+EROS_field+str(EROS_CCD)
-			merged = merger_library.merger_eros_first(output_directory, MACHO_field, eros_ccd, EROS_files_path, correspondance_files_path, MACHO_files_path, quart=quart, save=False)
-			if fit:
-				iminuit_fitter.fit_all(merged=merged, filename=str(MACHO_field)+"_"+str(eros_ccd)+quart+".pkl", input_dir_path=output_directory, output_dir_path=output_directory)
+			merge_eros_ccd(output_directory, MACHO_field, eros_ccd, EROS_files_path, correspondance_files_path, MACHO_files_path, quart, fit, save, n_workers, sample_fraction, seed, min_points, bad_times_path, force)
 		else:
-			for i in range(0,8):
-				eros_ccd = "lm"+EROS_field+str(i)
-				merged = merger_library.merger_eros_first(output_directory, MACHO_field, eros_ccd, EROS_files_path, correspondance_files_path, MACHO_files_path, save=False)
-				if fit:
-					iminuit_fitter.fit_all(merged=merged, filename= str(MACHO_field)+"_"+str(eros_ccd)+".pkl", input_dir_path=output_directory, output_dir_path=output_directory)
+			# Up to one process per CCD, the remaining workers are shared by the CCDs to load their quarters. CCDs already merged are skipped (see merge_manifest)
+			ccd_workers = min(n_workers, 8)
+			quarter_workers = max(1, n_workers // ccd_workers)
+			args_list = [(output_directory, MACHO_field, "lm"+EROS_field+str(i), EROS_files_path, correspondance_files_path, MACHO_files_path, "", fit, save, quarter_workers, sample_fraction, seed, min_points, bad_times_path, force) for i in range(0,8)]
+			for _ in merger_library.parallel_map(merge_eros_ccd, args_list, n_workers=ccd_workers):
+				pass
 	else:
-		merged = merger_library.merger_macho_first(output_directory, MACHO_field, EROS_files_path, correspondance_files_path, MACHO_files_path, save=False, MACHO_tile=MACHO_tile)
-		if fit:
-			iminuit_fitter.fit_all(merged=merged, filename=str(MACHO_field) + "_" + str(MACHO_tile) + ".pkl", input_dir_path=output_directory, output_dir_path=output_directory)
\ No newline at end of file
+		inputs = manifest.inputs(merger_library.merger_macho_first_inputs(MACHO_field, MACHO_tile, EROS_files_path, correspondance_files_path, MACHO_files_path) + bad_times_files, parameters)
+		manifest.run(merge_manifest.unit_key(MACHO_field, MACHO_tile=MACHO_tile), inputs,
+					 partial(run_macho_tile, output_directory, MACHO_field, MACHO_tile, EROS_files_path, correspondance_files_path, MACHO_files_path, fit, save, n_workers, sample_fraction, seed, min_points, row_filter),
+					 force=force)
\ No newline at end of file
@@ -5,6 +5,7 @@ import time
 
 from merger.clean.libraries.merger_library import *
 from merger.clean.libraries.parameter_generator import Microlensing_generator
+from merger.clean.libraries.star_ids import sample_stars, encode_eros_id
 
 def microlensing_amplification(t, u0, t0, tE):
 	u = np.sqrt(u0*u0 + ((t-t0)**2)/tE/tE)
@@ -110,14 +111,13 @@ ms = pd.read_pickle(WORKING_DIR_PATH+"ms_temp_lm0322n")
 bin_baseline, bin_edges, binnumber = stats.binned_statistic(ms.dropna(subset=['bl_red_E', 'std_red_E']).bl_red_E, ms.dropna(subset=['bl_red_E', 'std_red_E']).std_red_E, bins=30, statistic='mean')
 sigmag = Sigma_Baseline(bin_edges, bin_baseline)
 
-#delete stars with at least one empty lightcurves
-merged = merged.groupby('id_E').filter(lambda x: x.red_E.count()!=0 
-	and x.red_M.count()!=0 
-	and x.blue_E.count()!=0 
-	and x.blue_M.count()!=0)
+#simulate on only x% of the lightcurves, the same ones on every run
+#old merged files have string identifiers, they are sampled on their int64 encoding
+ids = merged.id_E.values if pd.api.types.is_integer_dtype(merged.id_E) else encode_eros_id(merged.id_E.values)
+merged = merged[sample_stars(ids, 0.02, seed=12345)]
 
-#simulate on only x% of the lightcurves
-merged = merged.groupby("id_E").filter(lambda x: np.random.rand()<0.02)
+#delete stars with at least one empty lightcurves
+merged = filter_complete_stars(merged, min_points=1)
 
 g = Microlensing_generator(seed=12345)
 
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Time the loaders on generated MACHO tiles and EROS archives (see fake_data)
+
+Not collected by pytest : the results of the loaders are checked by the test modules, this script only prints timings.
+
+python -m merger.test.benchmarks [names of benchmarks]
+"""
+
+import argparse
+import os
+import tarfile
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import merger.clean.libraries.merger_library as mrgl
+from merger.test.fake_data import write_macho_tile, write_eros_archive
+from merger.test.test_macho_loaders import line_read_macho_lightcurve
+from merger.test.test_eros_loaders import line_load_eros_compressed_files
+
+
+def timed(func, *args, **kwargs):
+	st1 = time.time()
+	result = func(*args, **kwargs)
+	return result, time.time() - st1
+
+
+def macho_parser(path, nb_stars=500):
+	filename = write_macho_tile(path, 1, 3319, nb_stars=nb_stars)
+	t1, line_time = timed(line_read_macho_lightcurve, path, filename)
+	t2, columnar_time = timed(mrgl.read_macho_lightcurve, path, filename)
+	print(f'Line parser : {line_time} seconds, columnar parser : {columnar_time} seconds for {len(t2)} lines.')
+
+
+def macho_pipeline(path, nb_stars=500):
+	filename = write_macho_tile(path, 1, 3319, nb_stars=nb_stars)
+	t1, sequential_time = timed(mrgl.read_macho_lightcurve, path, filename)
+	t2, pipelined_time = timed(mrgl.read_macho_lightcurve, path, filename, pipeline=True)
+	print(f'Sequential : {sequential_time} seconds, pipelined : {pipelined_time} seconds for {len(t1)} lines.')
+
+
+def macho_tile_decompression(path, nb_stars=500, n_workers=4):
+	filename = write_macho_tile(path, 1, 3319, nb_stars=nb_stars)
+	mrgl.build_macho_tile_index(path, filename, spacing=256*1024)
+	serial, serial_time = timed(mrgl.read_macho_lightcurve, path, filename)
+	parallel, parallel_time = timed(mrgl.read_macho_lightcurve, path, filename, n_workers=n_workers)
+	print(f'1 process : {serial_time} seconds, {n_workers} processes : {parallel_time} seconds for {len(serial)} lines.')
+
+
+def macho_tiles(path, nb_tiles=4, n_workers=4):
+	os.makedirs(os.path.join(path, 'F_1'))
+	tiles = [3319 + i for i in range(nb_tiles)]
+	for tile in tiles:
+		write_macho_tile(os.path.join(path, 'F_1'), 1, tile, nb_stars=300, seed=tile)
+	for n_tiles in range(1, nb_tiles + 1):
+		serial, serial_time = timed(mrgl.load_macho_tiles, path + '/', 1, tiles[:n_tiles])
+		parallel, parallel_time = timed(mrgl.load_macho_tiles, path + '/', 1, tiles[:n_tiles], n_workers=n_workers)
+		print(f'{n_tiles} tiles : serial {serial_time} seconds, {n_workers} workers {parallel_time} seconds (x{serial_time/parallel_time:.2f}).')
+
+
+def macho_columnar(path, nb_stars=300):
+	filename = write_macho_tile(path, 1, 3319, nb_stars=nb_stars)
+	_, conversion_time = timed(mrgl.convert_macho_tile, path, filename)
+	t, reading_time = timed(mrgl.read_macho_lightcurve, path, filename)
+	print(f'Conversion : {conversion_time} seconds, columnar reading : {reading_time} seconds for {len(t)} lines.')
+
+
+def eros_parser(path, nb_stars=2000):
+	filepath, ids = write_eros_archive(path, "lm0103", "n", nb_stars=nb_stars)
+	ref, line_time = timed(line_load_eros_compressed_files, filepath)
+	t, vectorized_time = timed(mrgl.load_eros_compressed_files, filepath)
+	print(f'Line by line : {line_time} seconds, vectorized : {vectorized_time} seconds for {len(t)} lines.')
+
+
+def eros_pipeline(path, nb_stars=2000):
+	filepath, ids = write_eros_archive(path, "lm0103", "n", nb_stars=nb_stars)
+	t1, sequential_time = timed(mrgl.load_eros_compressed_files, filepath)
+	t2, pipelined_time = timed(mrgl.load_eros_compressed_files, filepath, pipeline=True)
+	print(f'Sequential : {sequential_time} seconds, pipelined : {pipelined_time} seconds for {len(t1)} lines.')
+
+
+def eros_archive_index(path, nb_stars=500):
+	filepath, ids = write_eros_archive(path, "lm0103", "k", nb_stars=nb_stars)
+	selection = ids[10:20] + ids[-3:]
+	_, noindex_time = timed(mrgl.load_eros_compressed_files, filepath, idE_list=selection)
+	mrgl.build_eros_archive_index(filepath)
+	_, index_time = timed(mrgl.load_eros_compressed_files, filepath, idE_list=selection)
+	print(f'{len(selection)} stars extracted in {noindex_time} seconds without index, {index_time} seconds with index.')
+
+
+def eros_files(path, nb_stars=2000, n_workers=4):
+	filepath, ids = write_eros_archive(path, "lm0103", "m", nb_stars=nb_stars)
+	with tarfile.open(filepath, 'r:gz') as f:
+		f.extractall(os.path.join(path, 'lm0103'))
+	t, serial_time = timed(mrgl.load_eros_files, os.path.join(path, 'lm0103'))
+	_, parallel_time = timed(mrgl.load_eros_files, os.path.join(path, 'lm0103'), n_workers=n_workers, chunk_size=300)
+	print(f'1 process : {serial_time} seconds, {n_workers} processes : {parallel_time} seconds for {len(t)} lines.')
+
+
+def eros_columnar(path, nb_stars=500):
+	filepath, ids = write_eros_archive(path, "lm0103", "l", nb_stars=nb_stars)
+	_, conversion_time = timed(mrgl.convert_eros_archive, filepath)
+	t, reading_time = timed(mrgl.load_eros_compressed_files, filepath)
+	print(f'Conversion : {conversion_time} seconds, columnar reading : {reading_time} seconds for {len(t)} lines.')
+
+
+def filter_complete_stars(path, nb_rows=1000000, nb_stars=100000):
+	rng = np.random.default_rng(0)
+	merged = pd.DataFrame({'time': rng.uniform(48000, 53000, nb_rows), 'id_E': rng.integers(0, nb_stars, nb_rows) << 8})
+	for mag, err in mrgl.EROS_BANDS + mrgl.MACHO_BANDS:
+		merged[mag] = np.where(rng.random(nb_rows) < 0.7, rng.normal(18, 1, nb_rows), np.nan)
+		merged[err] = np.where(rng.random(nb_rows) < 0.95, 0.05, np.nan)
+	for min_points in (1, 3):
+		filtered, filter_time = timed(mrgl.filter_complete_stars, merged, min_points)
+		print(f"{min_points} points : {len(filtered)} rows kept in {filter_time:.3f} seconds")
+
+
+BENCHMARKS = {func.__name__: func for func in (macho_parser, macho_pipeline, macho_tile_decompression, macho_tiles, macho_columnar,
+												eros_parser, eros_pipeline, eros_archive_index, eros_files, eros_columnar, filter_complete_stars)}
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('names', type=str, nargs='*', default=[], help="Benchmarks to run among "+", ".join(BENCHMARKS)+", default : all")
+	args = parser.parse_args()
+	if set(args.names) - set(BENCHMARKS):
+		parser.error(f"unknown benchmarks : {', '.join(set(args.names) - set(BENCHMARKS))}")
+
+	for name in args.names or BENCHMARKS:
+		print(name)
+		with tempfile.TemporaryDirectory() as path:
+			BENCHMARKS[name](path)
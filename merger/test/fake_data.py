@@ -0,0 +1,127 @@
+"""Generate small MACHO tiles and EROS archives with the layout of the original databases, for tests and benchmarks."""
+
+import gzip
+import io
+import os
+import tarfile
+
+import numpy as np
+
+MACHO_NB_FIELDS = 40
+
+
+def write_macho_tile(dirpath, field, tile, nb_stars=100, nb_epochs=(50, 500), seed=0):
+	"""
+	Write a gzipped MACHO tile F_<field>.<tile>.gz in dirpath.
+
+	Parameters
+	----------
+	dirpath : str
+	field : int
+	tile : int
+	nb_stars : int
+	nb_epochs : tuple(int, int)
+		Range of the number of points per star
+	seed : int
+
+	Returns
+	-------
+	str
+		Name of the written file
+	"""
+	rng = np.random.default_rng(seed)
+	filename = "F_" + str(field) + "." + str(tile) + ".gz"
+	counts = rng.integers(nb_epochs[0], nb_epochs[1], nb_stars)
+	n = counts.sum()
+	values = rng.uniform(0., 20., (n, MACHO_NB_FIELDS))
+	values[:, 1] = field
+	values[:, 2] = tile
+	values[:, 3] = np.repeat(np.arange(1, nb_stars + 1), counts)
+	values[:, 4] = np.concatenate([np.sort(rng.uniform(48800., 52600., c)) for c in counts])
+	values[:, 5] = np.arange(1, n + 1)
+	values[:, 10] = rng.uniform(0.001, 0.5, n)
+	values[:, 25] = rng.uniform(0.001, 0.5, n)
+	values[rng.random(n) < 0.05, 9] = -99.
+	values[rng.random(n) < 0.05, 24] = -99.
+	fmt = "lc;%d;%d;%d;%.5f;%d;" + ";".join(["%.3f"] * (MACHO_NB_FIELDS - 6))
+	lines = [fmt % tuple(row) for row in values[:, 1:].tolist()]
+	with gzip.open(os.path.join(dirpath, filename), 'wt', compresslevel=6) as f:
+		f.write("\n".join(lines) + "\n")
+	return filename
+
+
+def eros_time_file(nb_epochs, rng):
+	"""Content of one EROS .time lightcurve file"""
+	header = "# EROS2 lightcurve\n# star\n# columns : time red rederr blue blueerr\n#\n"
+	times = np.sort(rng.uniform(-1200., 2700., nb_epochs))
+	rows = [f"{t:.5f} {rng.uniform(14, 22):.3f} {rng.uniform(0.001, 0.5):.3f} {rng.uniform(14, 22):.3f} {rng.uniform(0.001, 0.5):.3f}" for t in times]
+	for i in range(len(rows)):
+		if rng.random() < 0.05:
+			rows[i] = rows[i].rsplit(' ', 2)[0] + " 99.999 9.999"
+	return (header + "\n".join(rows) + "\n").encode()
+
+
+def write_eros_archive(dirpath, eros_ccd, quart, nb_stars=100, nb_epochs=(50, 500), seed=0):
+	"""
+	Write an EROS quarter CCD archive <eros_ccd><quart>-lc.tar.gz in dirpath/<eros_ccd[:5]>.
+
+	Returns
+	-------
+	tuple(str, list(str))
+		Path of the archive and EROS identifiers of the written stars
+	"""
+	rng = np.random.default_rng(seed)
+	os.makedirs(os.path.join(dirpath, eros_ccd[:5]), exist_ok=True)
+	filepath = os.path.join(dirpath, eros_ccd[:5], eros_ccd + quart + "-lc.tar.gz")
+	ids = []
+	with tarfile.open(filepath, 'w:gz') as tar:
+		for nb in range(1, nb_stars + 1):
+			id_E = eros_ccd + quart + str(nb)
+			data = eros_time_file(rng.integers(nb_epochs[0], nb_epochs[1]), rng)
+			info = tarfile.TarInfo(os.path.join(eros_ccd + quart, id_E + ".time"))
+			info.size = len(data)
+			tar.addfile(info, io.BytesIO(data))
+			ids.append(id_E)
+	return filepath, ids
+
+
+def write_correspondance(dirpath, MACHO_field, pairs):
+	"""
+	Write the association file <MACHO_field>.txt of (id_E, id_M) pairs in dirpath
+
+	Returns
+	-------
+	str
+		Path of the written file
+	"""
+	filepath = os.path.join(dirpath, str(MACHO_field) + ".txt")
+	with open(filepath, 'w') as f:
+		for id_E, id_M in pairs:
+			f.write(f"{id_E} 80.0 -69.0 {id_M} 0.1\n")
+	return filepath
+
+
+def write_merge_inputs(dirpath, MACHO_field=1, eros_ccd="lm0103", quarts="klmn", nb_stars=20, tiles=(3319, 3320)):
+	"""
+	Write EROS archives, MACHO tiles and association file of a small merge, half of the EROS stars being associated to a MACHO star.
+
+	Returns
+	-------
+	dict
+		Paths to give to the mergers : EROS_files_path, MACHO_files_path and correspondance_files_path
+	"""
+	paths = {'EROS_files_path': os.path.join(dirpath, 'EROS'),
+			 'MACHO_files_path': os.path.join(dirpath, 'MACHO') + '/',
+			 'correspondance_files_path': os.path.join(dirpath, 'correspondance')}
+	for path in paths.values():
+		os.makedirs(path, exist_ok=True)
+	os.makedirs(os.path.join(paths['MACHO_files_path'], 'F_' + str(MACHO_field)), exist_ok=True)
+	for tile in tiles:
+		write_macho_tile(os.path.join(paths['MACHO_files_path'], 'F_' + str(MACHO_field)), MACHO_field, tile, nb_stars=nb_stars, nb_epochs=(20, 60), seed=tile)
+	pairs = []
+	for i, quart in enumerate(quarts):
+		_, ids = write_eros_archive(paths['EROS_files_path'], eros_ccd, quart, nb_stars=nb_stars, nb_epochs=(20, 60), seed=i)
+		tile = tiles[i % len(tiles)]
+		pairs += [(id_E, f"{MACHO_field}:{tile}:{seq}") for seq, id_E in enumerate(ids[::2], start=1 + (i // len(tiles)) * (nb_stars // 2))]
+	write_correspondance(paths['correspondance_files_path'], MACHO_field, pairs)
+	return paths
@@ -0,0 +1,70 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import merger.clean.libraries.merger_library as mrgl
+from merger.clean.libraries.correspondance_index import correspondance_index_path
+from merger.clean.libraries.star_ids import encode_eros_id, encode_macho_id_strings, eros_id_ccd, eros_id_quarter, macho_id_tile
+from merger.test.fake_data import write_correspondance, write_merge_inputs
+
+
+def test_correspondance_index(tmp_path):
+	pairs = [("lm0103k0012", "1:3319:5"), ("lm0103l7", "1:3320:1"), ("lm0104n42", "1:3319:2"), ("lm0103k0011", "1:12:1"), ("lm0103m9", "1:3320:3")]
+	path = write_correspondance(tmp_path, 1, pairs)
+	text = mrgl.load_correspondance(path)
+	mrgl.build_correspondance_index(path)
+	assert os.path.isdir(correspondance_index_path(path))
+	index = mrgl.load_correspondance_index(path)
+	assert isinstance(index.eros_id_E, np.memmap) and len(index) == len(pairs)
+	pd.testing.assert_frame_equal(index.to_frame(), text.sort_values('id_E', ignore_index=True))
+
+	id_E = encode_eros_id([id_E for id_E, _ in pairs])
+	id_M = encode_macho_id_strings([id_M for _, id_M in pairs])
+	assert list(index.macho_of(id_E)) == list(id_M) and list(index.eros_of(id_M)) == list(id_E)
+	assert list(index.macho_of([encode_eros_id("lm0103k1"), id_E[1], 1 << 62])) == [-1, id_M[1], -1]
+	assert list(index.eros_of(encode_macho_id_strings("1:3319:3"))) == [-1]
+
+	tile_M, tile_E = index.macho_tile(1, 3319)
+	assert list(tile_M) == sorted(id_M[macho_id_tile(id_M) == 3319]) and list(index.macho_of(tile_E)) == list(tile_M)
+	assert not len(index.macho_tile(1, 3318)[0])
+	ccd_E, ccd_M = index.eros_quarter(10, 3)
+	assert set(ccd_E) == set(id_E[:2]) | set(id_E[3:]) and list(ccd_E) == sorted(ccd_E)
+	quarter_E, _ = index.eros_quarter(10, 3, 'k')
+	assert set(quarter_E) == set(id_E[[0, 3]])
+	assert list(index.eros_quarter(10, 4, 'n')[0]) == [id_E[2]] and list(index.eros_quarter(10, 3, 'l')[0]) == [id_E[1]]
+	assert (eros_id_quarter(index.eros_quarter(10, 3, 'm')[0]) == 2).all() and (eros_id_ccd(index.eros_quarter(10, 4)[0]) == 4).all()
+
+	write_correspondance(tmp_path, 2, pairs + [("lm0103l7", "1:3320:9")])
+	with pytest.raises(ValueError):
+		mrgl.build_correspondance_index(os.path.join(tmp_path, "2.txt"))
+
+
+def test_merge_with_index(tmp_path):
+	paths = write_merge_inputs(tmp_path)
+	eros_first = mrgl.merger_eros_first(str(tmp_path), 1, "lm0103", save=False, **paths)
+	macho_first = mrgl.merger_macho_first(str(tmp_path), 1, save=False, MACHO_tile=3319, **paths)
+	correspondance_path = os.path.join(paths['correspondance_files_path'], "1.txt")
+	mrgl.build_correspondance_index(correspondance_path)
+	pd.testing.assert_frame_equal(mrgl.merger_eros_first(str(tmp_path), 1, "lm0103", save=False, **paths), eros_first)
+	pd.testing.assert_frame_equal(mrgl.merger_macho_first(str(tmp_path), 1, save=False, MACHO_tile=3319, **paths), macho_first)
+
+	# Same rows and columns as a merge with the association file
+	macho_lcs = mrgl.load_macho_tiles(paths['MACHO_files_path'], 1, [3319, 3320], row_filter=mrgl.RowFilter())
+	expected = macho_lcs.merge(mrgl.load_correspondance(correspondance_path), on='id_M', validate="m:1")
+	index = mrgl.load_correspondance_index(correspondance_path)
+	pd.testing.assert_frame_equal(mrgl.add_counterparts(macho_lcs, index.eros_of(macho_lcs.id_M.values), 'id_E'), expected)
+	with pytest.raises(NameError):
+		mrgl.merger_eros_first(str(tmp_path), 1, "lm0104", save=False, **paths)
+
+	# New association file : the index of the old one is not used anymore
+	with open(correspondance_path) as f:
+		lines = f.readlines()
+	with open(correspondance_path, 'w') as f:
+		f.writelines(lines[:3])
+	assert not isinstance(mrgl.load_correspondance_index(correspondance_path).eros_id_E, np.memmap)
+	assert mrgl.merger_eros_first(str(tmp_path), 1, "lm0103", save=False, **paths).id_E.nunique() == 3
+	mrgl.build_correspondance_index(correspondance_path)
+	index = mrgl.load_correspondance_index(correspondance_path)
+	assert isinstance(index.eros_id_E, np.memmap) and len(index) == 3
@@ -1,6 +1,13 @@
-import os, time
+import io, os, tarfile, threading, time, types
+
+import numpy as np
+import pandas as pd
+import pytest
 
 import merger.clean.libraries.merger_library as mrgl
+from merger.clean.libraries.star_ids import encode_eros_id, sample_stars
+from merger.test.fake_data import eros_time_file, write_eros_archive
+from irods.exception import DataObjectDoesNotExist
 
 #Load test EROS
 
@@ -20,4 +27,241 @@ def test_loading_eros(irods=False):
 	print(f'Compressed reading time : {st2-st1} seconds for {len(t1)} lines.')
 	print(f'.time reading time : {st3-st2} seconds for {len(t2)} lines.')
 	if irods:
-		print(f'iRods reading time : {st4-st3} seconds for {len(t3)} lines.')
\ No newline at end of file
+		print(f'iRods reading time : {st4-st3} seconds for {len(t3)} lines.')
+
+
+def test_pipeline(tmp_path, nb_stars=300):
+	filepath, ids = write_eros_archive(tmp_path, "lm0103", "n", nb_stars=nb_stars)
+	t1 = mrgl.load_eros_compressed_files(filepath)
+	assert t1.equals(mrgl.load_eros_compressed_files(filepath, pipeline=True))
+	assert t1.id_E.nunique() == nb_stars
+
+
+def line_load_eros_compressed_files(filepath):
+	"""Line by line reader, as done before the vectorized parser"""
+	lc = {"time":[], "red_E":[], "rederr_E":[], "blue_E":[], "blueerr_E":[], "id_E":[]}
+	with tarfile.open(filepath, 'r:gz') as f:
+		for member in f.getmembers():
+			lcf = f.extractfile(member)
+			if lcf:
+				id_E = encode_eros_id(member.name.split("/")[-1][:-5])
+				for line in lcf.readlines()[4:]:
+					line = line.split()
+					lc["time"].append(float(line[0])+49999.5)
+					lc["red_E"].append(float(line[1]))
+					lc["rederr_E"].append(float(line[2]))
+					lc["blue_E"].append(float(line[3]))
+					lc["blueerr_E"].append(float(line[4]))
+					lc["id_E"].append(id_E)
+	return pd.DataFrame.from_dict(lc)
+
+
+def test_eros_parser(tmp_path, nb_stars=300):
+	filepath, ids = write_eros_archive(tmp_path, "lm0103", "n", nb_stars=nb_stars)
+	ref = line_load_eros_compressed_files(filepath)
+	pd.testing.assert_frame_equal(ref, mrgl.load_eros_compressed_files(filepath))
+	with tarfile.open(filepath, 'r:gz') as f:
+		f.extractall(tmp_path / 'lm0103n')
+	t2 = mrgl.load_eros_files(str(tmp_path / 'lm0103n'))
+	pd.testing.assert_frame_equal(t2.sort_values(['id_E', 'time'], ignore_index=True), ref.sort_values(['id_E', 'time'], ignore_index=True))
+	one = mrgl.read_eros_lighcurve(str(tmp_path / 'lm0103n' / 'lm0103n' / (ids[0] + '.time')))
+	pd.testing.assert_frame_equal(one, ref[ref.id_E == encode_eros_id(ids[0])])
+	assert len(mrgl.parse_eros_time(b"#\n#\n#\n#\n")) == 0
+	header = b"#\n#\n#\n#\n"
+	assert mrgl.parse_eros_time(header + b"1. 2. 3. 4. 5.\n6. 7. 8. 9. 10.\n").shape == (2, 5)
+	for rows in [b"1. 2. 3. 4. 5. 6. 7. 8. 9. 10.\n", b"1. 2. 3. 4. 5.\n6. 7. 8. 9.\n10. 11. 12. 13. 14. 15.\n", b"1. 2. 3. 4. 5.\n6. 7. nan?\n"]:
+		with pytest.raises(ValueError):
+			mrgl.parse_eros_time(header + rows)
+
+
+def test_archive_index(tmp_path, nb_stars=500):
+	filepath, ids = write_eros_archive(tmp_path, "lm0103", "k", nb_stars=nb_stars)
+	ref = mrgl.load_eros_compressed_files(filepath)
+	selection = ids[10:20] + ids[-3:] + ["lm0103k99999"]
+	expected = ref[ref.id_E.isin(encode_eros_id(selection))].reset_index(drop=True)
+	noindex = mrgl.load_eros_compressed_files(filepath, idE_list=selection)
+	pd.testing.assert_frame_equal(noindex, expected)
+	members = mrgl.build_eros_archive_index(filepath, spacing=64*1024)
+	assert len(members) == nb_stars
+	assert (members['id_E'] == encode_eros_id(ids)).all()
+	indexed = mrgl.load_eros_compressed_files(filepath, idE_list=encode_eros_id(selection))
+	pd.testing.assert_frame_equal(indexed, expected)
+	pd.testing.assert_frame_equal(mrgl.load_eros_compressed_files(filepath, idE_list=selection[::-1], pipeline=True), expected)
+
+	# A new archive : the offsets of the old one would extract wrong bytes
+	filepath, ids = write_eros_archive(tmp_path, "lm0103", "k", nb_stars=nb_stars // 2, seed=1)
+	assert mrgl.load_eros_archive_index(filepath) is None
+	ref = mrgl.load_eros_compressed_files(filepath, use_index=False)
+	pd.testing.assert_frame_equal(mrgl.load_eros_compressed_files(filepath, idE_list=ids[10:20]), ref[ref.id_E.isin(encode_eros_id(ids[10:20]))].reset_index(drop=True))
+
+
+class FakeIrodsObject:
+	def __init__(self, session, path):
+		self.session = session
+		self.path = path
+		self.size = len(session.files[path])
+		self.modify_time = 0
+
+	def open(self, mode):
+		return io.BytesIO(self.session.read(self.path))
+
+
+class FakeIrodsSession:
+	"""
+	In memory iRods session
+
+	Parameters
+	----------
+	files : dict
+		Content of the data objects, by path
+	behaviours : dict
+		For some paths, list of what the successive reads do : a delay in seconds, or an exception to raise
+	"""
+	def __init__(self, files, behaviours=None, lock=None, calls=None):
+		self.files = files
+		self.behaviours = behaviours if behaviours is not None else {}
+		self.lock = lock if lock is not None else threading.Lock()
+		self.calls = calls if calls is not None else []
+		self.data_objects = self
+		self.collections = self
+		self.closed = False
+
+	def get(self, path):
+		if path in self.files:
+			return FakeIrodsObject(self, path)
+		names = [p.split('/')[-1] for p in self.files if os.path.dirname(p) == path]
+		if names:
+			return types.SimpleNamespace(data_objects=[types.SimpleNamespace(name=name) for name in names])
+		raise DataObjectDoesNotExist(path)
+
+	def read(self, path):
+		with self.lock:
+			self.calls.append(path)
+			behaviour = self.behaviours.get(path, [])
+			behaviour = behaviour.pop(0) if behaviour else 0
+		if isinstance(behaviour, Exception):
+			raise behaviour
+		time.sleep(behaviour)
+		return self.files[path]
+
+	def cleanup(self):
+		self.closed = True
+
+
+def fake_irods(nb_stars=30, behaviours=None, seed=0):
+	rng = np.random.default_rng(seed)
+	ids = ["lm0103k" + str(nb) for nb in range(1, nb_stars + 1)]
+	files = {os.path.join(mrgl.IRODS_ROOT, "lm010", "lm0103", "lm0103k", id_E + ".time"): eros_time_file(rng.integers(10, 50), rng) for id_E in ids}
+	sessions = []
+	calls = []
+	lock = threading.Lock()
+
+	def session_factory():
+		sessions.append(FakeIrodsSession(files, behaviours, lock, calls))
+		return sessions[-1]
+	return ids, files, session_factory, sessions, calls
+
+
+def test_irods_fetcher(tmp_path):
+	ids, files, session_factory, sessions, calls = fake_irods()
+	paths = list(files)
+	ref = mrgl.eros_lightcurves_to_frame([mrgl.parse_eros_time(files[path]) for path in paths], encode_eros_id(ids))
+	t1 = mrgl.load_irods_eros_lightcurves(idE_list=encode_eros_id(ids), n_workers=4, session_factory=session_factory, cache_path='')
+	pd.testing.assert_frame_equal(t1, ref)
+	assert len(calls) == len(paths) and len(sessions) <= 8 and all(session.closed for session in sessions)
+	t2 = mrgl.load_irods_eros_lightcurves(os.path.dirname(paths[0]), n_workers=4, session_factory=session_factory, cache_path=str(tmp_path / 'cache'))
+	pd.testing.assert_frame_equal(t2, ref)
+	assert len(calls) == 2 * len(paths)
+
+	# Second load from the cache
+	t2 = mrgl.load_irods_eros_lightcurves(os.path.dirname(paths[0]), n_workers=4, session_factory=session_factory, cache_path=str(tmp_path / 'cache'))
+	pd.testing.assert_frame_equal(t2, ref)
+	assert len(calls) == 2 * len(paths)
+
+	# Missing file : logged and skipped, the other stars are kept
+	t3 = mrgl.load_irods_eros_lightcurves(idE_list=ids[:5] + ["lm0103k999"], n_workers=4, session_factory=session_factory, cache_path='')
+	pd.testing.assert_frame_equal(t3, ref[ref.id_E.isin(encode_eros_id(ids[:5]))])
+
+
+def test_irods_fetcher_failures():
+	behaviours = {}
+	ids, files, session_factory, sessions, calls = fake_irods(behaviours=behaviours)
+	paths = list(files)
+	behaviours[paths[0]] = [OSError("connection reset"), OSError("connection reset")]	# Retried
+	behaviours[paths[1]] = [5.]		# Hedged
+	behaviours[paths[2]] = [OSError("connection reset")] * 4	# More failures than retries
+	behaviours[paths[3]] = [0.5, 0.5]		# Slow, answered by the first of the two reads
+	st1 = time.time()
+	contents = mrgl.fetch_irods_objects(paths, session_factory=session_factory, n_workers=4, timeout=0.8, retries=3, backoff=0.01, hedge_after=0.2, cache_path='')
+	assert time.time() - st1 < 4.
+	assert set(contents) == set(paths) - {paths[2]}
+	assert all(contents[path] == files[path] for path in contents)
+	assert calls.count(paths[0]) == 3 and calls.count(paths[1]) == 2 and calls.count(paths[2]) == 4
+
+
+def test_columnar_store(tmp_path, nb_stars=500):
+	filepath, ids = write_eros_archive(tmp_path, "lm0103", "l", nb_stars=nb_stars)
+	ref = mrgl.load_eros_compressed_files(filepath)
+	mrgl.convert_eros_archive(filepath)
+	t = mrgl.load_eros_compressed_files(filepath)
+	pd.testing.assert_frame_equal(t, ref)
+	selection = ids[100:110] + [ids[3]]
+	sub = mrgl.load_eros_compressed_files(filepath, idE_list=selection)
+	pd.testing.assert_frame_equal(sub, ref[ref.id_E.isin(encode_eros_id(selection))].reset_index(drop=True))
+
+	# A new archive is read instead of the columns of the old one, until it is converted again
+	filepath, ids = write_eros_archive(tmp_path, "lm0103", "l", nb_stars=nb_stars // 2, seed=1)
+	assert not mrgl.is_current_columnar(mrgl.eros_columnar_path(filepath), filepath)
+	ref = mrgl.load_eros_compressed_files(filepath, use_index=False)
+	assert ref.id_E.nunique() == nb_stars // 2
+	pd.testing.assert_frame_equal(mrgl.load_eros_compressed_files(filepath), ref)
+	mrgl.convert_eros_archive(filepath)
+	assert mrgl.is_current_columnar(mrgl.eros_columnar_path(filepath), filepath)
+	pd.testing.assert_frame_equal(mrgl.load_eros_compressed_files(filepath), ref)
+
+
+def test_parallel_eros_files(tmp_path, nb_stars=600):
+	filepath, ids = write_eros_archive(tmp_path, "lm0103", "m", nb_stars=nb_stars)
+	with tarfile.open(filepath, 'r:gz') as f:
+		f.extractall(tmp_path / 'lm0103')
+	ref = mrgl.load_eros_compressed_files(filepath).sort_values(['id_E', 'time'], ignore_index=True)
+	assert len(mrgl.scan_eros_files(str(tmp_path / 'lm0103'))) == nb_stars
+	for n_workers in (1, 4):
+		t = mrgl.load_eros_files(str(tmp_path / 'lm0103'), n_workers=n_workers, chunk_size=100)
+		pd.testing.assert_frame_equal(t.sort_values(['id_E', 'time'], ignore_index=True), ref)
+	os.makedirs(tmp_path / 'empty')
+	assert len(mrgl.load_eros_files(str(tmp_path / 'empty'))) == 0
+
+
+def test_row_filter(tmp_path):
+	filepath, ids = write_eros_archive(tmp_path, "lm0103", "k", nb_stars=100)
+	ref = mrgl.load_eros_compressed_files(filepath)
+	row_filter = mrgl.RowFilter(time_range=(50000., 52000.))
+	expected = ref[ref.time.between(50000., 52000.)].copy()
+	for mag, err in mrgl.EROS_BANDS:
+		invalid = expected[mag].isin([99.999, -99.]) | ~expected[err].between(0, 9.999, inclusive='neither')
+		expected.loc[invalid, [mag, err]] = np.nan
+	expected = expected.dropna(axis=0, how='all', subset=['red_E', 'blue_E']).reset_index(drop=True)
+	assert expected.blue_E.isnull().any()
+	pd.testing.assert_frame_equal(mrgl.load_eros_compressed_files(filepath, row_filter=row_filter), expected)
+	selection = encode_eros_id(ids[:10])
+	pd.testing.assert_frame_equal(mrgl.load_eros_compressed_files(filepath, idE_list=selection, row_filter=row_filter),
+								  expected[expected.id_E.isin(selection)].reset_index(drop=True))
+	mrgl.convert_eros_archive(filepath)
+	pd.testing.assert_frame_equal(mrgl.load_eros_compressed_files(filepath, row_filter=row_filter), expected)
+
+
+def test_star_sample(tmp_path):
+	filepath, ids = write_eros_archive(tmp_path, "lm0103", "k", nb_stars=100)
+	ref = mrgl.load_eros_compressed_files(filepath)
+	row_filter = mrgl.RowFilter(valid_mag=False, sample_fraction=0.1, seed=5)
+	expected = ref[sample_stars(ref.id_E.values, 0.1, seed=5)].reset_index(drop=True)
+	assert 0 < expected.id_E.nunique() < 100
+	pd.testing.assert_frame_equal(mrgl.load_eros_compressed_files(filepath, row_filter=row_filter), expected)
+	mrgl.build_eros_archive_index(filepath)
+	pd.testing.assert_frame_equal(mrgl.load_eros_compressed_files(filepath, row_filter=row_filter), expected)
+	selection = encode_eros_id(ids[:50])
+	pd.testing.assert_frame_equal(mrgl.load_eros_compressed_files(filepath, idE_list=selection, row_filter=row_filter),
+								  expected[expected.id_E.isin(selection)].reset_index(drop=True))
+	mrgl.convert_eros_archive(filepath)
+	pd.testing.assert_frame_equal(mrgl.load_eros_compressed_files(filepath, row_filter=row_filter), expected)
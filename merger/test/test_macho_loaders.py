@@ -1,5 +1,17 @@
 import merger.clean.libraries.merger_library as mrgl
+import merger.clean.libraries.remote_cache as remote_cache
+import gzip
 import os, time
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from merger.clean.libraries.star_ids import encode_macho_id_strings, sample_stars
+from merger.test.fake_data import write_macho_tile
 
 INPUT_PATH = '/Volumes/DisqueSauvegarde/MACHO/lightcurves'
 
@@ -13,4 +25,305 @@ def test_loading_macho(url=False):
 
 	print(f'Compressed reading time : {st2-st1} seconds for {len(t1)} lines.')
 	if url:
-		print(f'url reading time : {st3-st2} seconds for {len(t2)} lines.')
\ No newline at end of file
+		print(f'url reading time : {st3-st2} seconds for {len(t2)} lines.')
+
+
+def line_read_macho_lightcurve(filepath, filename):
+	"""Line by line parser, as used before the columnar one. Used as reference."""
+	lc = list()
+	with gzip.open(os.path.join(filepath, filename), 'rt') as f:
+		for line in f:
+			line = line.split(';')
+			lc.append((float(line[4]), float(line[9]), float(line[10]), float(line[24]), float(line[25]), line[1] + ":" + line[2] + ":" + line[3]))
+	lc = np.array(lc, dtype=[('time', 'f8'), ('red_M', 'f8'), ('rederr_M', 'f8'), ('blue_M', 'f8'), ('blueerr_M', 'f8'), ('id_M', 'U13')])
+	return pd.DataFrame.from_records(lc)
+
+
+def test_columnar_parser(tmp_path, monkeypatch):
+	filename = write_macho_tile(tmp_path, 1, 3319, nb_stars=30)
+	ref = line_read_macho_lightcurve(tmp_path, filename)
+	monkeypatch.setattr(mrgl, 'MACHO_BLOCK_SIZE', 4096)
+	t = mrgl.read_macho_lightcurve(tmp_path, filename)
+	sub = mrgl.read_macho_lightcurve(tmp_path, filename, star_nb_start=4, star_nb_stop=11)
+	assert np.array_equal(t[['time', 'red_M', 'rederr_M', 'blue_M', 'blueerr_M']].values, ref[['time', 'red_M', 'rederr_M', 'blue_M', 'blueerr_M']].values)
+	assert (t.id_M.values == encode_macho_id_strings(ref.id_M.values)).all()
+	ids = t.id_M.unique()
+	assert (sub.id_M.unique() == ids[4:12]).all()
+	assert len(sub) == t.id_M.isin(ids[4:12]).sum()
+
+
+def test_tile_index(tmp_path):
+	filename = write_macho_tile(tmp_path, 1, 3319, nb_stars=60)
+	ref = mrgl.read_macho_lightcurve(tmp_path, filename)
+	offsets = mrgl.build_macho_tile_index(tmp_path, filename, spacing=64*1024)
+	assert len(offsets) == ref.id_M.nunique() + 1
+	ids = ref.id_M.unique()
+	for start, stop in [(0, 5), (17, 17), (40, -1), (55, 80)]:
+		sub = mrgl.read_macho_lightcurve(tmp_path, filename, star_nb_start=start, star_nb_stop=stop)
+		nosub = mrgl.read_macho_lightcurve(tmp_path, filename, star_nb_start=start, star_nb_stop=stop, use_index=False)
+		expected = ids[start:] if stop < 0 else ids[start:stop+1]
+		assert (sub.id_M.unique() == expected).all()
+		assert sub.equals(nosub)
+		assert sub.equals(ref[ref.id_M.isin(expected)].reset_index(drop=True))
+
+
+def test_parallel_tile_decompression(tmp_path, n_workers=4):
+	filename = write_macho_tile(tmp_path, 1, 3319, nb_stars=500)
+	mrgl.build_macho_tile_index(tmp_path, filename, spacing=256*1024)
+	offsets = mrgl.load_macho_tile_index(tmp_path, filename)
+	chunks = mrgl.split_macho_tile(offsets, n_workers)
+	assert chunks[0][0] == 0 and chunks[-1][1] == len(offsets) - 2
+	assert all(prev[1] + 1 == nxt[0] for prev, nxt in zip(chunks[:-1], chunks[1:]))
+	assert mrgl.split_macho_tile(offsets, n_workers, 10, 11) == [(10, 10), (11, 11)]
+	serial = mrgl.read_macho_lightcurve(tmp_path, filename)
+	parallel = mrgl.read_macho_lightcurve(tmp_path, filename, n_workers=n_workers)
+	assert serial.equals(parallel)
+	sub = mrgl.read_macho_lightcurve(tmp_path, filename, star_nb_start=100, star_nb_stop=199, n_workers=n_workers)
+	assert sub.equals(mrgl.read_macho_lightcurve(tmp_path, filename, star_nb_start=100, star_nb_stop=199))
+
+
+def test_parallel_tiles(tmp_path, nb_tiles=4, n_workers=4):
+	os.makedirs(tmp_path / 'F_1')
+	tiles = [3319 + i for i in range(nb_tiles)]
+	for tile in tiles:
+		write_macho_tile(tmp_path / 'F_1', 1, tile, nb_stars=100, seed=tile)
+	serial = mrgl.load_macho_tiles(str(tmp_path) + '/', 1, tiles)
+	assert serial.equals(mrgl.load_macho_tiles(str(tmp_path) + '/', 1, tiles, n_workers=n_workers, max_inflight=2))
+	field = mrgl.load_macho_field(str(tmp_path) + '/', 1, n_workers=n_workers)
+	assert field.sort_values(['id_M', 'time'], ignore_index=True).equals(serial.sort_values(['id_M', 'time'], ignore_index=True))
+
+
+def test_iter_macho_stars(tmp_path, monkeypatch):
+	filename = write_macho_tile(tmp_path, 1, 3319, nb_stars=40)
+	ref = mrgl.read_macho_lightcurve(tmp_path, filename)
+	monkeypatch.setattr(mrgl, 'MACHO_BLOCK_SIZE', 4096)
+	stars = list(mrgl.iter_macho_stars(tmp_path, filename))
+	assert [id_M for id_M, lc in stars] == list(ref.id_M.unique())
+	for id_M, lc in stars:
+		sub = ref[ref.id_M == id_M]
+		for name, values in lc.items():
+			assert np.array_equal(values, sub[name].values)
+
+
+def test_manifest_partition(tmp_path, monkeypatch):
+	os.makedirs(tmp_path / 'F_1')
+	tiles = [3319, 3320, 3321]
+	for tile, nb_stars, nb_epochs in zip(tiles, [30, 10, 20], [(10, 20), (400, 500), (50, 100)]):
+		write_macho_tile(tmp_path / 'F_1', 1, tile, nb_stars=nb_stars, nb_epochs=nb_epochs, seed=tile)
+	manifest = mrgl.build_macho_field_manifest(tmp_path, 1, output_path=tmp_path)
+	assert list(manifest['tile']) == tiles
+	assert list(manifest['star_count']) == [30, 10, 20]
+	assert list(manifest['first_star']) == [1, 1, 1] and list(manifest['last_star']) == [30, 10, 20]
+
+	jobs = mrgl.partition_macho_jobs(manifest, 4, weight='rows')
+	stars = [(tile, nb) for job in jobs for tile, start, stop in job for nb in range(start, stop+1)]
+	assert stars == [(tile, nb) for tile, count in zip(tiles, [30, 10, 20]) for nb in range(count)]
+	rows = [sum(manifest['row_count'][tiles.index(tile)] / manifest['star_count'][tiles.index(tile)] * (stop-start+1) for tile, start, stop in job) for job in jobs]
+	assert max(rows) < 1.5 * manifest['row_count'].sum() / 4
+
+	monkeypatch.setattr(mrgl, 'STAR_COUNT_PATH', str(tmp_path))
+	monkeypatch.setattr(mrgl, 'STARS_PER_JOBS', 15)
+	full = mrgl.read_macho_lightcurve(tmp_path / 'F_1', 'F_1.3320.gz')
+	loaded = pd.concat([mrgl.load_macho_stars(tmp_path, 1, t_indice) for t_indice in range(1, 5)])
+	assert len(loaded) == manifest['row_count'].sum()
+	assert set(full.id_M) <= set(loaded.id_M)
+
+	# As many jobs as stars : the shards between the stars of tile 3320, ~30 times heavier than the ones of 3319, are empty
+	monkeypatch.setattr(mrgl, 'STARS_PER_JOBS', 1)
+	shards = [mrgl.load_macho_stars(tmp_path, 1, t_indice) for t_indice in range(1, 61)]
+	assert any(shard.empty for shard in shards)
+	assert all(list(shard.columns) == mrgl.MACHO_COLUMNS + ['id_M'] for shard in shards)
+	assert len(pd.concat(shards)) == manifest['row_count'].sum()
+	for t_indice in (0, 61):
+		with pytest.raises(ValueError):
+			mrgl.load_macho_stars(tmp_path, 1, t_indice)
+
+
+class CountingHandler(SimpleHTTPRequestHandler):
+	requested = []
+	fail_head = False
+
+	def log_message(self, *args):
+		pass
+
+	def do_GET(self):
+		CountingHandler.requested.append(self.path)
+		super().do_GET()
+
+	def do_HEAD(self):
+		if CountingHandler.fail_head:
+			self.send_error(503)
+		else:
+			super().do_HEAD()
+
+
+def test_load_macho_from_url(tmp_path, monkeypatch):
+	os.makedirs(tmp_path / 'server' / 'F_1')
+	tiles = [3319, 3320, 3321]
+	for tile in tiles:
+		write_macho_tile(tmp_path / 'server' / 'F_1', 1, tile, nb_stars=20, seed=tile)
+	with open(tmp_path / 'server' / 'F_1' / 'F_1.9999.gz', 'w') as f:
+		f.write('Not found')
+	with open(tmp_path / 'server' / 'F_1' / 'F_1.3319.gz', 'rb') as f:
+		data = f.read()
+	with open(tmp_path / 'server' / 'F_1' / 'F_1.9998.gz', 'wb') as f:
+		f.write(data[:len(data) // 2])
+	ref = mrgl.load_macho_tiles(str(tmp_path / 'server') + '/', 1, tiles)
+	server = ThreadingHTTPServer(('127.0.0.1', 0), partial(CountingHandler, directory=str(tmp_path / 'server')))
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	monkeypatch.setattr(mrgl, 'MACHO_URL', f'http://127.0.0.1:{server.server_port}/')
+	monkeypatch.setenv(remote_cache.REMOTE_CACHE_ENV, str(tmp_path / 'cache'))
+	try:
+		CountingHandler.requested = []
+		t1 = mrgl.load_macho_tiles('url', 1, tiles)
+		assert len(CountingHandler.requested) == len(tiles)
+		t2 = mrgl.load_macho_tiles('url', 1, tiles)
+		assert len(CountingHandler.requested) == len(tiles)
+		assert mrgl.load_macho_from_url('F_1.9999.gz') is None
+		assert len(remote_cache.get_remote_cache().entries()) == len(tiles)
+		assert not os.listdir(tmp_path / 'cache' / 'tmp')
+		t3 = mrgl.load_macho_from_url('F_1.3320.gz', cache_path='')
+		assert len(CountingHandler.requested) == len(tiles) + 2
+		# Modified remote tile : downloaded again
+		write_macho_tile(tmp_path / 'server' / 'F_1', 1, 3321, nb_stars=10, seed=0)
+		os.utime(tmp_path / 'server' / 'F_1' / 'F_1.3321.gz', (0, 0))
+		t4 = mrgl.load_macho_from_url('F_1.3321.gz')
+		assert len(CountingHandler.requested) == len(tiles) + 3
+		# Headers not available : downloaded without the cache
+		CountingHandler.fail_head = True
+		t5 = mrgl.load_macho_from_url('F_1.3320.gz')
+		assert len(CountingHandler.requested) == len(tiles) + 4 and t5.equals(t3)
+		assert len(remote_cache.get_remote_cache().entries()) == len(tiles) + 1
+		# Truncated tile : not parsed as a shorter one, nor cached
+		CountingHandler.fail_head = False
+		assert mrgl.load_macho_from_url('F_1.9998.gz') is None
+		assert len(remote_cache.get_remote_cache().entries()) == len(tiles) + 1
+		assert not os.listdir(tmp_path / 'cache' / 'tmp')
+	finally:
+		CountingHandler.fail_head = False
+		server.shutdown()
+	assert t1.equals(ref) and t2.equals(ref)
+	assert t3.equals(mrgl.read_macho_lightcurve(tmp_path / 'server' / 'F_1', 'F_1.3320.gz'))
+	assert t4.equals(mrgl.read_macho_lightcurve(tmp_path / 'server' / 'F_1', 'F_1.3321.gz'))
+
+
+def test_column_projection(tmp_path):
+	filename = write_macho_tile(tmp_path, 1, 3319, nb_stars=10)
+	columns = mrgl.MACHO_COLUMNS + ['red_amp', 'blue_amp', 'observation_id']
+	t = mrgl.read_macho_lightcurve(tmp_path, filename, columns=columns)
+	assert list(t.columns) == columns + ['id_M']
+	with gzip.open(os.path.join(tmp_path, filename), 'rt') as f:
+		lines = [line.split(';') for line in f]
+	assert np.array_equal(t.red_amp.values, [float(line[17]) for line in lines])
+	assert np.array_equal(t.blue_amp.values, [float(line[32]) for line in lines])
+	assert np.array_equal(t.observation_id.values, [int(line[5]) for line in lines])
+	assert list(mrgl.read_macho_lightcurve(tmp_path, filename, columns=['time']).columns) == ['time', 'id_M']
+
+
+def test_pipeline(tmp_path, monkeypatch, nb_stars=200):
+	filename = write_macho_tile(tmp_path, 1, 3319, nb_stars=nb_stars)
+	t1 = mrgl.read_macho_lightcurve(tmp_path, filename)
+	assert t1.equals(mrgl.read_macho_lightcurve(tmp_path, filename, pipeline=True))
+	monkeypatch.setattr(mrgl, 'MACHO_BLOCK_SIZE', 64*1024)
+	sub = mrgl.read_macho_lightcurve(tmp_path, filename, star_nb_stop=3, pipeline=True)
+	assert sub.equals(mrgl.read_macho_lightcurve(tmp_path, filename, star_nb_stop=3))
+
+
+def test_columnar_store(tmp_path, monkeypatch, nb_stars=300):
+	filename = write_macho_tile(tmp_path, 1, 3319, nb_stars=nb_stars)
+	columns = mrgl.MACHO_COLUMNS + ['red_amp', 'observation_id']
+	ref = mrgl.read_macho_lightcurve(tmp_path, filename, columns=columns)
+	ref_stars = list(mrgl.iter_macho_stars(tmp_path, filename))
+	mrgl.convert_macho_tile(tmp_path, filename)
+	assert os.path.isdir(tmp_path / 'F_1.3319.cols')
+	t = mrgl.read_macho_lightcurve(tmp_path, filename, columns=columns)
+	assert t.equals(ref)
+	with monkeypatch.context() as m:
+		m.setattr(mrgl, 'COLUMNAR_BLOCK_ROWS', 1000)
+		for start, stop in [(0, 5), (17, 17), (40, -1), (nb_stars - 5, nb_stars + 20)]:
+			sub = mrgl.read_macho_lightcurve(tmp_path, filename, star_nb_start=start, star_nb_stop=stop, columns=columns)
+			ids = ref.id_M.unique()
+			expected = ids[start:] if stop < 0 else ids[start:stop+1]
+			assert sub.equals(ref[ref.id_M.isin(expected)].reset_index(drop=True))
+		stars = list(mrgl.iter_macho_stars(tmp_path, filename))
+	assert [id_M for id_M, lc in stars] == [id_M for id_M, lc in ref_stars]
+	assert all(np.array_equal(lc['time'], ref_lc['time']) for (_, lc), (_, ref_lc) in zip(stars, ref_stars))
+
+	# A new tile is read instead of the columns of the old one
+	write_macho_tile(tmp_path, 1, 3319, nb_stars=nb_stars // 2, seed=1)
+	new = mrgl.read_macho_lightcurve(tmp_path, filename, columns=columns)
+	assert new.id_M.nunique() == nb_stars // 2
+	mrgl.convert_macho_tile(tmp_path, filename)
+	assert mrgl.read_macho_lightcurve(tmp_path, filename, columns=columns).equals(new)
+
+
+def pandas_row_filter(df, bands, time_range=None, bad_times={}):
+	"""Late filtering of a loaded dataframe, as done before the loaders filtered rows"""
+	df = df.copy()
+	if time_range is not None:
+		df = df[df.time.between(*time_range)]
+	for mag, err in bands:
+		invalid = df[mag].isin([99.999, -99.]) | ~df[err].between(0, 9.999, inclusive='neither') | df.time.isin(bad_times.get(mag, []))
+		df.loc[invalid, [mag, err]] = np.nan
+	return df.dropna(axis=0, how='all', subset=[mag for mag, err in bands]).reset_index(drop=True)
+
+
+def test_row_filter(tmp_path, monkeypatch):
+	filename = write_macho_tile(tmp_path, 1, 3319, nb_stars=50)
+	ref = mrgl.read_macho_lightcurve(tmp_path, filename)
+	bad_times = {'red_M': ref.time.values[::7], 'blue_M': ref.time.values[::5]}
+	row_filter = mrgl.RowFilter(time_range=(49000., 52000.), bad_times=bad_times)
+	expected = pandas_row_filter(ref, mrgl.MACHO_BANDS, (49000., 52000.), bad_times)
+	assert len(expected) < len(ref) and expected.red_M.isnull().any()
+	with monkeypatch.context() as m:
+		m.setattr(mrgl, 'MACHO_BLOCK_SIZE', 4096)
+		t = mrgl.read_macho_lightcurve(tmp_path, filename, row_filter=row_filter)
+	pd.testing.assert_frame_equal(t, expected)
+	stars = list(mrgl.iter_macho_stars(tmp_path, filename, row_filter=mrgl.RowFilter(time_range=(0., 1.))))
+	assert stars == []
+	mrgl.convert_macho_tile(tmp_path, filename)
+	pd.testing.assert_frame_equal(mrgl.read_macho_lightcurve(tmp_path, filename, row_filter=row_filter), expected)
+
+
+def test_star_sample(tmp_path):
+	filename = write_macho_tile(tmp_path, 1, 3319, nb_stars=50)
+	ref = mrgl.read_macho_lightcurve(tmp_path, filename)
+	row_filter = mrgl.RowFilter(valid_mag=False, sample_fraction=0.2, seed=3)
+	expected = ref[sample_stars(ref.id_M.values, 0.2, seed=3)].reset_index(drop=True)
+	assert 0 < expected.id_M.nunique() < 50
+	pd.testing.assert_frame_equal(mrgl.read_macho_lightcurve(tmp_path, filename, row_filter=row_filter), expected)
+	mrgl.convert_macho_tile(tmp_path, filename)
+	pd.testing.assert_frame_equal(mrgl.read_macho_lightcurve(tmp_path, filename, row_filter=row_filter), expected)
+	assert [id_M for id_M, star in mrgl.iter_macho_stars(tmp_path, filename, row_filter=row_filter)] == list(expected.id_M.unique())
+
+
+def test_replaced_tile_index(tmp_path):
+	filename = write_macho_tile(tmp_path, 1, 3319, nb_stars=60)
+	mrgl.build_macho_tile_index(tmp_path, filename, spacing=64*1024)
+	assert mrgl.load_macho_tile_index(tmp_path, filename) is not None
+	# A new tile with other stars : the offsets of the old one would be wrong
+	write_macho_tile(tmp_path, 1, 3319, nb_stars=40, seed=1)
+	assert mrgl.load_macho_tile_index(tmp_path, filename) is None
+	ref = mrgl.read_macho_lightcurve(tmp_path, filename, use_index=False)
+	sub = mrgl.read_macho_lightcurve(tmp_path, filename, star_nb_start=10, star_nb_stop=19)
+	assert sub.equals(ref[ref.id_M.isin(ref.id_M.unique()[10:20])].reset_index(drop=True))
+	mrgl.build_macho_tile_index(tmp_path, filename, spacing=64*1024)
+	assert len(mrgl.load_macho_tile_index(tmp_path, filename)) == 41
+
+
+def test_tile_index_blank_lines(tmp_path):
+	filename = write_macho_tile(tmp_path, 1, 3319, nb_stars=30)
+	with gzip.open(tmp_path / filename, 'rb') as f:
+		lines = f.read().splitlines(keepends=True)
+	# Blank lines inside and between stars
+	for i in sorted([3, 120, 600, len(lines) // 2], reverse=True):
+		lines.insert(i, b'\n')
+	with gzip.open(tmp_path / filename, 'wb') as f:
+		f.writelines(lines)
+	ref = mrgl.read_macho_lightcurve(tmp_path, filename, use_index=False)
+	mrgl.build_macho_tile_index(tmp_path, filename, spacing=64*1024)
+	ids = ref.id_M.unique()
+	for start, stop in [(0, 3), (10, 20), (25, -1)]:
+		sub = mrgl.read_macho_lightcurve(tmp_path, filename, star_nb_start=start, star_nb_stop=stop)
+		expected = ids[start:] if stop < 0 else ids[start:stop+1]
+		assert sub.equals(ref[ref.id_M.isin(expected)].reset_index(drop=True))
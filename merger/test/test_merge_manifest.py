@@ -0,0 +1,115 @@
+import os
+
+import numpy as np
+
+from merger.clean.libraries import merger_library as mrgl
+from merger.clean.libraries.merge_manifest import MergeManifest, unit_key, file_checksum
+from merger.test.fake_data import write_merge_inputs
+
+
+def run_unit(manifest, output_dir, paths, parameters=None, force=False, quart="", bad_times_path=None):
+	row_filter = mrgl.RowFilter()
+	files = mrgl.merger_eros_first_inputs(1, "lm0103", quart=quart, **paths)
+	if bad_times_path is not None:
+		row_filter = mrgl.RowFilter(bad_times=mrgl.load_macho_bad_times(bad_times_path, 1))
+		files += list(mrgl.macho_bad_times_paths(bad_times_path, 1).values())
+	inputs = manifest.inputs(files, dict(parameters or {}, row_filter=row_filter.description()))
+
+	def merge():
+		mrgl.merger_eros_first(output_dir, 1, "lm0103", quart=quart, save=True, row_filter=row_filter, **paths)
+		return [os.path.join(output_dir, "1_lm0103" + quart + ".pkl")]
+	return manifest.run(unit_key(1, "lm0103", quart), inputs, merge, force=force)
+
+
+def test_merge_inputs(tmp_path):
+	paths = write_merge_inputs(tmp_path)
+	inputs = mrgl.merger_eros_first_inputs(1, "lm0103", **paths)
+	assert os.path.join(paths['correspondance_files_path'], "1.txt") in inputs
+	assert sorted(os.path.basename(path) for path in inputs if path.endswith("-lc.tar.gz")) == ["lm0103" + q + "-lc.tar.gz" for q in "klmn"]
+	assert sorted(os.path.basename(path) for path in inputs if path.startswith(paths['MACHO_files_path'])) == ["F_1.3319.gz", "F_1.3320.gz"]
+	# Quarter k is associated with tile 3319 only (see write_merge_inputs)
+	inputs = mrgl.merger_eros_first_inputs(1, "lm0103", quart="k", **paths)
+	assert [os.path.basename(path) for path in inputs[1:]] == ["lm0103k-lc.tar.gz", "F_1.3319.gz"]
+	inputs = mrgl.merger_macho_first_inputs(1, 3320, **paths)
+	assert sorted(os.path.basename(path) for path in inputs[1:]) == ["F_1.3320.gz", "lm0103l-lc.tar.gz", "lm0103n-lc.tar.gz"]
+	assert all(os.path.exists(path) for path in inputs)
+
+	# Indexes and converted columns are read instead of the files, they are inputs too
+	correspondance_path = os.path.join(paths['correspondance_files_path'], "1.txt")
+	archive_path = os.path.join(paths['EROS_files_path'], "lm010", "lm0103k-lc.tar.gz")
+	mrgl.build_correspondance_index(correspondance_path)
+	mrgl.build_eros_archive_index(archive_path)
+	mrgl.convert_macho_tile(os.path.join(paths['MACHO_files_path'], "F_1"), "F_1.3319.gz")
+	inputs = mrgl.merger_eros_first_inputs(1, "lm0103", quart="k", **paths)
+	assert inputs[:3] == [correspondance_path, archive_path, os.path.join(paths['MACHO_files_path'], "F_1", "F_1.3319.gz")]
+	sidecars = [os.path.relpath(path, tmp_path) for path in inputs[3:]]
+	assert os.path.join("correspondance", "1.idx", "source_stat.npy") in sidecars
+	assert {os.path.join("EROS", "lm010", "lm0103k-lc.tar.gz" + suffix) for suffix in (".gzidx", ".members.npy", ".source.npy")} <= set(sidecars)
+	assert os.path.join("MACHO", "F_1", "F_1.3319.cols", "source_stat.npy") in sidecars
+	assert all(os.path.isfile(path) for path in inputs)
+
+
+def test_load_bad_times(tmp_path):
+	paths = write_merge_inputs(tmp_path)
+	merged = mrgl.merger_eros_first(str(tmp_path), 1, "lm0103", save=False, **paths)
+	times = np.unique(merged.time[merged.red_M.notnull()])[:3]
+	# (amp, time) pairs, as written by bad_timestamp_filter.MACHO_get_bad_timestamps
+	np.save(tmp_path / "1_red_bad_timestamps", [(3, times[0]), (4, times[1]), (5, times[2])])
+	bad_times = mrgl.load_macho_bad_times(str(tmp_path), 1)
+	assert list(bad_times) == ['red_M'] and np.array_equal(bad_times['red_M'], times)
+	filtered = mrgl.merger_eros_first(str(tmp_path), 1, "lm0103", save=False, row_filter=mrgl.RowFilter(bad_times=bad_times), **paths)
+	assert not filtered.red_M[filtered.time.isin(times)].notnull().any()
+	assert filtered.red_M.count() == merged.red_M.count() - merged.red_M[merged.time.isin(times)].count()
+	np.save(tmp_path / "1_blue_bad_timestamps", np.empty((0, 2)))
+	assert len(mrgl.load_macho_bad_times(str(tmp_path), 1)['blue_M']) == 0
+
+
+def test_merge_manifest_resume(tmp_path):
+	paths = write_merge_inputs(tmp_path)
+	output_dir = str(tmp_path / "merged")
+	os.makedirs(output_dir)
+	manifest = MergeManifest(output_dir)
+	outputs, ran = run_unit(manifest, output_dir, paths)
+	assert ran and os.path.exists(outputs[0])
+	assert run_unit(manifest, output_dir, paths) == (outputs, False)
+	assert run_unit(manifest, output_dir, paths, force=True)[1]
+	# Other units are independent
+	assert run_unit(manifest, output_dir, paths, quart="k")[1]
+	assert not run_unit(manifest, output_dir, paths)[1]
+
+	# Missing output
+	os.remove(outputs[0])
+	assert run_unit(manifest, output_dir, paths)[1]
+	assert not run_unit(manifest, output_dir, paths)[1]
+
+	# New parameters
+	assert run_unit(manifest, output_dir, paths, {'min_points': 2})[1]
+	assert not run_unit(manifest, output_dir, paths, {'min_points': 2})[1]
+
+	# New bad timestamps file
+	bad_times_path = tmp_path / "bad_times"
+	os.makedirs(bad_times_path)
+	np.save(bad_times_path / "1_red_bad_timestamps", [(3, 49000.5)])
+	assert run_unit(manifest, output_dir, paths, bad_times_path=str(bad_times_path))[1]
+	assert not run_unit(manifest, output_dir, paths, bad_times_path=str(bad_times_path))[1]
+	np.save(bad_times_path / "1_red_bad_timestamps", [(3, 49000.5), (3, 49001.5)])
+	assert run_unit(manifest, output_dir, paths, bad_times_path=str(bad_times_path))[1]
+	np.save(bad_times_path / "1_blue_bad_timestamps", [(3, 49000.5)])
+	assert run_unit(manifest, output_dir, paths, bad_times_path=str(bad_times_path))[1]
+
+	# New index of the association file
+	mrgl.build_correspondance_index(os.path.join(paths['correspondance_files_path'], "1.txt"))
+	assert run_unit(manifest, output_dir, paths, bad_times_path=str(bad_times_path))[1]
+	assert not run_unit(manifest, output_dir, paths, bad_times_path=str(bad_times_path))[1]
+
+	# New association file : the CCD and its quarter depend on it
+	correspondance_path = os.path.join(paths['correspondance_files_path'], "1.txt")
+	checksum = file_checksum(correspondance_path)
+	with open(correspondance_path) as f:
+		lines = f.readlines()
+	with open(correspondance_path, 'w') as f:
+		f.writelines(lines[:-1])
+	assert file_checksum(correspondance_path) != checksum
+	assert run_unit(manifest, output_dir, paths, bad_times_path=str(bad_times_path))[1]
+	assert run_unit(manifest, output_dir, paths, quart="k")[1]
+	assert sorted(manifest.units()) == ["1:lm0103", "1:lm0103k"]
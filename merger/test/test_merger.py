@@ -0,0 +1,146 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import merger.clean.libraries.merger_library as mrgl
+from merger.clean.libraries.star_ids import decode_eros_id, macho_id_tile, sample_stars
+from merger.clean.libraries.lightcurves import RaggedLightcurves
+from merger.test.fake_data import write_merge_inputs
+
+
+def test_merger_eros_first(tmp_path):
+	paths = write_merge_inputs(tmp_path)
+	merged = mrgl.merger_eros_first(str(tmp_path), 1, "lm0103", save=False, **paths)
+	assert merged.id_E.dtype == np.int64 and merged.id_M.dtype == np.int64
+	assert merged.id_E.nunique() == 40
+	assert all(id_E[:7] in ("lm0103k", "lm0103l", "lm0103m", "lm0103n") for id_E in decode_eros_id(merged.id_E.unique()))
+	for id_E, star in merged.groupby('id_E'):
+		assert star.id_M.nunique() == 1
+		assert star.red_E.count() and star.red_M.count()
+	magnitudes = merged[['red_E', 'blue_E', 'red_M', 'blue_M']]
+	assert not magnitudes.isin([99.999, -99.]).any().any() and magnitudes.notnull().any(axis=1).all()
+	errors = merged[['rederr_E', 'blueerr_E', 'rederr_M', 'blueerr_M']]
+	assert ((errors > 0) & (errors < 9.999) | errors.isnull()).all().all()
+
+
+def test_merger_eros_first_parallel_quarters(tmp_path):
+	paths = write_merge_inputs(tmp_path)
+	serial = mrgl.merger_eros_first(str(tmp_path), 1, "lm0103", save=False, **paths)
+	parallel = mrgl.merger_eros_first(str(tmp_path), 1, "lm0103", save=False, n_workers=4, **paths)
+	assert serial.equals(parallel)
+	assert serial.equals(mrgl.merger_eros_first(str(tmp_path), 1, "lm0103", save=False, n_workers=2, max_inflight=1, **paths))
+	quarter = mrgl.merger_eros_first(str(tmp_path), 1, "lm0103", quart="l", save=False, n_workers=4, **paths)
+	assert all(id_E[:7] == "lm0103l" for id_E in decode_eros_id(quarter.id_E.unique()))
+
+
+def test_merger_macho_first(tmp_path):
+	paths = write_merge_inputs(tmp_path)
+	eros_first = mrgl.merger_eros_first(str(tmp_path), 1, "lm0103", save=False, **paths)
+	eros_first = eros_first[macho_id_tile(eros_first.id_M) == 3319]
+	for n_workers in (1, 4):
+		macho_first = mrgl.merger_macho_first(str(tmp_path), 1, save=False, MACHO_tile=3319, n_workers=n_workers, **paths)
+		assert macho_first.id_E.nunique() == eros_first.id_E.nunique() > 0
+		columns = list(eros_first.columns)
+		pd.testing.assert_frame_equal(macho_first[columns].sort_values(columns, ignore_index=True),
+									  eros_first.sort_values(columns, ignore_index=True))
+	mrgl.build_eros_archive_index(os.path.join(paths['EROS_files_path'], "lm010", "lm0103k-lc.tar.gz"))
+	indexed = mrgl.merger_macho_first(str(tmp_path), 1, save=False, MACHO_tile=3319, **paths)
+	pd.testing.assert_frame_equal(indexed.sort_values(columns, ignore_index=True)[columns], macho_first[columns].sort_values(columns, ignore_index=True))
+
+
+def test_merger_macho_first_tiles(tmp_path):
+	paths = write_merge_inputs(tmp_path)
+	eros_first = mrgl.merger_eros_first(str(tmp_path), 1, "lm0103", save=False, **paths)
+	columns = list(eros_first.columns)
+	for tiles in (np.array([3319, 3320]), [3319, 3320]):
+		macho_first = mrgl.merger_macho_first(str(tmp_path), 1, save=False, MACHO_tile=tiles, **paths)
+		pd.testing.assert_frame_equal(macho_first[columns].sort_values(columns, ignore_index=True), eros_first.sort_values(columns, ignore_index=True))
+	mrgl.merger_macho_first(str(tmp_path), 1, save=True, MACHO_tile=np.array([3319, 3320]), **paths)
+	saved = pd.read_pickle(tmp_path / "1_3319-3320.bz2", compression='bz2')
+	pd.testing.assert_frame_equal(saved[columns].sort_values(columns, ignore_index=True), eros_first.sort_values(columns, ignore_index=True))
+
+
+def test_merger_sample(tmp_path):
+	paths = write_merge_inputs(tmp_path)
+	full = mrgl.merger_eros_first(str(tmp_path), 1, "lm0103", save=False, **paths)
+	sampled = mrgl.merger_eros_first(str(tmp_path), 1, "lm0103", save=False, sample_fraction=0.3, seed=7, **paths)
+	ids = sampled.id_E.unique()
+	assert 0 < len(ids) < full.id_E.nunique()
+	assert set(ids) == set(full.id_E.unique()[sample_stars(full.id_E.unique(), 0.3, seed=7)])
+	pd.testing.assert_frame_equal(sampled.reset_index(drop=True), full[full.id_E.isin(ids)].reset_index(drop=True))
+	# The same sample is loaded from converted and indexed archives
+	for quart in "klmn":
+		archive = os.path.join(paths['EROS_files_path'], "lm010", "lm0103" + quart + "-lc.tar.gz")
+		if quart in "kl":
+			mrgl.build_eros_archive_index(archive)
+		else:
+			mrgl.convert_eros_archive(archive)
+	converted = mrgl.merger_eros_first(str(tmp_path), 1, "lm0103", save=False, sample_fraction=0.3, seed=7, **paths)
+	pd.testing.assert_frame_equal(converted.reset_index(drop=True), sampled.reset_index(drop=True))
+	macho_first = mrgl.merger_macho_first(str(tmp_path), 1, save=False, MACHO_tile=3319, sample_fraction=0.5, **paths)
+	assert set(macho_first.id_M.unique()) == set(full.id_M[(macho_id_tile(full.id_M) == 3319) & sample_stars(full.id_M.values, 0.5)].unique())
+
+
+def test_ragged_merge(tmp_path):
+	paths = write_merge_inputs(tmp_path)
+	merged = mrgl.merger_eros_first(str(tmp_path), 1, "lm0103", save=False, **paths)
+	lcs = mrgl.merger_eros_first(str(tmp_path), 1, "lm0103", save=True, ragged=True, **paths)
+	assert isinstance(lcs, RaggedLightcurves) and len(lcs) == merged.id_E.nunique()
+	assert (lcs.counts() > 0).all().all()
+	columns = list(merged.columns)
+	expected = merged.sort_values(['id_E', 'time', 'red_E', 'red_M'], ignore_index=True)
+	for frame in (lcs.to_frame(), pd.read_pickle(os.path.join(tmp_path, "1_lm0103.pkl"), compression='bz2')):
+		pd.testing.assert_frame_equal(frame[columns].sort_values(['id_E', 'time', 'red_E', 'red_M'], ignore_index=True), expected)
+
+	# Lightcurves of a star are views of the band arrays
+	id_E = lcs.ids[5]
+	star = merged[merged.id_E == id_E]
+	time, mag, err = lcs[id_E]['blue_M']
+	assert np.shares_memory(mag, lcs.mag['blue_M'])
+	valid = star.blue_M.notnull()
+	assert list(time) == list(star.time[valid]) and list(mag) == list(star.blue_M[valid]) and list(err) == list(star.blueerr_M[valid])
+	assert lcs.counterparts[5] == star.id_M.iloc[0]
+
+	# Round trip of a selection, with measures at the same time in a star
+	subset = RaggedLightcurves.from_frames(pd.concat([star, star.iloc[:3]], ignore_index=True))
+	assert subset.counts().loc[id_E, 'red_E'] == star.red_E.count() + star.red_E.iloc[:3].count()
+	assert len(subset.to_frame()) == len(star) + 3
+	selected = lcs.select(np.arange(len(lcs)) % 3 == 0)
+	assert list(selected.ids) == list(lcs.ids[::3])
+	pd.testing.assert_frame_equal(RaggedLightcurves.from_frames(selected.to_frame()).to_frame(), selected.to_frame())
+	macho_first = mrgl.merger_macho_first(str(tmp_path), 1, save=False, MACHO_tile=3319, ragged=True, **paths)
+	assert set(macho_first.ids) == set(merged.id_E[macho_id_tile(merged.id_M) == 3319])
+
+
+def test_filter_complete_stars():
+	rng = np.random.default_rng(0)
+	nb_rows = 50000
+	merged = pd.DataFrame({'time': rng.uniform(48000, 53000, nb_rows), 'id_E': rng.integers(0, 5000, nb_rows) << 8})
+	for mag, err in (('red_E', 'rederr_E'), ('blue_E', 'blueerr_E'), ('red_M', 'rederr_M'), ('blue_M', 'blueerr_M')):
+		merged[mag] = np.where(rng.random(nb_rows) < 0.7, rng.normal(18, 1, nb_rows), np.nan)
+		merged[err] = np.where(rng.random(nb_rows) < 0.95, 0.05, np.nan)
+	for min_points in (1, 3):
+		expected = merged.groupby('id_E').filter(lambda x: all((x[mag].notnull() & x[err].notnull()).sum() >= min_points
+										for mag, err in (('red_E', 'rederr_E'), ('blue_E', 'blueerr_E'), ('red_M', 'rederr_M'), ('blue_M', 'blueerr_M'))))
+		pd.testing.assert_frame_equal(mrgl.filter_complete_stars(merged, min_points), expected)
+	assert 0 < mrgl.filter_complete_stars(merged, 3).id_E.nunique() < mrgl.filter_complete_stars(merged, 1).id_E.nunique()
+	assert mrgl.filter_complete_stars(merged.iloc[:0]).empty
+
+
+def test_merger_field_out_of_core(tmp_path):
+	paths = write_merge_inputs(tmp_path)
+	merged = mrgl.merger_eros_first(str(tmp_path), 1, "lm0103", save=False, **paths)
+	for name in ("full", "sampled"):
+		os.makedirs(os.path.join(tmp_path, name))
+	with mrgl.local_dask_client(n_workers=2, memory_limit='1GB') as client:
+		partitions = mrgl.merger_field_out_of_core(os.path.join(tmp_path, "full"), 1, "lm010", n_partitions=8, client=client, **paths)
+		sampled = mrgl.merger_field_out_of_core(os.path.join(tmp_path, "sampled"), 1, "lm010", n_partitions=4, sample_fraction=0.5, client=client, **paths)
+	assert 1 < len(partitions) <= 8 and sorted(os.listdir(os.path.join(tmp_path, "full"))) == sorted(os.path.basename(path) for path in partitions)
+	frames = [pd.read_pickle(path, compression='bz2') for path in partitions]
+	# Each star is in a single partition
+	assert sum(frame.id_E.nunique() for frame in frames) == merged.id_E.nunique()
+	columns = ['id_E', 'time', 'red_E', 'red_M']
+	pd.testing.assert_frame_equal(pd.concat(frames)[merged.columns].sort_values(columns, ignore_index=True), merged.sort_values(columns, ignore_index=True))
+	sampled = pd.concat([pd.read_pickle(path, compression='bz2') for path in sampled])
+	assert set(sampled.id_E) == set(merged.id_E[sample_stars(merged.id_E.values, 0.5)])
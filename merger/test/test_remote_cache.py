@@ -0,0 +1,61 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from merger.clean.libraries.remote_cache import RemoteCache, get_remote_cache, REMOTE_CACHE_ENV
+
+
+def test_lru_eviction(tmp_path, monkeypatch):
+	cache = RemoteCache(str(tmp_path), budget=3000)
+	keys = [cache.key(f"/remote/{i}", 1000, 0) for i in range(4)]
+	assert len(set(keys)) == 4 and cache.key("/remote/0", 1000, 1) != keys[0]
+	for i, key in enumerate(keys[:3]):
+		cache.put(key, bytes([i]) * 1000)
+		os.utime(cache.object_path(key), (i, i))
+	assert cache.get(keys[0]) == bytes([0]) * 1000		# 0 is now the most recently used
+	cache.put(keys[3], bytes([3]) * 1000)
+	assert cache.get(keys[1]) is None
+	# Evicted down to the low water mark
+	assert [cache.get(key) is not None for key in keys] == [True, False, False, True]
+	assert sum(entry[1] for entry in cache.entries()) <= 2700
+
+	# Writes under the budget don't scan the cache
+	scans = []
+	entries = cache.entries
+	monkeypatch.setattr(cache, 'entries', lambda: scans.append(1) or entries())
+	cache.put(cache.key("/remote/4", 500, 0), bytes([4]) * 500)
+	assert not scans
+	# A replaced entry is counted once
+	cache.put(keys[3], bytes([3]) * 800)
+	assert not scans and cache._read_size() == sum(entry[1] for entry in entries()) == 2300
+
+	# Failed writes are not added
+	try:
+		with cache.writer(keys[1]) as f:
+			f.write(b'partial')
+			raise ValueError()
+	except ValueError:
+		pass
+	assert cache.get(keys[1]) is None and not os.listdir(cache.tmp_path)
+	assert get_remote_cache('') is None
+	monkeypatch.delenv(REMOTE_CACHE_ENV, raising=False)
+	assert get_remote_cache() is None
+	monkeypatch.setenv(REMOTE_CACHE_ENV, str(tmp_path / 'env'))
+	assert get_remote_cache().path == str(tmp_path / 'env')
+
+
+def put_entries(path, worker, nb_entries=50):
+	cache = RemoteCache(path, budget=20000)
+	for i in range(nb_entries):
+		key = cache.key(f"/remote/{i % 30}", 1000, 0)
+		data = cache.get(key)
+		assert data is None or data == bytes([i % 30]) * 1000
+		cache.put(key, bytes([i % 30]) * 1000)
+	return worker
+
+
+def test_concurrent_processes(tmp_path, n_workers=4):
+	with ProcessPoolExecutor(max_workers=n_workers) as pool:
+		assert list(pool.map(put_entries, [str(tmp_path)] * n_workers, range(n_workers))) == list(range(n_workers))
+	cache = RemoteCache(str(tmp_path), budget=20000)
+	assert sum(entry[1] for entry in cache.entries()) <= 20000
+	assert not os.listdir(cache.tmp_path)
@@ -0,0 +1,35 @@
+import numpy as np
+
+from merger.clean.libraries import star_ids
+
+
+def test_macho_ids():
+	ids = np.array(["1:3319:1", "82:12345:98765", "49:1:5"])
+	keys = star_ids.encode_macho_id_strings(ids)
+	assert keys.dtype == np.int64
+	assert list(star_ids.macho_id_tile(keys)) == [3319, 12345, 1]
+	assert list(star_ids.decode_macho_id(keys)) == list(ids)
+	assert star_ids.encode_macho_id_strings("1:3319:1") == keys[0]
+	assert star_ids.decode_macho_id(keys[1]) == "82:12345:98765"
+
+
+def test_eros_ids():
+	ids = np.array(["lm0103n1234", "lm0220k00012", "lm0594m7", "lm0103n1234"])
+	keys = star_ids.encode_eros_id(ids)
+	assert keys.dtype == np.int64
+	assert keys[0] == keys[3] and len(set(keys)) == 3
+	assert list(star_ids.decode_eros_id(keys)) == list(ids)
+	assert star_ids.encode_eros_id("lm0220k00012") == keys[1]
+	assert star_ids.decode_eros_id(keys[2]) == "lm0594m7"
+	assert list(star_ids.eros_id_ccd(keys)) == [3, 0, 4, 3]
+
+
+def test_sample_stars():
+	keys = star_ids.encode_macho_id(1, 3319, np.arange(1, 100001))
+	sample = star_ids.sample_stars(keys, 0.02, seed=1)
+	assert abs(sample.mean() - 0.02) < 0.003
+	assert (sample == star_ids.sample_stars(keys, 0.02, seed=1)).all()
+	assert (sample <= star_ids.sample_stars(keys, 0.1, seed=1)).all()
+	assert (sample & star_ids.sample_stars(keys, 0.02, seed=2)).sum() < 0.1 * sample.sum()
+	assert list(star_ids.sample_stars(keys[:10], 0., seed=1)) == [False] * 10
+	assert star_ids.sample_stars(keys[sample][0], 0.02, seed=1)[0]
@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Script to convert EROS-MACHO association files into binary indexes
+
+For each <field>.txt association file, write the <field>.idx directory of identifiers sorted both ways next to it,
+memory mapped by the mergers instead of parsing the text file.
+"""
+
+import argparse
+import os
+import time
+
+from merger.clean.libraries.merger_library import build_correspondance_index
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--path', type=str, required=True, help="Path to the association files (<MACHO field>.txt).")
+	parser.add_argument('--fields', type=int, nargs='+', required=True, help="MACHO fields")
+
+	args = parser.parse_args()
+
+	for field in args.fields:
+		print(field)
+		st1 = time.time()
+		index = build_correspondance_index(os.path.join(args.path, str(field)+".txt"))
+		print(f"{len(index)} pairs, {time.time()-st1} seconds")
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Script to build the member indexes of EROS quarter archives
+
+For each lmXXXXq-lc.tar.gz archive of the given EROS fields, write the gzip access checkpoints and the offsets of the lightcurves next to the archive,
+so that loaders can extract only some stars.
+"""
+
+import argparse
+import os
+import time
+
+from merger.clean.libraries.merger_library import build_eros_archive_index, EROS_INDEX_SPACING
+
+def index_field(filepath, spacing=EROS_INDEX_SPACING):
+	st1 = time.time()
+	for filename in sorted(os.listdir(filepath)):
+		if filename[-10:] == '-lc.tar.gz':
+			print(filename)
+			build_eros_archive_index(os.path.join(filepath, filename), spacing=spacing)
+	print(time.time()-st1)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--path', type=str, required=True, help="Path to EROS lightcurves archives (containing lmXXX directories).")
+	parser.add_argument('--fields', type=str, nargs='+', required=True, help="something like lmXXX")
+	parser.add_argument('--spacing', type=int, default=EROS_INDEX_SPACING, help="Decompressed bytes between two gzip checkpoints")
+
+	args = parser.parse_args()
+
+	for field in args.fields:
+		print(field)
+		index_field(os.path.join(args.path, field), spacing=args.spacing)
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Script to build the star indexes of MACHO tiles
+
+For each tile of a field, write the gzip access checkpoints and the star offsets next to the tile, so that loaders can seek directly to a star.
+"""
+
+import argparse
+import os
+import time
+
+from merger.clean.libraries.merger_library import build_macho_tile_index, MACHO_INDEX_SPACING
+
+def index_field(filepath, spacing=MACHO_INDEX_SPACING):
+	st1 = time.time()
+	for filename in sorted(os.listdir(filepath)):
+		if filename[-3:] == '.gz':
+			print(filename)
+			build_macho_tile_index(filepath, filename, spacing=spacing)
+	print(time.time()-st1)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--path', type=str, required=True, help="Path to MACHO lightcurves files.")
+	parser.add_argument('--fields', type=int, nargs='+', required=True)
+	parser.add_argument('--spacing', type=int, default=MACHO_INDEX_SPACING, help="Decompressed bytes between two gzip checkpoints")
+
+	args = parser.parse_args()
+
+	for field in args.fields:
+		print(field)
+		index_field(os.path.join(args.path, 'F_' + str(field)), spacing=args.spacing)
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Script to build the binary manifests of MACHO fields
+
+For each tile of a field, store its number of stars and rows, its decompressed size and its first and last star, in MACHOstarcounts/manifest_<field>.npy
+"""
+
+import argparse
+import time
+
+from merger.clean.libraries.merger_library import build_macho_field_manifest, STAR_COUNT_PATH
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--path', type=str, required=True, help="Path to MACHO lightcurves files.")
+	parser.add_argument('--fields', type=int, nargs='+', required=True)
+	parser.add_argument('--output-path', type=str, required=False, default=STAR_COUNT_PATH)
+
+	args = parser.parse_args()
+
+	for field in args.fields:
+		print(field)
+		st1 = time.time()
+		build_macho_field_manifest(args.path, field, output_path=args.output_path)
+		print(time.time()-st1)
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Script to convert EROS archives and MACHO tiles into memory mappable columns
+
+Each lmXXXXq-lc.tar.gz EROS archive and F_X.Y.gz MACHO tile is written once as a directory of .npy columns next to it (lmXXXXq-lc.cols, F_X.Y.cols).
+The merger_library loaders then read these columns instead of parsing the original files. Files replaced since their conversion are converted again.
+"""
+
+import argparse
+import os
+import time
+
+from merger.clean.libraries.merger_library import convert_eros_archive, convert_macho_tile, eros_columnar_path, macho_columnar_path, is_current_columnar
+
+def convert_eros_field(filepath, overwrite=False):
+	st1 = time.time()
+	for root, subdirs, files in os.walk(filepath):
+		for filename in sorted(files):
+			if filename[-10:] == '-lc.tar.gz' and (overwrite or not is_current_columnar(eros_columnar_path(os.path.join(root, filename)), os.path.join(root, filename))):
+				print(filename)
+				convert_eros_archive(os.path.join(root, filename))
+	print(time.time()-st1)
+
+def convert_macho_field(filepath, overwrite=False):
+	st1 = time.time()
+	for filename in sorted(os.listdir(filepath)):
+		if filename[-3:] == '.gz' and (overwrite or not is_current_columnar(macho_columnar_path(filepath, filename), os.path.join(filepath, filename))):
+			print(filename)
+			convert_macho_tile(filepath, filename)
+	print(time.time()-st1)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--EROS-path', '-pE', type=str, default=None, help="Path to EROS lightcurves archives (containing lmXXX directories).")
+	parser.add_argument('--EROS-fields', '-fE', type=str, nargs='*', default=[], help="something like lmXXX")
+	parser.add_argument('--MACHO-path', '-pM', type=str, default=None, help="Path to MACHO lightcurves files.")
+	parser.add_argument('--MACHO-fields', '-fM', type=int, nargs='*', default=[])
+	parser.add_argument('--overwrite', action='store_true', help="Convert again already converted files")
+
+	args = parser.parse_args()
+
+	for field in args.EROS_fields:
+		print(field)
+		convert_eros_field(os.path.join(args.EROS_path, field), overwrite=args.overwrite)
+	for field in args.MACHO_fields:
+		print(field)
+		convert_macho_field(os.path.join(args.MACHO_path, 'F_' + str(field)), overwrite=args.overwrite)
@@ -1,58 +1,17 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
-import gzip, os
+import os
 import time
 
+from merger.clean.libraries import merger_library
+
 def read_macho_lightcurve(filepath):
-    try:
-        with gzip.open(filepath, 'rt') as f:
-            lc = {'time':[], 
-                'red_M':[], 
-                'rederr_M':[], 
-                'blue_M':[], 
-                'blueerr_M':[], 
-                'id_M':[], 
-                # 'red_crowd':[], 
-                # 'blue_crowd':[], 
-                # 'red_avesky':[],
-                # 'blue_avesky':[], 
-                # 'airmass':[],
-                # 'red_fwhm':[],
-                # 'blue_fwhm':[],
-                # 'red_normsky':[],
-                # 'blue_normsky':[],
-                # 'red_chi2':[],
-                # 'blue_chi2':[],
-                # 'red_type':[],
-                # 'blue_type':[]
-                }
-            for line in f:
-                line = line.split(';')
-                lc['time'].append(float(line[4]))
-                lc['red_M'].append(float(line[9]))
-                lc['rederr_M'].append(float(line[10]))
-                lc['blue_M'].append(float(line[24]))
-                lc['blueerr_M'].append(float(line[25]))
-                lc['id_M'].append(line[1]+":"+line[2]+":"+line[3])
-                # lc['red_crowd'].append(float(line[13]))
-                # lc['blue_crowd'].append(float(line[28]))
-                # lc['red_avesky'].append(float(line[20]))
-                # lc['blue_avesky'].append(float(line[35]))
-                # lc['airmass'].append(float(line[8]))
-                # lc['red_fwhm'].append(float(line[21]))
-                # lc['blue_fwhm'].append(float(line[36]))
-                # lc['red_normsky'].append(float(line[11]))
-                # lc['blue_normsky'].append(float(line[26]))
-                # lc['red_chi2'].append(float(line[14]))
-                # lc['blue_chi2'].append(float(line[29]))
-                # lc['red_type'].append(float(line[12]))
-                # lc['blue_type'].append(float(line[27]))
-            f.close()
-    except FileNotFoundError:
+    # Other MACHO_SCHEMA columns can be added, for example 'red_crowd', 'airmass', 'red_fwhm' or 'red_chi2'
+    if not os.path.isfile(filepath):
         print(filepath+" doesn't exist.")
         return None
-    return pd.DataFrame.from_dict(lc)
+    return merger_library.read_macho_lightcurve(os.path.dirname(filepath), os.path.basename(filepath), columns=merger_library.MACHO_COLUMNS)
 
 def load_macho_tiles(MACHO_files_path, field, tile_list):
     macho_path = MACHO_files_path+"F_"+str(field)+"/"
@@ -12,5 +12,7 @@ setup(name='merger',
 		'matplotlib',
 		'astropy',
 		'numba',
-		'sklearn']
+		'sklearn'],
+	extras_require={
+		'index': ['indexed_gzip']}
 	)
\ No newline at end of file